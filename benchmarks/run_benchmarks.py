@@ -0,0 +1,281 @@
+"""
+Benchmarks of the respiration phase pipeline on synthetic recordings.
+
+Usage:
+    python benchmarks/run_benchmarks.py                  # quick sizes, compare against benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --sizes full     # up to several hours of data
+    python benchmarks/run_benchmarks.py --save_baseline  # store the results as the new baseline
+
+Exits with status 1 if a benchmark is slower (or uses more memory) than the baseline by more than the tolerance, or
+if one of the checks of the results (CHECKS) fails.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy import interpolate
+
+sys.path.append(str(Path(__file__).parents[1]))
+sys.path.append(str(Path(__file__).parents[1] / "src"))
+import respiration as resp
+import preprocessing
+import online_phase
+from config import event_ids
+from synthetic import synthetic_respiration, synthetic_events
+
+
+# (duration in seconds, sample rate)
+SIZES = {
+    "quick": [(2 * 60, 300), (10 * 60, 300), (10 * 60, 1000)],
+    "full": [(2 * 60, 300), (10 * 60, 300), (60 * 60, 300), (3 * 60 * 60, 300), (10 * 60, 1000), (60 * 60, 1000)],
+}
+WIDTHS = [50, 100]
+PEAK_METHODS = ["cwt", "fast"]
+MAX_CWT_SAMPLES = 200_000 # find_peaks_cwt takes minutes above this
+MAX_PLOT_SAMPLES = 1_500_000
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+
+
+def measure(func, *args, repeat = 1, **kwargs):
+    """
+    Runs func, returning its result, the best wall time over `repeat` runs and the peak memory (MB) traced by
+    tracemalloc in a separate run. Output printed by func is suppressed.
+    """
+    wall_times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            wall_times.append(time.perf_counter() - start)
+            plt.close("all")
+
+        tracemalloc.start()
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        plt.close("all")
+
+    return result, min(wall_times), peak / 1024**2
+
+
+def check_interpolate_nans(n_cases = 3000, seed = 0) -> list:
+    """
+    Compares respiration.interpolate_nans with interpolate.interp1d(fill_value = "extrapolate") (what
+    extract_phase_angle used before) on short random series with NaN runs, including leading and trailing runs next to
+    isolated valid samples, and small blocks so runs cross block edges.
+    """
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+
+    for _ in range(n_cases):
+        n = rng.integers(5, 40)
+        ts = rng.normal(size = n)
+        ts[rng.random(n) < rng.random() * 0.7] = np.nan
+        if rng.random() < 0.5:
+            ts[:rng.integers(1, 5)] = np.nan
+        if rng.random() < 0.5:
+            ts[-rng.integers(1, 5):] = np.nan
+
+        valid = ~np.isnan(ts)
+        if valid.sum() < 2:
+            continue
+
+        expected = ts.copy()
+        expected[~valid] = interpolate.interp1d(np.flatnonzero(valid), ts[valid], fill_value = "extrapolate")(np.flatnonzero(~valid))
+
+        resp.interpolate_nans(ts, block_size = int(rng.integers(1, 8)))
+        mismatches += not np.allclose(ts, expected)
+
+    return [f"interpolate_nans differs from interp1d in {mismatches} of {n_cases} cases"] if mismatches else []
+
+
+def check_phase_vector_groups() -> list:
+    """
+    The phase vector plots take a pandas Series with any index (e.g. the phase angles of a filtered DataFrame) as one
+    group, as well as lists of groups.
+    """
+    failures = []
+    angles = pd.Series([0.1, 1.2, -2.], index = [5, 7, 9])
+
+    try:
+        groups = resp._as_groups(angles)
+        if len(groups) != 1 or not np.array_equal(groups[0], angles.to_numpy()):
+            failures.append("_as_groups does not return a Series with a non-zero index as one group")
+
+        if len(resp._as_groups([angles, angles[:2]])) != 2:
+            failures.append("_as_groups does not split a list of Series into groups")
+
+        resp.plot_phase_vectors(angles)
+        resp.plot_average_phase_vectors(angles, pd.Series([1., .5, .2], index = [5, 7, 9]))
+    except Exception as error:
+        failures.append(f"phase vector plots fail on a Series with a non-zero index: {error!r}")
+    finally:
+        plt.close("all")
+
+    return failures
+
+
+def check_circular_mean_nans() -> list:
+    """
+    circular_mean and average_phase_angle are NaN for a group with a NaN angle (as the sums of sines and cosines they
+    replaced), and unaffected for the groups without.
+    """
+    failures = []
+    angles = np.array([[0.1, 0.5, np.nan], [1., 2., 3.]])
+    expected = np.angle(np.exp(1j * angles[1]).mean())
+
+    mean = resp.circular_mean(angles, axis = 1)
+    if not (np.isnan(mean[0]) and np.isclose(mean[1], expected % (2 * np.pi))):
+        failures.append(f"circular_mean of a group with a NaN is {mean[0]}, not NaN")
+
+    phase, magnitude = resp.average_phase_angle(angles, axis = 1)
+    if not (np.isnan(phase[0]) and np.isnan(magnitude[0]) and np.isclose(phase[1], expected)):
+        failures.append(f"average_phase_angle of a group with a NaN is {phase[0]}, {magnitude[0]}, not NaN")
+
+    if not np.isnan(resp.circular_mean(angles[0])):
+        failures.append("circular_mean of 1-D angles with a NaN is not NaN")
+
+    return failures
+
+
+CHECKS = [check_interpolate_nans, check_phase_vector_groups, check_circular_mean_nans]
+
+
+def run_checks() -> list:
+    """
+    Runs CHECKS, returning the failures.
+    """
+    return [failure for check in CHECKS for failure in check()]
+
+
+def run_benchmarks(sizes, repeat = 1):
+    results = {}
+
+    def record(name, n_samples, wall, peak):
+        results[name] = {"wall_s": wall, "peak_mb": peak, "n_samples": n_samples}
+        print(f"{name:<60} {wall:>9.3f} s {peak:>9.1f} MB")
+
+    tmp_dir = Path(tempfile.mkdtemp())
+
+    for duration, sfreq in sizes:
+        resp_ts, _ = synthetic_respiration(duration, sfreq = sfreq)
+        events = synthetic_events(len(resp_ts), sfreq, event_ids)
+        size = f"{duration // 60}min_{sfreq}Hz"
+
+        if sfreq != 300:
+            _, wall, peak = measure(preprocessing.polyphase_resample, resp_ts, sfreq, 300, h_freq = 10, repeat = repeat)
+            record(f"polyphase_resample[300Hz]@{size}", len(resp_ts), wall, peak)
+
+        for method in PEAK_METHODS:
+            if method == "cwt" and len(resp_ts) > MAX_CWT_SAMPLES:
+                continue
+
+            for widths in WIDTHS:
+                # widths are given in samples, scale them with the sample rate
+                scaled_widths = int(widths * sfreq / 300)
+                output, wall, peak = measure(resp.extract_phase_angle, resp_ts, widths = scaled_widths, min_sample = scaled_widths // 2, peak_method = method, repeat = repeat)
+                record(f"extract_phase_angle[{method},w={widths}]@{size}", len(resp_ts), wall, peak)
+
+                # low-memory mode, cleaned and normalised in place in float32
+                _, wall, peak = measure(resp.extract_phase_angle, resp_ts, widths = scaled_widths, min_sample = scaled_widths // 2, peak_method = method, dtype = np.float32, repeat = repeat)
+                record(f"extract_phase_angle[{method},w={widths},float32]@{size}", len(resp_ts), wall, peak)
+
+        normalised_ts, peaks, troughs, phase_angle = output
+
+        df, wall, peak = measure(resp.phase_angle_events, phase_angle, events, hz = sfreq, event_ids = event_ids, repeat = repeat)
+        record(f"phase_angle_events@{size}", len(resp_ts), wall, peak)
+
+        _, wall, peak = measure(online_phase.replay, resp_ts, sfreq, reference_phase = phase_angle, block_size = int(sfreq / 30), repeat = repeat)
+        record(f"online_phase_replay[{sfreq // 30} samples per block]@{size}", len(resp_ts), wall, peak)
+
+        angles = df["phase_angle"].dropna().to_numpy()
+        _, wall, peak = measure(resp.circular_mean, angles, repeat = repeat)
+        record(f"circular_mean[n={len(angles)}]@{size}", len(resp_ts), wall, peak)
+
+        _, wall, peak = measure(resp.average_phase_angle, angles, repeat = repeat)
+        record(f"average_phase_angle[n={len(angles)}]@{size}", len(resp_ts), wall, peak)
+
+        if len(resp_ts) <= MAX_PLOT_SAMPLES:
+            _, wall, peak = measure(resp.sanity_check_phase_angle, normalised_ts = normalised_ts, peaks = peaks, troughs = troughs, phase_angle = phase_angle, savepath = tmp_dir / "sanity.png")
+            record(f"sanity_check_phase_angle@{size}", len(resp_ts), wall, peak)
+
+            _, wall, peak = measure(resp.summary_plots, peaks, troughs, phase_angle, savepath = tmp_dir / "summary.png")
+            record(f"summary_plots@{size}", len(resp_ts), wall, peak)
+
+        hits = df[df["event"].str.contains("hit")]["phase_angle"].dropna().to_numpy()
+        misses = df[df["event"].str.contains("miss")]["phase_angle"].dropna().to_numpy()
+        _, wall, peak = measure(resp.polar_density_plot, [hits, misses], ["hits", "misses"], repeat = repeat)
+        record(f"polar_density_plot@{size}", len(resp_ts), wall, peak)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the names of benchmarks that are slower or use more memory than the baseline by more than tolerance
+    (relative). Very short benchmarks (< 10 ms) are only compared on memory, as their timing is mostly noise.
+    """
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        reference = baseline[name]
+
+        slower = result["wall_s"] > 0.01 and result["wall_s"] > reference["wall_s"] * (1 + tolerance)
+        larger = result["peak_mb"] > 1 and result["peak_mb"] > reference["peak_mb"] * (1 + tolerance)
+
+        if slower or larger:
+            regressions.append(name)
+            print(f"REGRESSION {name}: {reference['wall_s']:.3f} -> {result['wall_s']:.3f} s, {reference['peak_mb']:.1f} -> {result['peak_mb']:.1f} MB")
+
+    return regressions
+
+
+if __name__ in "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", choices = list(SIZES), default = "quick")
+    parser.add_argument("--repeat", type = int, default = 1, help = "timing runs per benchmark, the best is kept")
+    parser.add_argument("--tolerance", type = float, default = 0.5, help = "allowed relative slowdown before a regression is reported")
+    parser.add_argument("--baseline", type = Path, default = BASELINE_PATH)
+    parser.add_argument("--save_baseline", action = "store_true")
+    args = parser.parse_args()
+
+    failures = run_checks()
+    if failures:
+        print("\n".join(f"CHECK FAILED {failure}" for failure in failures))
+        sys.exit(1)
+
+    results = run_benchmarks(SIZES[args.sizes], repeat = args.repeat)
+
+    if args.save_baseline:
+        with args.baseline.open("w") as f:
+            json.dump({"machine": platform.platform(), "python": platform.python_version(), "results": results}, f, indent = 2)
+        print(f"Saved baseline to {args.baseline}")
+
+    elif args.baseline.exists():
+        with args.baseline.open() as f:
+            baseline = json.load(f)
+
+        if baseline["machine"] != platform.platform():
+            print(f"Note: baseline was recorded on {baseline['machine']}")
+
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
+        print("No regressions")
+
+    else:
+        print(f"No baseline at {args.baseline}, run with --save_baseline to create one")
@@ -0,0 +1,72 @@
+import numpy as np
+from scipy import signal
+
+
+def synthetic_respiration(duration, sfreq = 300, rate = (0.15, 0.35), amplitude_variation = 0.3, noise_level = 0.1, n_bursts = None, seed = 0):
+    """
+    Simulates a respiration trace with a slowly varying breathing rate and amplitude, measurement noise and short
+    high amplitude outlier bursts (movement, coughing).
+
+    Parameters
+    ----------
+    duration : float
+        length in seconds
+    sfreq : float, default 300
+        sample rate
+    rate : tuple of float, default (0.15, 0.35)
+        range of the breathing rate in Hz
+    amplitude_variation : float, default 0.3
+        relative variation of the breathing amplitude
+    noise_level : float, default 0.1
+        standard deviation of the white noise, relative to the breathing amplitude
+    n_bursts : int, default None
+        number of outlier bursts, by default one per 5 minutes
+    seed : int, default 0
+
+    Returns
+    -------
+    resp : np.ndarray
+        the respiration trace
+    true_peaks : np.ndarray
+        sample indices of the simulated end of inspirations (phase 0)
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = int(duration * sfreq)
+    time = np.arange(n_samples) / sfreq
+
+    # rate and amplitude as smooth random walks (low-passed noise)
+    sos = signal.butter(2, 0.02, fs = sfreq, output = "sos")
+    def smooth_walk():
+        walk = signal.sosfiltfilt(sos, rng.standard_normal(n_samples))
+        return walk / (np.abs(walk).max() + 1e-12)
+
+    inst_rate = np.mean(rate) + (rate[1] - rate[0]) / 2 * smooth_walk()
+    amplitude = 1 + amplitude_variation * smooth_walk()
+
+    phase = 2 * np.pi * np.cumsum(inst_rate) / sfreq
+    resp = amplitude * np.cos(phase) + noise_level * rng.standard_normal(n_samples)
+
+    # end of inspiration at phase 0 (mod 2 pi)
+    true_peaks = np.flatnonzero(np.diff(np.floor(phase / (2 * np.pi))) > 0) + 1
+
+    if n_bursts is None:
+        n_bursts = int(duration // 300)
+
+    for start in rng.integers(0, max(n_samples - int(2 * sfreq), 1), n_bursts):
+        length = int(rng.uniform(0.2, 2) * sfreq)
+        resp[start:start + length] += rng.choice([-1, 1]) * rng.uniform(4, 8)
+
+    return resp, true_peaks
+
+
+def synthetic_events(n_samples, sfreq, event_ids, rate = 0.5, seed = 0):
+    """
+    Random events in MNE format (sample, 0, trigger) with triggers drawn from event_ids, on average `rate` per second.
+    """
+    rng = np.random.default_rng(seed)
+    n_events = int(n_samples / sfreq * rate)
+
+    samples = np.sort(rng.choice(n_samples, n_events, replace = False))
+    triggers = rng.choice(list(event_ids.values()), n_events)
+
+    return np.column_stack([samples, np.zeros(n_events, dtype = int), triggers])
@@ -2,30 +2,75 @@ from config import recordings, event_ids
 import sys
 sys.path.append("src")
 from MEG_participant import MEG_participant
+from manifest import RawManifest
+from stages import Stage, StageGraph
+import instrumentation
+import landmarks
 from pathlib import Path
 import pickle as pkl
+import mne
+import numpy as np
+import argparse
+import functools
+import json
+import os
+import resource
+import time
+import traceback
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Manager
+
+# cerebellar AAL labels for the source space power
+ROI = ['Cerebelum_Crus1_L',
+     'Cerebelum_Crus1_R',
+     'Cerebelum_Crus2_L',
+     'Cerebelum_Crus2_R',
+     'Cerebelum_3_L',
+     'Cerebelum_3_R',
+     'Cerebelum_4_5_L',
+     'Cerebelum_4_5_R',
+     'Cerebelum_6_L',
+     'Cerebelum_6_R',
+     'Cerebelum_7b_L',
+     'Cerebelum_7b_R',
+     'Cerebelum_8_L',
+     'Cerebelum_8_R',
+     'Cerebelum_9_L',
+     'Cerebelum_9_R',
+     'Cerebelum_10_L',
+     'Cerebelum_10_R']
+
+# parameters of the pipeline stages. After changing one, the next run only reruns the stages using it and the
+# stages downstream of them
+PARAMS = dict(
+    resp = dict(l_freq = None, h_freq = 10, sample_rate = 300, resp_ch_name = "MISC001"),
+    peaks = dict(widths = 100, min_sample = 50, peak_method = "cwt", dtype = "float32"),
+    alpha = dict(l_freq = 8, h_freq = 13),
+    phase_bins = dict(n_bins = 36),
+)
 
-def determine_project_path():
-    pass
 
+PROJECT_PATH = Path("/projects/MINDLAB2021_MEG-CerebellarClock-FuncSig")
 
-def get_resp_data(participant, l_freq = None, h_freq = 10, sample_rate = 300):
-    resp_ts = participant.raw.copy().pick("MISC001")
-    resp_ts.load_data()
 
+def determine_project_path():
+    pass
 
-    resp_ts = resp_ts.filter(l_freq, h_freq, picks = "MISC001", n_jobs = participant.n_jobs)
-    resp_ts, tmp_events = resp_ts.resample(sample_rate, events = participant.events) # resampling the events at the same time!
 
-    first_sample = resp_ts.first_samp
+def get_resp_data(participant, l_freq = None, h_freq = 10, sample_rate = 300, resp_ch_name = "MISC001"):
+    # filtered and resampled respiration, read from the preprocessing cache if available
+    resp_array, tmp_events = participant.load_resp(l_freq = l_freq, h_freq = h_freq, resp_ch_name = resp_ch_name, sample_rate = sample_rate)
 
-    tmp_events[:, 0] = tmp_events[:, 0]-first_sample
+    info = mne.create_info([resp_ch_name], sfreq = sample_rate, ch_types = "misc")
+    resp_ts = mne.io.RawArray(np.asarray(resp_array)[np.newaxis, :], info, verbose = False)
 
-    data = {"respiration_timeseries": resp_ts, "events": tmp_events}
+    data = {"respiration_timeseries": resp_ts, "events": np.asarray(tmp_events)}
     
     print(participant.project_path)
     print(participant.subj_id)
-    output_path = Path(participant.project_path) / "scratch" / "resp_data_MH" / f"{participant.subj_id}.pkl"
+    output_path = participant.fnames["resp_data"]
 
     
     if not output_path.parent.exists():
@@ -37,46 +82,262 @@ def get_resp_data(participant, l_freq = None, h_freq = 10, sample_rate = 300):
 
 
 
-if __name__ in "__main__":
+def phase_binned_power(participant, l_freq, h_freq, n_bins):
+    participant.load_raw(preload = False)
+    participant.phase_binned_power(l_freq = l_freq, h_freq = h_freq, n_bins = n_bins)
+    del participant.raw
+
 
-    ROI = ['Cerebelum_Crus1_L',
-         'Cerebelum_Crus1_R',
-         'Cerebelum_Crus2_L',
-         'Cerebelum_Crus2_R',
-         'Cerebelum_3_L',
-         'Cerebelum_3_R',
-         'Cerebelum_4_5_L',
-         'Cerebelum_4_5_R',
-         'Cerebelum_6_L',
-         'Cerebelum_6_R',
-         'Cerebelum_7b_L',
-         'Cerebelum_7b_R',
-         'Cerebelum_8_L',
-         'Cerebelum_8_R',
-         'Cerebelum_9_L',
-         'Cerebelum_9_R',
-         'Cerebelum_10_L',
-         'Cerebelum_10_R']
-
-    for sub in recordings:
-        print("\n\n\n", sub)
-
-        participant = MEG_participant(
-            subj_id = sub["subject"], 
-            meg_date = sub["date"], 
-            mr_date = sub["mr_date"], 
-            bad_channels = sub["bad_channels"],
-            run_path = Path(__file__).parents[1],
-            event_ids = event_ids,
-            n_jobs = 4
-            )
-        
-        participant.populate_fnames()
+def source_power(participant, l_freq, h_freq, labels, freqs, n_jobs = 1):
+    if not hasattr(participant, "events"):
         participant.load_events()
-        participant.load_raw(preload = False)
-        get_resp_data(participant)
+    participant.load_raw(preload = False)
+    participant.create_epochs(event_id=event_ids, on_disk = True, l_freq = l_freq, h_freq = h_freq)
+    participant.epochs_extract_power_sourcespace(labels = labels, freqs = freqs, n_jobs = n_jobs)
+    del participant.raw
+
+
+def build_pipeline(n_jobs = 1) -> StageGraph:
+    """
+    The stages of the pipeline with the parameters in PARAMS. Stages are rerun when their parameters or input files
+    changed (see stages.StageGraph).
+    """
+    resp, peaks, alpha = PARAMS["resp"], PARAMS["peaks"], PARAMS["alpha"]
+
+    return StageGraph([
+        Stage("resp_data", get_resp_data, inputs = ["subj_raws_list", "events"], outputs = ["resp_data"], params = resp),
+        Stage("resp_angle", MEG_participant.extract_resp_angle, inputs = ["subj_raws_list", "events"], outputs = ["phase_angles_events", "phase_landmarks"], params = {**resp, **peaks}),
+        Stage("phase_binned_power", phase_binned_power, inputs = ["subj_raws_list", "phase_landmarks"], outputs = ["phase_binned_power"], params = {**alpha, **PARAMS["phase_bins"]}),
+        Stage("source_power", functools.partial(source_power, n_jobs = n_jobs), inputs = ["subj_raws_list", "events"], outputs = ["source_power"], params = {**alpha, "labels": ROI, "freqs": list(range(8, 14))}, version = 2),
+    ])
+
+
+def init_worker(max_memory_gb, profile_path):
+    """
+    Caps the address space of the current (worker) process, so allocations above the cap raise a MemoryError in that
+    worker only, and directs the stage timings to the profile log.
+    """
+    instrumentation.configure(profile_path)
+
+    if max_memory_gb:
+        max_bytes = int(max_memory_gb * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+def make_participant(sub, n_jobs = 1, project_path = PROJECT_PATH):
+    """
+    MEG_participant of an entry of config.recordings in project_path.
+    """
+    return MEG_participant(
+        subj_id = sub["subject"], 
+        meg_date = sub["date"], 
+        mr_date = sub["mr_date"], 
+        bad_channels = sub["bad_channels"],
+        run_path = Path(__file__).parents[1],
+        event_ids = event_ids,
+        project_path = Path(project_path),
+        n_jobs = n_jobs
+        )
+
+
+def process_subject(sub, n_jobs = 1, manifest_path = None, targets = ("resp_data",), force = False, project_path = PROJECT_PATH):
+    """
+    Runs the pipeline for one entry of config.recordings in project_path. Never raises, so one bad subject cannot
+    abort the batch.
+
+    Returns
+    -------
+    dict
+        subject, status ("success" or "failed"), wall time in seconds, the traceback on failure and the path of the
+        phase landmarks if they exist
+    """
+    start = time.perf_counter()
+    summary = {"subject": sub["subject"], "status": "success", "error": None, "stages": None, "phase_landmarks": None}
+
+    try:
+        participant = make_participant(sub, n_jobs = n_jobs, project_path = project_path)
+
+        manifest = RawManifest(manifest_path, Path(project_path) / "raw") if manifest_path else None
+        participant.populate_fnames(manifest = manifest)
+
+        # stages that are up to date are skipped, raw and events are only loaded by the stages that run
+        summary["stages"] = build_pipeline(n_jobs = n_jobs).run(participant, targets = list(targets), force = force)
+
+        if participant.fnames["phase_landmarks"].exists():
+            summary["phase_landmarks"] = str(participant.fnames["phase_landmarks"])
+
+    except Exception:
+        summary["status"] = "failed"
+        summary["error"] = traceback.format_exc()
+
+    summary["wall_time"] = time.perf_counter() - start
+
+    return summary
+
+
+def run_tracked(sub, running, *args):
+    """
+    process_subject, with the subject in the shared dict `running` while it runs. If the worker is killed, the subject
+    stays in it, so run_batch can tell which subjects were running when the pool broke.
+    """
+    running[sub["subject"]] = os.getpid()
+    try:
+        return process_subject(sub, *args)
+    finally:
+        running.pop(sub["subject"], None)
+
+
+def run_batch(batch, n_workers, running, max_memory_gb, profile_path, *args):
+    """
+    Runs run_tracked for the recordings in batch on a pool of n_workers processes.
+
+    Returns
+    -------
+    summaries : list of dict
+        summaries of the subjects that finished
+    unfinished : list of dict
+        recordings of the subjects that did not finish because a worker died and broke the pool
+    """
+    summaries, unfinished = [], []
+
+    # a fresh process per subject, so memory is given back to the node after each subject
+    with ProcessPoolExecutor(max_workers = n_workers, initializer = init_worker, initargs = (max_memory_gb, profile_path), max_tasks_per_child = 1) as executor:
+        futures = {executor.submit(run_tracked, sub, running, *args): sub for sub in batch}
+
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except BrokenProcessPool: # a worker was killed, e.g. by the OOM killer
+                unfinished.append(futures[future])
+                continue
+
+            print(f"Subject {summary['subject']}: {summary['status']} ({summary['wall_time']} s)")
+            summaries.append(summary)
+
+    return summaries, unfinished
+
+
+def run_cohort(recordings, n_workers = 4, n_jobs = 1, max_memory_gb = None, summary_path = None, project_path = PROJECT_PATH, targets = ("resp_data",), force = False):
+    """
+    Runs process_subject for all recordings across a pool of worker processes.
+
+    Parameters
+    ----------
+    recordings : list of dict
+        entries as in config.recordings
+    n_workers : int, default 4
+        number of subjects processed at the same time
+    n_jobs : int, default 1
+        n_jobs passed on to MEG_participant (MNE filtering, source power workers) inside each worker
+    max_memory_gb : float, default None
+        memory cap per worker process. None means no cap.
+    summary_path : str or pathlike, default None
+        where to write the run summary as json. Defaults to logs/run_summary_<timestamp>.json next to this file. The
+        stage timings of all subjects are written next to it (profile_<timestamp>.jsonl), and the breathing cycle
+        quality control of the subjects with phase landmarks (cycle_qc_<timestamp>.csv, see
+        landmarks.summarise_cycle_statistics).
+    project_path : pathlike
+        project directory of the participants. The raw file manifest (scratch/raw_manifest.json) is refreshed once
+        before the subjects are run, so the workers do not search the raw directory.
+    targets : list of str, default ("resp_data",)
+        stages of build_pipeline to run (with the stages they depend on), e.g. "resp_angle" or "source_power"
+    force : bool or list of str, default False
+        run all stages, or the listed ones, even if they are up to date
+
+    Returns
+    -------
+    list of dict
+        one summary per subject, see process_subject
+    """
+    timestamp = f"{datetime.now():%Y%m%d_%H%M%S}"
+    if summary_path is None:
+        summary_path = Path(__file__).parent / "logs" / f"run_summary_{timestamp}.json"
+
+    summary_path = Path(summary_path)
+    if not summary_path.parent.exists():
+        summary_path.parent.mkdir(parents=True)
+    profile_path = summary_path.parent / f"profile_{timestamp}.jsonl"
+
+    start = time.perf_counter()
+    summaries = []
+
+    project_path = Path(project_path)
+    manifest_path = project_path / "scratch" / "raw_manifest.json"
+    RawManifest(manifest_path, project_path / "raw").refresh(recordings)
+
+    # a killed worker breaks the pool and every unfinished subject with it. The subjects that had not started yet are
+    # run on a fresh pool, those that were running are rerun alone, and only a subject that kills its worker when
+    # run alone is failed
+    with Manager() as manager:
+        running = manager.dict()
+        batches = [(list(recordings), n_workers)]
+
+        while batches:
+            batch, workers = batches.pop(0)
+            done, unfinished = run_batch(batch, workers, running, max_memory_gb, profile_path, n_jobs, manifest_path, targets, force, project_path)
+            summaries.extend(done)
+
+            if not unfinished:
+                continue
+
+            if len(batch) == 1 and workers == 1:
+                sub = unfinished[0]
+                summary = {"subject": sub["subject"], "status": "failed", "error": "worker process died", "wall_time": None}
+                print(f"Subject {summary['subject']}: {summary['status']} ({summary['error']})")
+                summaries.append(summary)
+            else:
+                was_running = [sub for sub in unfinished if sub["subject"] in running]
+                not_started = [sub for sub in unfinished if sub["subject"] not in running]
+                if not was_running:
+                    was_running, not_started = unfinished, []
+
+                batches.extend(([sub], 1) for sub in was_running)
+                if not_started:
+                    batches.append((not_started, n_workers))
+
+            running.clear()
+
+    summaries = sorted(summaries, key = lambda summary: summary["subject"])
+
+    qc_path = None
+    landmark_paths = {summary["subject"]: summary["phase_landmarks"] for summary in summaries if summary.get("phase_landmarks")}
+    if landmark_paths:
+        qc = landmarks.summarise_cycle_statistics(landmarks.cohort_cycle_statistics(landmarks.load_cohort(landmark_paths)))
+        qc_path = summary_path.parent / f"cycle_qc_{timestamp}.csv"
+        qc.to_csv(qc_path, index = False)
+        print(qc.to_string())
+
+    run_summary = {
+        "n_workers": n_workers,
+        "max_memory_gb": max_memory_gb,
+        "total_wall_time": time.perf_counter() - start,
+        "succeeded": [summary["subject"] for summary in summaries if summary["status"] == "success"],
+        "failed": [summary["subject"] for summary in summaries if summary["status"] == "failed"],
+        "profile": str(profile_path),
+        "cycle_qc": str(qc_path) if qc_path else None,
+        "subjects": summaries
+    }
+
+    with summary_path.open("w") as f:
+        json.dump(run_summary, f, indent = 2)
+
+    print(f"Done: {len(run_summary['succeeded'])} succeeded, {len(run_summary['failed'])} failed. Summary in {summary_path}")
+
+    if profile_path.exists():
+        print(instrumentation.profile_table(profile_path).to_string())
+
+    return summaries
+
+
+if __name__ in "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_workers", type = int, default = 4, help = "number of subjects run in parallel")
+    parser.add_argument("--n_jobs", type = int, default = 1, help = "n_jobs for MNE within each subject")
+    parser.add_argument("--max_memory_gb", type = float, default = None, help = "memory cap per worker process")
+    parser.add_argument("--summary_path", type = Path, default = None)
+    parser.add_argument("--targets", nargs = "+", default = ["resp_data"], choices = list(build_pipeline().stages), help = "stages to run, with the stages they depend on")
+    parser.add_argument("--force", nargs = "*", default = None, help = "rerun these stages (all targets if no names are given) even if up to date")
+    args = parser.parse_args()
 
-        #participant.filter_raw(8, 13) # alpha band
-        #participant.create_epochs(event_id=event_ids)
-        #participant.epochs_extract_power_sourcespace(labels=ROI)
-        #participant.extract_resp_angle()
\ No newline at end of file
+    run_cohort(recordings, n_workers = args.n_workers, n_jobs = args.n_jobs, max_memory_gb = args.max_memory_gb, summary_path = args.summary_path, targets = args.targets, force = True if args.force == [] else (args.force or False))
@@ -1,8 +1,19 @@
+import json
 import mne
+import numpy as np
 from mne.minimum_norm import apply_inverse, make_inverse_operator
 from pathlib import Path
 import respiration as resp
+import preprocessing
 import pickle as pkl
+from cache import ArrayCache, OperatorCache, array_fingerprint, file_fingerprint, make_key
+import event_store
+import epoching
+import source_power
+import phase_binning
+import online_phase
+from landmarks import CycleLandmarks
+from instrumentation import instrumented, stage, array_sizes
 from config import event_ids
 
 
@@ -18,7 +29,18 @@ class MEG_participant:
         self.n_jobs = n_jobs
         self.fnames = {}
 
-    def populate_fnames(self, mkdirs = True):
+    @instrumented
+    def populate_fnames(self, mkdirs = True, manifest = None):
+        """
+        Sets the paths used by the pipeline in self.fnames.
+
+        Parameters
+        ----------
+        mkdirs : bool, default True
+            create the directories (output_dirs) if they do not exist
+        manifest : manifest.RawManifest, default None
+            if provided, the raw files are looked up in the manifest instead of searching the raw directory
+        """
         self.fnames["raw"] =  self.project_path / "raw"
         self.fnames["scratch"] =  self.project_path / "scratch"
         self.fnames["MEG"] =  self.fnames["scratch"] / "MEG"
@@ -26,24 +48,45 @@ class MEG_participant:
         self.fnames["fig"] =  self.run_path / "fig" / self.subj_id
         self.fnames["subjects_dir"] = self.fnames["scratch"] / "freesurfer"
         self.fnames["events"] = self.fnames["MEG"] / self.subj_id / self.meg_date / "fc-eve.fif"
+        self.fnames["epochs"] = self.fnames["MEG"] / self.subj_id / self.meg_date / "epochs"
         self.fnames["resp"] = self.fnames["scratch"] / "respiration" / self.subj_id
+        self.fnames["resp_cache"] = self.fnames["scratch"] / "respiration" / "cache"
         self.fnames["subj_freesurfer"] = self.fnames["scratch"] / "freesurfer" / self.subj_id
         self.fnames["subj_bem"] = self.fnames["subj_freesurfer"] / "bem"
+        self.fnames["bem_sol"] = self.fnames["subj_bem"] / f"{self.subj_id}-bem-sol.fif"
+        self.fnames["trans"] = self.fnames["subj_bem"] / f"{self.subj_id}-trans.fif"
+        self.fnames["atlas"] = self.fnames["subj_freesurfer"] / "mri" / "aal.mgz" # AAL atlas warped to the subject's MRI
+        self.fnames["source_power"] = self.fnames["scratch"] / "source_power" / self.subj_id
+        self.fnames["operator_cache"] = self.fnames["scratch"] / "operator_cache"
         self.fnames["phase_angles_events"] = self.fnames["resp"] / f"{self.subj_id}_phase_angles_events.csv"
+        self.fnames["phase_event_store"] = self.fnames["scratch"] / "respiration" / "phase_event_store"
         self.fnames["phase_angles_ts"] = self.fnames["resp"] / f"{self.subj_id}_phase_angles.pkl"
+        self.fnames["phase_binned_power"] = self.fnames["resp"] / f"{self.subj_id}_phase_binned_power.npz"
+        self.fnames["phase_landmarks"] = self.fnames["resp"] / f"{self.subj_id}_phase_landmarks.npz"
+        self.fnames["online_phase_report"] = self.fnames["resp"] / f"{self.subj_id}_online_phase.json"
+        self.fnames["resp_data"] = self.fnames["scratch"] / "resp_data_MH" / f"{self.subj_id}.pkl"
+        self.fnames["stage_state"] = self.fnames["scratch"] / "pipeline_state" / f"{self.subj_id}.json"
 
-        files_with_number = list((self.fnames["raw"] / self.subj_id / self.meg_date / "MEG").rglob("*raw_[0-9].fif"))
-        files_without_number = list((self.fnames["raw"] / self.subj_id / self.meg_date / "MEG").rglob("*raw.fif"))
-        self.fnames["subj_raws_list"] = sorted(files_with_number + files_without_number)
+        if manifest is not None:
+            self.fnames["subj_raws_list"] = manifest.raw_files(self.subj_id, self.meg_date)
+        else:
+            files_with_number = list((self.fnames["raw"] / self.subj_id / self.meg_date / "MEG").rglob("*raw_[0-9].fif"))
+            files_without_number = list((self.fnames["raw"] / self.subj_id / self.meg_date / "MEG").rglob("*raw.fif"))
+            self.fnames["subj_raws_list"] = sorted(files_with_number + files_without_number)
 
         if mkdirs:
-            for name, path in self.fnames.items():
-                if name.endswith("_list") or "." in str(path): # not turning files into dirs
-                    continue
-                if not path.exists():
-                    path.mkdir(parents = True)
+            # one mkdir per directory rather than a stat and a mkdir
+            for path in self.output_dirs():
+                path.mkdir(parents = True, exist_ok = True)
+
+    def output_dirs(self) -> list:
+        """
+        The directories in self.fnames (not the files or the raw file list).
+        """
+        return [path for name, path in self.fnames.items() if not (name.endswith("_list") or "." in str(path))] # not turning files into dirs
 
         
+    @instrumented
     def load_raw(self, preload = False):
         raws = []
         for fname in self.fnames["subj_raws_list"]:
@@ -51,13 +94,72 @@ class MEG_participant:
             
         self.raw = mne.concatenate_raws(raws)
 
+    @instrumented
+    def read_channel(self, ch_name):
+        """
+        Reads a single channel across all files in subj_raws_list, without building a concatenated Raw object.
+
+        Only the headers of the files are parsed, and data is read file by file for the picked channel only, so memory
+        scales with one channel rather than all MEG channels.
+
+        Returns
+        -------
+        data : np.ndarray
+            contiguous float array with the channel data of all files
+        sfreq : float
+            sample rate
+        first_samps : np.ndarray
+            first sample of each file. Events from the event file are at data index sample - first_samps[0], as for
+            the concatenated Raw object from load_raw.
+        boundaries : np.ndarray
+            data indices where a new file starts (excluding the first)
+        """
+        raws = [mne.io.read_raw_fif(fname, preload = False, verbose = False) for fname in self.fnames["subj_raws_list"]]
+        n_times = [raw.n_times for raw in raws]
+
+        data = np.empty(sum(n_times))
+        starts = np.cumsum([0] + n_times)
+
+        for raw, start, stop in zip(raws, starts[:-1], starts[1:]):
+            data[start:stop] = raw.get_data(picks = [ch_name])[0]
+            raw.close()
+
+        return data, raws[0].info["sfreq"], np.array([raw.first_samp for raw in raws]), starts[1:-1]
+
+    def raw_segments(self):
+        """
+        Sample rate, first sample, and the start and length of each file in subj_raws_list in samples from the start
+        of the first file, from the file headers only.
+        """
+        raws = [mne.io.read_raw_fif(fname, preload = False, verbose = False) for fname in self.fnames["subj_raws_list"]]
+        lengths = np.array([raw.n_times for raw in raws])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+        return raws[0].info["sfreq"], raws[0].first_samp, starts, lengths
+
+    @instrumented
     def filter_raw(self, h_freq = 40, l_freq = None):
         self.raw = self.raw.filter(l_freq = l_freq, h_freq = h_freq)
         
+    @instrumented
     def load_events(self):
         self.events = mne.read_events(self.fnames["events"])
 
-    def create_epochs(self, event_id, tmin = -0.2, tmax = 1, baseline = (None, 0)):
+    @instrumented
+    def create_epochs(self, event_id, tmin = -0.2, tmax = 1, baseline = (None, 0), on_disk = False, chunk_size = 200, l_freq = None, h_freq = None):
+        """
+        Epochs self.raw around self.events.
+
+        on_disk:
+            if False, self.epochs is a preloaded mne.Epochs. If True, epochs are created chunk_size events at a time
+            and the accepted ones are written to fnames["epochs"]; self.epochs is then an epoching.EpochStore with the
+            epochs memory-mapped and iterators per condition, so the epochs never have to fit in memory (load the raw
+            with preload = False).
+
+        l_freq, h_freq:
+            with on_disk, the epochs are band-pass filtered chunk by chunk (see epoching.write_epochs) rather than
+            the preloaded raw with filter_raw
+        """
         # Picks MEG channels
         picks = mne.pick_types(
             self.raw.info, meg=True, eeg=False, eog=True, stim=False, exclude=self.bad_channels
@@ -65,6 +167,10 @@ class MEG_participant:
         
         reject = dict(grad=4000e-13, mag=4e-12, eog=150e-6)
 
+        if on_disk:
+            self.epochs = epoching.write_epochs(self.raw, self.events, event_id, self.fnames["epochs"], tmin = tmin, tmax = tmax, picks = picks, baseline = baseline, reject = reject, chunk_size = chunk_size, l_freq = l_freq, h_freq = h_freq)
+            return
+
         # Load epochs
         self.epochs = mne.Epochs(
             self.raw,
@@ -78,55 +184,328 @@ class MEG_participant:
             preload=True,
         )
 
-    """
-    def epochs_extract_power_sourcespace(self, labels = ['Cerebelum_Crus1_R'], freqs = None):
+    def operator_key(self, store, labels, pos = 5., loose = 1., depth = None, tmax = 0.) -> dict:
+        """
+        Cache keys of the forward solution, noise covariance and inverse operator used for source space analyses of
+        the epochs in store (see inverse_operator).
+        """
+        fwd_key = make_key(
+            subject = self.subj_id, mr_date = self.mr_date, bad_channels = sorted(self.bad_channels),
+            labels = list(labels), pos = pos,
+            atlas = file_fingerprint(self.fnames["atlas"]), trans = file_fingerprint(self.fnames["trans"]), bem = file_fingerprint(self.fnames["bem_sol"]),
+            raw_files = [file_fingerprint(fname) for fname in self.fnames["subj_raws_list"]], # sensor positions and head position
+            ch_names = store.ch_names
+            )
+        # the epochs by content, so epoching again with the same settings keeps the covariance
+        cov_key = make_key(
+            subject = self.subj_id, raw_files = [file_fingerprint(fname) for fname in self.fnames["subj_raws_list"]],
+            events = array_fingerprint(store.events), shape = store.meta["shape"], tmin = store.meta["tmin"], sfreq = store.meta["sfreq"],
+            highpass = store.info["highpass"], lowpass = store.info["lowpass"], ch_names = store.ch_names, tmax = tmax
+            )
+        inv_key = make_key(fwd = fwd_key, cov = cov_key, loose = loose, depth = depth)
 
-        inverse_operator = make_inverse_operator(self.raw.info, fwd, noise_cov, depth=None, loose=loose, verbose=True)
-        
-        labels_power = mne.norm.source_induced_power(
-            self.epochs,
-            inverse_operator,
-            freqs,
-            labels,
-            baseline=(-0.1, 0),
-            baseline_mode="mean",
-            n_cycles=n_cycles,
-            n_jobs=None,
-            return_plv=False,
-        )
-        pass
-    """
-    def extract_resp_angle(self, l_freq = None, h_freq = 10, resp_ch_name = "MISC001", sample_rate = 300):        
-        # check if raw is loaded, if not:
-        if not self.raw.preload: # only load the respiratory channel
-            resp_ts = self.raw.copy().pick(resp_ch_name)
-            resp_ts.load_data()
-        
-        else: # get the respiration data
-            resp_ts = self.raw.copy().pick(resp_ch_name)
+        return {"fwd": fwd_key, "cov": cov_key, "inv": inv_key}
+
+    def inverse_operator(self, store, labels, pos = 5., loose = 1., depth = None, tmax = 0., n_jobs = None, use_cache = True):
+        """
+        Inverse operator for a volume source space of atlas labels, from the operator cache in fnames["operator_cache"].
+
+        The cache is keyed by subject, MR date, bad channels, labels, grid spacing and fingerprints of the atlas,
+        trans, BEM and raw files (forward solution), by the content of the epochs (noise covariance over their
+        baselines up to tmax) and by loose and depth (inverse). Entries are only made, or read, when needed: if the
+        inverse operator is cached, neither the forward solution nor the covariance is computed or loaded.
+        """
+        keys = self.operator_key(store, labels, pos = pos, loose = loose, depth = depth, tmax = tmax)
+        cache = OperatorCache(self.fnames["operator_cache"])
+        meta = {"subj_id": self.subj_id, "labels": list(labels)}
+
+        def make_fwd():
+            with stage("forward"):
+                src = source_power.setup_label_source_space(self.subj_id, self.fnames["subjects_dir"], self.fnames["atlas"], labels, pos = pos, bem = self.fnames["bem_sol"], n_jobs = n_jobs)
+                return mne.make_forward_solution(store.info, self.fnames["trans"], src, self.fnames["bem_sol"], meg = True, eeg = False, n_jobs = n_jobs, verbose = False)
+
+        def make_cov():
+            with stage("noise_cov"):
+                return source_power.baseline_covariance(store, tmax = tmax)
+
+        def make_inv():
+            fwd = cache.get_or_make("fwd", keys["fwd"], make_fwd, meta) if use_cache else make_fwd()
+            noise_cov = cache.get_or_make("cov", keys["cov"], make_cov, meta) if use_cache else make_cov()
+            return make_inverse_operator(store.info, fwd, noise_cov, loose = loose, depth = depth, verbose = False)
+
+        if not use_cache:
+            return make_inv()
+
+        return cache.get_or_make("inv", keys["inv"], make_inv, meta)
+
+    @instrumented
+    def epochs_extract_power_sourcespace(self, labels = ['Cerebelum_Crus1_R'], freqs = None, n_cycles = None, baseline = (-0.1, 0), baseline_mode = "mean", pos = 5., decim = 1, n_jobs = None):
+        """
+        Induced power per source space label, condition and frequency, saved as one array per label in
+        fnames["source_power"] (see source_power.save_label_power).
+
+        The inverse operator comes from the operator cache (see inverse_operator). The projections of the labels are
+        kept in self.label_projections and reused by later calls with the same operator, e.g. for other frequencies.
+
+        Uses self.epochs, which are written to fnames["epochs"] first if they are in memory (create_epochs with
+        on_disk = False).
+
+        n_jobs:
+            worker processes for the label x frequency block tasks, self.n_jobs if None
+        """
+        freqs = np.arange(8, 14) if freqs is None else freqs
+        n_jobs = self.n_jobs if n_jobs is None else n_jobs
+
+        store = self.epochs if isinstance(self.epochs, epoching.EpochStore) else epoching.epochs_to_store(self.epochs, self.fnames["epochs"])
+
+        key = self.operator_key(store, labels, pos = pos)
+
+        if getattr(self, "label_projections", {}).get("key") != key:
+            with stage("inverse", n_labels = len(labels)):
+                inverse_operator = self.inverse_operator(store, labels, pos = pos, n_jobs = n_jobs)
+
+                kernel, ch_names = source_power.inverse_kernel(inverse_operator, store.info)
+                self.label_projections = {
+                    "key": key,
+                    "ch_names": ch_names,
+                    "projections": source_power.label_projections(kernel, source_power.label_slices(inverse_operator["src"], labels))
+                    }
+
+        with stage("label_power", n_freqs = len(freqs), n_epochs = len(store)):
+            power, info = source_power.extract_label_power(
+                store, self.label_projections["projections"], self.label_projections["ch_names"], freqs,
+                n_cycles = n_cycles, decim = decim, baseline = baseline, baseline_mode = baseline_mode, n_jobs = n_jobs
+                )
+
+        source_power.save_label_power(power, info, self.fnames["source_power"])
+
+        return power, info
+
+    @instrumented
+    def phase_binned_power(self, phase_angle = None, l_freq = 8, h_freq = 13, n_bins = 36, sample_rate = 300, chunk_duration = 60.):
+        """
+        Band power (squared Hilbert envelope, l_freq to h_freq) of the good MEG channels per respiratory phase bin,
+        accumulated in one pass over self.raw (which does not need to be preloaded) and saved to
+        fnames["phase_binned_power"].
+
+        phase_angle:
+            landmarks.CycleLandmarks at the native sample rate, as saved by extract_resp_angle (read from
+            fnames["phase_landmarks"] if None), so the phase is evaluated at each MEG sample. Or a continuous phase
+            angle at sample_rate, in which case MEG samples are mapped to the phase sample at the same time, file by
+            file, as in load_resp.
+
+        Returns
+        -------
+        phase_binning.PhaseBinnedAccumulator
+        """
+        if phase_angle is None:
+            phase_angle = CycleLandmarks.load(self.fnames["phase_landmarks"])
+
+        sfreq = self.raw.info["sfreq"]
+        picks = mne.pick_types(self.raw.info, meg = True, exclude = self.bad_channels)
 
-        resp_ts = resp_ts.filter(l_freq, h_freq, picks = resp_ch_name, n_jobs = self.n_jobs)
-        resp_ts, tmp_events = resp_ts.resample(sample_rate, events = self.events) # resampling the events at the same time!
+        _, _, starts, lengths = self.raw_segments()
 
-        first_sample = resp_ts.first_samp
+        accumulator = phase_binning.PhaseBinnedAccumulator(n_bins, len(picks), names = [self.raw.ch_names[pick] for pick in picks])
 
-        tmp_events[:, 0] = tmp_events[:, 0]-first_sample
+        for start, power in phase_binning.iter_band_power(self.raw, l_freq, h_freq, picks = picks, chunk_duration = chunk_duration, boundaries = starts[1:]):
+            samples = np.arange(start, start + power.shape[1])
 
-        resp_ts = resp_ts.get_data().squeeze() # squeeze to get rid of the channel dimension
-        normalised_ts, peaks, troughs, phase_angle = resp.extract_phase_angle(resp_ts, widths=100, min_sample = 50)
+            if isinstance(phase_angle, CycleLandmarks):
+                phase = phase_angle.phase_at(samples)
+            else:
+                phase_idx = preprocessing.remap_samples(samples, sfreq, sample_rate, starts, lengths)
+                phase = np.full(len(phase_idx), np.nan)
+                in_range = phase_idx < len(phase_angle)
+                phase[in_range] = phase_angle[phase_idx[in_range]]
 
+            accumulator.update(phase, power)
 
-        df = resp.phase_angle_events(phase_angle, tmp_events, hz = 300, event_ids = self.event_ids)
+        accumulator.save(self.fnames["phase_binned_power"])
 
-        df.to_csv(self.fnames["phase_angles_events"], index = False)
+        return accumulator
+
+    @instrumented
+    def replay_online_phase(self, block_size = 10, l_freq = None, h_freq = 10, resp_ch_name = "MISC001", sample_rate = 300, **kwargs):
+        """
+        Replays the recorded respiration through the causal online phase estimator in blocks of block_size samples
+        and compares it with the offline phase (from fnames["phase_landmarks"] of extract_resp_angle if it exists, so
+        use the same respiration settings). The report (update times, phase error and peak detection delay, see
+        online_phase.replay) is saved to fnames["online_phase_report"].
+
+        **kwargs:
+            passed on to online_phase.OnlinePhaseEstimator
+
+        Returns
+        -------
+        report : dict
+        online_phase : np.ndarray
+        """
+        resp_ts, _ = self.load_resp(l_freq = l_freq, h_freq = h_freq, resp_ch_name = resp_ch_name, sample_rate = sample_rate)
+
+        reference_phase = None
+        if self.fnames["phase_landmarks"].exists():
+            _, _, starts, lengths = self.raw_segments()
+            landmarks = CycleLandmarks.load(self.fnames["phase_landmarks"]).resampled(sample_rate, starts, lengths)
+            reference_phase = landmarks.to_array(len(resp_ts))
+
+        report, phase, _ = online_phase.replay(resp_ts, sample_rate, reference_phase = reference_phase, block_size = block_size, **kwargs)
+        report["subject"] = self.subj_id
+
+        with open(self.fnames["online_phase_report"], "w") as f:
+            json.dump(report, f, indent = 1)
+
+        print(f"{self.subj_id}: online phase error {report['phase_error_median_abs']:.2f} rad (median absolute), peaks detected after {report['peak_detection_delay']:.2f} s, {report['update_us_median']:.0f} us per block")
+
+        return report, phase
+
+    @instrumented
+    def load_resp(self, l_freq = None, h_freq = 10, resp_ch_name = "MISC001", sample_rate = 300, use_cache = True, cache_size_gb = 20, resample_method = "polyphase"):
+        """
+        Filtered and resampled respiration channel with the events resampled to the same rate.
+
+        The result is cached under fnames["resp_cache"], keyed by the raw and event files (path, size and mtime), the
+        filter settings, the sample rate, the channel name and the resampling method. On a cache hit no FIF file is read.
+
+        resample_method:
+            "polyphase": filtering and resampling in a single chunked pass over the channel, with the events remapped
+                exactly to the new sample rate (see preprocessing.filter_resample_segments).
+            "mne": Raw.filter followed by Raw.resample, as before. The results differ by less than 1% of the
+                standard deviation of the signal away from large artefacts.
+
+        Returns
+        -------
+        resp_ts : np.ndarray
+            respiration timeseries (read-only memory map when loaded from the cache)
+        events : np.ndarray
+            events with samples relative to the first sample of resp_ts
+        """
+        key = make_key(
+            raw_files = [file_fingerprint(fname) for fname in self.fnames["subj_raws_list"]],
+            events = file_fingerprint(self.fnames["events"]),
+            l_freq = l_freq, h_freq = h_freq, sample_rate = sample_rate, resp_ch_name = resp_ch_name,
+            resample_method = resample_method
+            )
+        cache = ArrayCache(self.fnames["resp_cache"], max_bytes = cache_size_gb * 1024**3)
+
+        if use_cache:
+            arrays, _ = cache.get(key)
+            if arrays is not None:
+                return arrays["resp"], arrays["events"]
+
+        if not hasattr(self, "events"):
+            self.load_events()
+
+        # only the respiratory channel is read from disk
+        data, sfreq, first_samps, boundaries = self.read_channel(resp_ch_name)
+        sizes = array_sizes(resp_ts = data)
+
+        if resample_method == "polyphase":
+            tmp_events = self.events.copy()
+            tmp_events[:, 0] -= first_samps[0]
+
+            with stage("filter_resample", sample_rate = sample_rate, **sizes):
+                resp_ts, tmp_events = preprocessing.filter_resample_segments(data, sfreq, sample_rate, boundaries, events = tmp_events, l_freq = l_freq, h_freq = h_freq)
+
+        elif resample_method == "mne":
+            # single channel raws per file, concatenated so filtering and resampling treat the file boundaries as before
+            info = mne.create_info([resp_ch_name], sfreq = sfreq, ch_types = "misc")
+            resp_ts = mne.concatenate_raws([
+                mne.io.RawArray(segment[np.newaxis, :], info, first_samp = first_samp, verbose = False)
+                for segment, first_samp in zip(np.split(data, boundaries), first_samps)
+                ])
+            del data
+
+            with stage("filter", **sizes):
+                resp_ts = resp_ts.filter(l_freq, h_freq, picks = resp_ch_name, n_jobs = self.n_jobs)
+            with stage("resample", sample_rate = sample_rate):
+                resp_ts, tmp_events = resp_ts.resample(sample_rate, events = self.events) # resampling the events at the same time!
+
+            first_sample = resp_ts.first_samp
+
+            tmp_events[:, 0] = tmp_events[:, 0]-first_sample
+
+            resp_ts = resp_ts.get_data().squeeze() # squeeze to get rid of the channel dimension
+
+        else:
+            raise ValueError(f"Unknown resampling method: {resample_method}")
+
+        if use_cache:
+            cache.put(key, {"resp": resp_ts, "events": tmp_events}, meta = {"subj_id": self.subj_id, "resp_ch_name": resp_ch_name, "sample_rate": sample_rate, "l_freq": l_freq, "h_freq": h_freq})
+
+        return resp_ts, tmp_events
+
+    @instrumented
+    def extract_resp_angle(self, l_freq = None, h_freq = 10, resp_ch_name = "MISC001", sample_rate = 300, peak_method = "cwt", deferred_figures = False, widths = 100, min_sample = 50, dtype = None, save_phase_ts = True):        
+        """
+        Extracts the respiratory phase angle, saves the peaks and troughs at the native sample rate
+        (landmarks.CycleLandmarks, fnames["phase_landmarks"]) and the phase angle at each event, looked up at the
+        event's own sample, and plots the sanity check and summary figures.
+
+        The event table (fnames["phase_angles_events"] and the event store) has the event samples at the native
+        sample rate in sample_<native rate>, and, for now, also the samples at sample_rate in sample_<sample_rate> as
+        before. The phase angles are those at the native samples, so they can differ slightly from the phase at the
+        resampled sample. Scripts reading sample_<sample_rate> should move to the native column.
+
+        widths, min_sample:
+            peak detection settings, see respiration.extract_phase_angle
+
+        dtype:
+            dtype the respiration is cleaned and normalised in and of the phase angle, e.g. "float32" to halve the
+            memory (see respiration.extract_phase_angle). Float64 if None.
+
+        save_phase_ts:
+            also pickle the full phase angle timeseries at sample_rate to fnames["phase_angles_ts"], as before. The
+            landmarks give the same phase (CycleLandmarks.resampled(sample_rate, ...).to_array()) in kilobytes, so
+            this will default to False in a later release; pass save_phase_ts = False already to skip the pickle.
+
+        deferred_figures:
+            if True, the figures are rendered in a background process and this method returns without waiting for
+            them. The futures are stored in self.figure_futures.
+        """
+        resp_ts, _ = self.load_resp(l_freq = l_freq, h_freq = h_freq, resp_ch_name = resp_ch_name, sample_rate = sample_rate)
+
+        normalised_ts, peaks, troughs, phase_angle = resp.extract_phase_angle(resp_ts, widths = widths, min_sample = min_sample, peak_method = peak_method, dtype = dtype, copy = False)
+
+        # landmarks at the native sample rate, mapped back file by file as load_resp resampled them
+        sfreq, first_samp, starts, lengths = self.raw_segments()
+        landmarks = CycleLandmarks.from_resampled(peaks, troughs, sfreq, sample_rate, starts, lengths, peak_values = normalised_ts[peaks], trough_values = normalised_ts[troughs])
+        landmarks.save(self.fnames["phase_landmarks"])
+
+        if not hasattr(self, "events"):
+            self.load_events()
+        events = self.events.copy()
+        events[:, 0] -= first_samp
+
+        with stage("phase_angle_events"):
+            hz = int(sfreq) if float(sfreq).is_integer() else sfreq
+            df = resp.phase_angle_events(landmarks, events, hz = hz, event_ids = self.event_ids)
+
+            # the samples at sample_rate as load_resp remapped them, the column of previous versions
+            if hz != sample_rate:
+                df.insert(df.columns.get_loc(f"sample_{hz}") + 1, f"sample_{sample_rate}", preprocessing.remap_samples(df[f"sample_{hz}"].to_numpy(), sfreq, sample_rate, starts, lengths))
+
+            df.to_csv(self.fnames["phase_angles_events"], index = False)
+            event_store.write_subject_events(df, self.fnames["phase_event_store"], self.subj_id, sfreq = sfreq)
         
-        resp.sanity_check_phase_angle(resp_timeseries = None, normalised_ts = normalised_ts, peaks = peaks, troughs = troughs, phase_angle = phase_angle, savepath = self.fnames["fig"] / f"{self.subj_id}_respiration.png")
-        resp.summary_plots(peaks, troughs, phase_angle, savepath = self.fnames["fig"] / f"{self.subj_id}_respiration_summary.png" )
+        with stage("figures", deferred = deferred_figures):
+            sanity_kwargs = dict(resp_timeseries = None, normalised_ts = normalised_ts, peaks = peaks, troughs = troughs, phase_angle = phase_angle, savepath = self.fnames["fig"] / f"{self.subj_id}_respiration.png")
+            summary_args = (peaks, troughs, phase_angle, self.fnames["fig"] / f"{self.subj_id}_respiration_summary.png", sample_rate)
+
+            if deferred_figures:
+                self.figure_futures = [
+                    resp.render_deferred(resp.sanity_check_phase_angle, **sanity_kwargs),
+                    resp.render_deferred(resp.summary_plots, *summary_args)
+                    ]
+            else:
+                resp.sanity_check_phase_angle(**sanity_kwargs)
+                resp.summary_plots(*summary_args)
 
 
         # save phase_angle as pickle
-        with open(self.fnames["phase_angles_ts"], 'wb') as fn:
-            pkl.dump(phase_angle, fn, protocol=-1)
+        if save_phase_ts:
+            with open(self.fnames["phase_angles_ts"], 'wb') as fn:
+                pkl.dump(phase_angle, fn, protocol=-1)
 
 
 
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+import mne
+import numpy as np
+from mne.minimum_norm import read_inverse_operator, write_inverse_operator
+
+
+def file_fingerprint(path) -> dict:
+    """
+    Identifies a file by path, size and modification time, without reading it.
+    """
+    stat = Path(path).stat()
+    return {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def array_fingerprint(array) -> str:
+    """
+    Content hash of a (small) array, e.g. events.
+    """
+    array = np.ascontiguousarray(array)
+    return hashlib.sha256(str((array.dtype.str, array.shape)).encode() + array.tobytes()).hexdigest()
+
+
+def make_key(**params) -> str:
+    """
+    Content address for a set of parameters (anything json serialisable, e.g. file fingerprints and filter settings).
+    """
+    serialised = json.dumps(params, sort_keys = True, default = str)
+    return hashlib.sha256(serialised.encode()).hexdigest()
+
+
+class ArrayCache:
+    """
+    On-disk cache of numpy arrays. Each entry is a directory named by its key holding one .npy file per array and a
+    meta.json sidecar. Arrays are read back memory-mapped, and the least recently used entries are evicted once the
+    cache grows beyond `max_bytes`.
+
+    Parameters
+    ----------
+    root : str or pathlike
+        directory holding the cache entries
+    max_bytes : int, default 20 GB
+        size budget of the cache
+    """
+    def __init__(self, root, max_bytes = 20 * 1024**3):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, key):
+        return self.root / key
+
+    def get(self, key):
+        """
+        Returns
+        -------
+        arrays : dict or None
+            memory-mapped (read only) arrays of the entry, None if the key is not cached
+        meta : dict or None
+            metadata stored with the entry
+        """
+        entry = self._entry_path(key)
+        meta_path = entry / "meta.json"
+
+        if not meta_path.exists():
+            return None, None
+
+        with meta_path.open() as f:
+            meta = json.load(f)
+
+        arrays = {name: np.load(entry / f"{name}.npy", mmap_mode = "r") for name in meta["arrays"]}
+
+        # mark as recently used
+        os.utime(meta_path)
+
+        return arrays, meta
+
+    def put(self, key, arrays: dict, meta: dict = None):
+        """
+        Stores arrays under key. The entry is written to a temporary directory and renamed, so concurrent readers
+        (e.g. several subjects run in parallel) never see half-written entries.
+        """
+        meta = dict(meta or {})
+        meta["arrays"] = list(arrays)
+        meta["created"] = time.time()
+
+        self.root.mkdir(parents = True, exist_ok = True)
+        tmp_entry = self.root / f".tmp_{key}_{uuid.uuid4().hex}"
+        tmp_entry.mkdir()
+
+        for name, array in arrays.items():
+            np.save(tmp_entry / f"{name}.npy", np.ascontiguousarray(array))
+
+        with (tmp_entry / "meta.json").open("w") as f:
+            json.dump(meta, f, default = str)
+
+        try:
+            tmp_entry.rename(self._entry_path(key))
+        except OSError: # entry written by another process in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors = True)
+
+        self.evict()
+
+    def size(self, key = None) -> int:
+        """
+        Size in bytes of one entry, or of the whole cache if key is None.
+        """
+        path = self.root if key is None else self._entry_path(key)
+        return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        if not self.root.exists():
+            return
+
+        entries = []
+        for entry in self.root.iterdir():
+            meta_path = entry / "meta.json"
+            if entry.name.startswith(".") or not meta_path.exists():
+                continue
+            entries.append((meta_path.stat().st_mtime, entry, self.size(entry.name)))
+
+        total = sum(size for _, _, size in entries)
+
+        for _, entry, size in sorted(entries, key = lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors = True)
+            total -= size
+
+    def clear(self):
+        if self.root.exists():
+            shutil.rmtree(self.root)
+
+
+class OperatorCache(ArrayCache):
+    """
+    On-disk cache of MNE objects that are expensive to compute and do not change between analyses, i.e. forward
+    solutions, noise covariances, inverse operators and source spaces. Each entry is a directory named by its key
+    holding one fif file and a meta.json sidecar, evicted like ArrayCache entries.
+
+    Keys should be made (make_key) from everything the object depends on, including fingerprints of the input files,
+    so a changed input gives a new key and the old entry is simply no longer used.
+    """
+    _IO = {
+        "fwd": ("-fwd.fif", lambda fname, obj: mne.write_forward_solution(fname, obj, verbose = False), lambda fname: mne.read_forward_solution(fname, verbose = False)),
+        "cov": ("-cov.fif", lambda fname, obj: mne.write_cov(fname, obj, verbose = False), lambda fname: mne.read_cov(fname, verbose = False)),
+        "inv": ("-inv.fif", lambda fname, obj: write_inverse_operator(fname, obj, verbose = False), lambda fname: read_inverse_operator(fname, verbose = False)),
+        "src": ("-src.fif", lambda fname, obj: mne.write_source_spaces(fname, obj, verbose = False), lambda fname: mne.read_source_spaces(fname, verbose = False)),
+    }
+
+    def _fname(self, entry, kind):
+        return entry / f"{kind}{self._IO[kind][0]}"
+
+    def get_or_make(self, kind: str, key: str, make, meta: dict = None):
+        """
+        Reads the object of kind ("fwd", "cov", "inv" or "src") stored under key, or calls make() and stores its
+        result. make is only called on a miss, so it can itself fetch other (lazily made) operators from the cache.
+        """
+        entry = self._entry_path(key)
+        meta_path = entry / "meta.json"
+
+        if meta_path.exists():
+            os.utime(meta_path) # mark as recently used
+            return self._IO[kind][2](self._fname(entry, kind))
+
+        obj = make()
+
+        self.root.mkdir(parents = True, exist_ok = True)
+        tmp_entry = self.root / f".tmp_{key}_{uuid.uuid4().hex}"
+        tmp_entry.mkdir()
+
+        self._IO[kind][1](self._fname(tmp_entry, kind), obj)
+        with (tmp_entry / "meta.json").open("w") as f:
+            json.dump({**(meta or {}), "kind": kind, "created": time.time()}, f, default = str)
+
+        try:
+            tmp_entry.rename(entry)
+        except OSError: # entry written by another process in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors = True)
+
+        self.evict()
+
+        return obj
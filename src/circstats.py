@@ -0,0 +1,251 @@
+"""
+Circular statistics for phase angles in radians. Functions work along an axis of N-D arrays and ignore NaNs.
+
+Based on Zar, Biostatistical Analysis (2010) and Berens, CircStat: A MATLAB Toolbox for Circular Statistics (2009).
+"""
+import numpy as np
+import pandas as pd
+from scipy import special, stats
+
+
+def _sums(angles, axis = None):
+    """
+    Number of non-NaN angles and the sums of their cosines and sines along axis.
+    """
+    angles = np.asarray(angles, dtype = float)
+    valid = ~np.isnan(angles)
+
+    n = np.sum(valid, axis = axis)
+    cos_sum = np.sum(np.cos(angles), axis = axis, where = valid)
+    sin_sum = np.sum(np.sin(angles), axis = axis, where = valid)
+
+    return n, cos_sum, sin_sum
+
+
+def mean_resultant_vector(angles, axis = None) -> np.ndarray:
+    """
+    Average of the unit vectors of the angles in the complex plane.
+    """
+    n, cos_sum, sin_sum = _sums(angles, axis)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        return (cos_sum + 1j * sin_sum) / n
+
+
+def circ_mean(angles, axis = None) -> np.ndarray:
+    """
+    Mean direction in the range [-pi, pi].
+    """
+    n, cos_sum, sin_sum = _sums(angles, axis)
+
+    return np.where(n > 0, np.arctan2(sin_sum, cos_sum), np.nan)
+
+
+def resultant_length(angles, axis = None) -> np.ndarray:
+    """
+    Length of the mean resultant vector (R), between 0 (no consistency) and 1 (all angles equal).
+    """
+    return np.abs(mean_resultant_vector(angles, axis))
+
+
+def circ_var(angles, axis = None) -> np.ndarray:
+    """
+    Circular variance, 1 - R.
+    """
+    return 1 - resultant_length(angles, axis)
+
+
+def _rayleigh(n, R):
+    z = n * R**2
+
+    # p-value approximation from Zar (2010), eq. 27.4
+    with np.errstate(invalid = "ignore"):
+        p = np.exp(np.sqrt(1 + 4 * n + 4 * (n**2 - (R * n)**2)) - (1 + 2 * n))
+
+    return z, np.clip(p, 0, 1)
+
+
+def rayleigh_test(angles, axis = None):
+    """
+    Rayleigh test for non-uniformity (unimodal departure from a uniform distribution).
+
+    Returns
+    -------
+    z : np.ndarray
+        Rayleigh's z, n * R**2
+    p : np.ndarray
+        approximate p-value
+    """
+    n, cos_sum, sin_sum = _sums(angles, axis)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        R = np.hypot(cos_sum, sin_sum) / n
+
+    return _rayleigh(n, R)
+
+
+def v_test(angles, mu, axis = None):
+    """
+    V-test for non-uniformity with a known mean direction mu.
+
+    Returns
+    -------
+    V : np.ndarray
+        the V statistic, n * R * cos(mean - mu)
+    u : np.ndarray
+        V * sqrt(2 / n), approximately standard normal under the null hypothesis
+    p : np.ndarray
+        one-sided p-value
+    """
+    n, cos_sum, sin_sum = _sums(angles, axis)
+
+    V = cos_sum * np.cos(mu) + sin_sum * np.sin(mu)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        u = V * np.sqrt(2 / n)
+
+    return V, u, stats.norm.sf(u)
+
+
+def grouped_circ_stats(angles, labels, mu = None) -> pd.DataFrame:
+    """
+    Circular statistics for every group of angles defined by one or more label arrays, without looping over groups.
+
+    Parameters
+    ----------
+    angles : array-like
+        1D array of angles
+    labels : array-like or dict of array-like
+        group label per angle. A dict (e.g. {"subject": ..., "event": ...}) groups by every combination of labels.
+    mu : float, default None
+        if given, the V-test against this direction is added
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per group with the label columns, n, mean, R, circ_var, rayleigh_z and rayleigh_p
+        (plus V, v_u and v_p if mu is given)
+    """
+    if not isinstance(labels, dict):
+        labels = {"label": labels}
+
+    angles = np.asarray(angles, dtype = float)
+    valid = ~np.isnan(angles)
+
+    # integer code per combination of labels
+    codes, uniques = zip(*(pd.factorize(np.asarray(label), use_na_sentinel = False) for label in labels.values()))
+    combined = np.ravel_multi_index(codes, [len(unique) for unique in uniques])
+    group_ids, group_index = np.unique(combined, return_inverse = True)
+
+    n_groups = len(group_ids)
+    group_index, angles = group_index[valid], angles[valid]
+
+    n = np.bincount(group_index, minlength = n_groups)
+    cos_sum = np.bincount(group_index, weights = np.cos(angles), minlength = n_groups)
+    sin_sum = np.bincount(group_index, weights = np.sin(angles), minlength = n_groups)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        R = np.hypot(cos_sum, sin_sum) / n
+
+    z, p = _rayleigh(n, R)
+
+    df = pd.DataFrame({
+        name: unique[code] for name, unique, code in zip(labels, uniques, np.unravel_index(group_ids, [len(unique) for unique in uniques]))
+        })
+    df["n"] = n
+    df["mean"] = np.where(n > 0, np.arctan2(sin_sum, cos_sum), np.nan)
+    df["R"] = R
+    df["circ_var"] = 1 - R
+    df["rayleigh_z"] = z
+    df["rayleigh_p"] = p
+
+    if mu is not None:
+        V = cos_sum * np.cos(mu) + sin_sum * np.sin(mu)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            u = V * np.sqrt(2 / n)
+        df["V"] = V
+        df["v_u"] = u
+        df["v_p"] = stats.norm.sf(u)
+
+    return df
+
+
+def kappa_estimate(R):
+    """
+    Approximate maximum likelihood estimate of the von Mises concentration from the resultant length
+    (Best & Fisher, 1981).
+    """
+    R = np.asarray(R, dtype = float)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        kappa = np.where(
+            R < 0.53, 2 * R + R**3 + 5 * R**5 / 6,
+            np.where(R < 0.85, -0.4 + 1.39 * R + 0.43 / (1 - R), 1 / (R**3 - 4 * R**2 + 3 * R))
+            )
+
+    return kappa[()]
+
+
+def taylor_bandwidth(angles) -> float:
+    """
+    Concentration of the von Mises kernel for circular_kde, following the plug-in rule by Taylor (2008),
+    Automatic bandwidth selection for circular density estimation, Computational Statistics & Data Analysis 52.
+    """
+    angles = np.asarray(angles, dtype = float)
+    angles = angles[~np.isnan(angles)]
+    n = len(angles)
+
+    kappa = kappa_estimate(resultant_length(angles))
+
+    # I2(2 kappa) / I0(kappa)**2 with exponentially scaled bessel functions to avoid overflow
+    bessel_ratio = special.ive(2, 2 * kappa) / special.i0e(kappa)**2
+
+    return float((3 * n * kappa**2 * bessel_ratio / (4 * np.sqrt(np.pi))) ** (2 / 5))
+
+
+def circular_kde(angles, kappa = "taylor", n_grid = 512):
+    """
+    Circular kernel density estimate with a von Mises kernel.
+
+    The angles are linearly binned onto a regular grid over the circle, and the binned counts are convolved with the
+    kernel using the FFT (circular convolution, so no wrap-around copies of the data are needed). Cost is
+    O(n + n_grid log n_grid).
+
+    Parameters
+    ----------
+    angles : array-like
+        angles in radians, NaNs are ignored
+    kappa : float or "taylor", default "taylor"
+        concentration of the von Mises kernel (larger is narrower). "taylor" selects it with taylor_bandwidth.
+    n_grid : int, default 512
+        number of grid points
+
+    Returns
+    -------
+    grid : np.ndarray
+        n_grid angles from -pi (inclusive) to pi (exclusive)
+    density : np.ndarray
+        density at the grid points, integrating to 1 over the circle
+    """
+    angles = np.asarray(angles, dtype = float)
+    angles = angles[~np.isnan(angles)]
+
+    if kappa == "taylor":
+        kappa = taylor_bandwidth(angles)
+
+    step = 2 * np.pi / n_grid
+    grid = -np.pi + step * np.arange(n_grid)
+
+    # linear binning: every angle is split between its two neighbouring grid points
+    position = np.mod(angles + np.pi, 2 * np.pi) / step
+    lower = np.floor(position).astype(int)
+    upper_weight = position - lower
+    counts = np.bincount(lower % n_grid, weights = 1 - upper_weight, minlength = n_grid)
+    counts += np.bincount((lower + 1) % n_grid, weights = upper_weight, minlength = n_grid)
+
+    # von Mises kernel centred at grid index 0, exp(kappa * cos(x)) / (2 pi I0(kappa)) computed without overflow
+    kernel = np.exp(kappa * (np.cos(step * np.arange(n_grid)) - 1)) / (2 * np.pi * special.i0e(kappa))
+
+    density = np.fft.irfft(np.fft.rfft(counts) * np.fft.rfft(kernel), n = n_grid) / max(len(angles), 1)
+
+    return grid, np.clip(density, 0, None)
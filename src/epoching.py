@@ -0,0 +1,257 @@
+"""
+Memory-bounded epoching. Epochs are cut from a (not preloaded) raw object a chunk of events at a time, rejected and
+baseline corrected with mne.Epochs as usual, and the accepted epochs are appended to an on-disk array that is read
+back memory-mapped. Only one chunk of epochs is ever held in memory.
+"""
+import json
+import shutil
+import uuid
+import warnings
+from pathlib import Path
+import mne
+import numpy as np
+
+
+def write_epochs(raw, events: np.ndarray, event_id: dict, path, tmin = -0.2, tmax = 1, picks = None, baseline = (None, 0), reject = None, chunk_size = 200, dtype = np.float32, l_freq = None, h_freq = None, pad = 1.):
+    """
+    Epochs raw around events and writes the accepted epochs to path (a directory), chunk by chunk.
+
+    The arguments are passed on to mne.Epochs, which is created for chunk_size events at a time. As rejection and
+    baseline correction are done per epoch, the accepted epochs are the same as with a single preloaded mne.Epochs.
+
+    l_freq, h_freq:
+        band-pass filter the epochs (mne.Epochs.filter), instead of filtering the whole preloaded raw first. Each
+        epoch is read with pad seconds of data on both sides, filtered, and cropped to tmin, tmax before baseline
+        correction and rejection, so the edge effects of the filter fall in the padding as long as it is longer
+        than the filter. Epochs whose padding does not fit in their file segment get less (see _epoch_chunk).
+
+    Files written to path:
+        data.dat (raw array of shape (n_epochs, n_channels, n_times) in dtype, C order), events.npy (accepted events),
+        info.fif (measurement info of the picked channels) and meta.json (shape, dtype, tmin, event_id and the number
+        of epochs dropped per reason).
+
+    Returns
+    -------
+    EpochStore
+    """
+    path = Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    tmp_path = path.parent / f".tmp_{path.name}_{uuid.uuid4().hex}"
+    tmp_path.mkdir()
+
+    events = np.asarray(events)
+    events = events[np.isin(events[:, 2], list(event_id.values()))]
+
+    accepted_events, drop_reasons = [], {}
+    info = None
+
+    with (tmp_path / "data.dat").open("wb") as f:
+        for start in range(0, len(events), chunk_size):
+            pieces = _epoch_chunk(raw, events[start:start + chunk_size], event_id, tmin, tmax, picks, baseline, reject, l_freq, h_freq, pad)
+
+            for epochs, log in pieces:
+                for reasons in log:
+                    for reason in reasons:
+                        drop_reasons[reason] = drop_reasons.get(reason, 0) + 1
+
+            # the pieces back in event order
+            chunk_events = np.concatenate([epochs.events for epochs, _ in pieces])
+            order = np.argsort(chunk_events[:, 0], kind = "stable")
+            data = np.concatenate([epochs.get_data(copy = False) for epochs, _ in pieces])[order]
+            f.write(np.ascontiguousarray(data, dtype = dtype).tobytes())
+
+            accepted_events.append(chunk_events[order])
+            info = pieces[0][0].info
+            times = pieces[0][0].times
+            del pieces, data
+
+    if info is None:
+        shutil.rmtree(tmp_path)
+        raise ValueError("No events of event_id to epoch")
+
+    return _finalise(tmp_path, path, np.concatenate(accepted_events), info, times, event_id, dtype, n_events = len(events), drop_reasons = drop_reasons)
+
+
+def _epoch_chunk(raw, events, event_id, tmin, tmax, picks, baseline, reject, l_freq, h_freq, pad) -> list:
+    """
+    Preloaded mne.Epochs of a chunk of events, band-pass filtered with pad seconds of data on both sides if l_freq or
+    h_freq is given (see write_epochs).
+
+    Epochs whose padded window is dropped (it reaches past the data or into a boundary or BAD annotation) are retried
+    with half the padding, down to none, so the same epochs are kept as without padding. raw.filter does not filter
+    across file segments either.
+
+    Returns
+    -------
+    list of (mne.Epochs, drop log)
+        the epochs of each padding, and the drop log entries to count for them
+    """
+    # not every event type is in every chunk, and a chunk may well have all its epochs rejected
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message = "All epochs were dropped")
+
+        if l_freq is None and h_freq is None:
+            epochs = mne.Epochs(raw, events, event_id, tmin, tmax, picks = picks, baseline = baseline, reject = reject, preload = True, on_missing = "ignore", verbose = False)
+            return [(epochs, epochs.drop_log)]
+
+        epochs = mne.Epochs(raw, events, event_id, tmin - pad, tmax + pad, picks = picks, baseline = None, preload = True, on_missing = "ignore", verbose = False)
+        retry = np.array([len(log) > 0 for log in epochs.drop_log]) if pad > 0 else np.zeros(len(events), dtype = bool)
+
+        if len(epochs):
+            epochs.filter(l_freq, h_freq, verbose = False).crop(tmin, tmax).apply_baseline(baseline, verbose = False).drop_bad(reject = reject, verbose = False)
+
+    # with all epochs retried there is nothing to keep (and the empty epochs would still have the padded times)
+    pieces = [] if retry.all() else [(epochs, [log for log, retried in zip(epochs.drop_log, retry) if not retried])]
+
+    if retry.any():
+        pieces += _epoch_chunk(raw, events[retry], event_id, tmin, tmax, picks, baseline, reject, l_freq, h_freq, pad / 2 if pad > 0.1 else 0)
+
+    return pieces
+
+
+def epochs_to_store(epochs, path, dtype = np.float32):
+    """
+    Writes in-memory (preloaded) mne.Epochs in the format of write_epochs, e.g. to pass them to worker processes.
+
+    Returns
+    -------
+    EpochStore
+    """
+    path = Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    tmp_path = path.parent / f".tmp_{path.name}_{uuid.uuid4().hex}"
+    tmp_path.mkdir()
+
+    with (tmp_path / "data.dat").open("wb") as f:
+        for start in range(0, len(epochs), 200):
+            f.write(np.ascontiguousarray(epochs.get_data(item = np.arange(start, min(start + 200, len(epochs)))), dtype = dtype).tobytes())
+
+    return _finalise(tmp_path, path, epochs.events, epochs.info, epochs.times, epochs.event_id, dtype, n_events = len(epochs.drop_log))
+
+
+def _finalise(tmp_path, path, events, info, times, event_id, dtype, n_events, drop_reasons = None):
+    # events, info and meta.json next to data.dat, then the directory is moved into place
+    np.save(tmp_path / "events.npy", events)
+    mne.io.write_info(tmp_path / "info.fif", info)
+
+    meta = {
+        "shape": [len(events), len(info["ch_names"]), len(times)],
+        "dtype": np.dtype(dtype).str,
+        "tmin": float(times[0]),
+        "sfreq": info["sfreq"],
+        "event_id": {name: int(trigger) for name, trigger in event_id.items()},
+        "n_events": n_events,
+        "drop_reasons": drop_reasons or {}
+        }
+
+    with (tmp_path / "meta.json").open("w") as f:
+        json.dump(meta, f)
+
+    if path.exists():
+        shutil.rmtree(path)
+    tmp_path.rename(path)
+
+    return EpochStore(path)
+
+
+class EpochStore:
+    """
+    Epochs written by write_epochs, read back memory-mapped.
+
+    Parameters
+    ----------
+    path : str or pathlike
+        directory written by write_epochs
+
+    Attributes
+    ----------
+    data : np.memmap
+        read-only array of shape (n_epochs, n_channels, n_times)
+    events : np.ndarray
+        events of the epochs
+    event_id : dict
+    times : np.ndarray
+    info : mne.Info
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+
+        with (self.path / "meta.json").open() as f:
+            self.meta = json.load(f)
+
+        shape, dtype = tuple(self.meta["shape"]), np.dtype(self.meta["dtype"])
+        if shape[0] > 0:
+            self.data = np.memmap(self.path / "data.dat", dtype = dtype, mode = "r", shape = shape)
+        else: # an empty file cannot be memory-mapped
+            self.data = np.empty(shape, dtype = dtype)
+        self.events = np.load(self.path / "events.npy")
+        self.event_id = self.meta["event_id"]
+        self.info = mne.io.read_info(self.path / "info.fif", verbose = False)
+        self.times = self.meta["tmin"] + np.arange(self.meta["shape"][2]) / self.meta["sfreq"]
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def ch_names(self) -> list:
+        return self.info["ch_names"]
+
+    @property
+    def conditions(self) -> dict:
+        """
+        Number of accepted epochs per event name.
+        """
+        return {name: int(np.sum(self.events[:, 2] == trigger)) for name, trigger in self.event_id.items()}
+
+    def select(self, conditions = None, contains = None) -> np.ndarray:
+        """
+        Indices of the epochs of some conditions.
+
+        Parameters
+        ----------
+        conditions : str or list of str, default None
+            event names, e.g. ["w0_hit", "w15_hit"]. All if None.
+        contains : str, default None
+            only events whose name contains this string, e.g. "hit"
+        """
+        names = list(self.event_id) if conditions is None else [conditions] if isinstance(conditions, str) else list(conditions)
+
+        if contains is not None:
+            names = [name for name in names if contains in name]
+
+        return np.flatnonzero(np.isin(self.events[:, 2], [self.event_id[name] for name in names]))
+
+    def iter_epochs(self, conditions = None, contains = None, batch_size = 64):
+        """
+        Iterates over the epochs of some conditions (see select) in batches, so they can be consumed without loading
+        all epochs into memory.
+
+        Yields
+        ------
+        data : np.ndarray
+            (batch_size, n_channels, n_times) epochs, in memory
+        events : np.ndarray
+            events of the batch
+        """
+        indices = self.select(conditions, contains)
+
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            yield np.asarray(self.data[batch]), self.events[batch]
+
+    def iter_conditions(self, batch_size = 64):
+        """
+        Iterates over the conditions with at least one epoch, yielding the name and a batch iterator (see iter_epochs).
+        """
+        for name, count in self.conditions.items():
+            if count > 0:
+                yield name, self.iter_epochs(name, batch_size = batch_size)
+
+    def to_epochs(self, conditions = None, contains = None) -> mne.EpochsArray:
+        """
+        The selected epochs as an in-memory mne.EpochsArray, e.g. for a single condition.
+        """
+        indices = self.select(conditions, contains)
+        event_id = {name: trigger for name, trigger in self.event_id.items() if trigger in self.events[indices, 2]}
+
+        return mne.EpochsArray(np.asarray(self.data[indices], dtype = float), self.info, events = self.events[indices], tmin = self.meta["tmin"], event_id = event_id, baseline = None, verbose = False)
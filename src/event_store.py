@@ -0,0 +1,109 @@
+"""
+Group level store of phase angle events: one parquet file per subject in a hive partitioned directory
+(<root>/subject=<subj_id>/events.parquet), queried with pyarrow so only the needed columns and rows are read.
+"""
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+
+COLUMNS = ["subject", "trigger", "event", "sample", "phase_angle"]
+PARTITIONING = ds.partitioning(pa.schema([("subject", pa.string())]), flavor = "hive")
+
+
+def write_subject_events(df: pd.DataFrame, root, subject: str, sfreq: float = None):
+    """
+    Writes (or replaces) the phase angle events of one subject.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        output of respiration.phase_angle_events (phase_angle, trigger, sample_<hz> and event)
+    root : str or pathlike
+        directory of the store
+    subject : str
+        subject id, used as partition
+    sfreq : float, default None
+        sample rate of the samples, stored as a column if given
+    """
+    sample_col = [col for col in df.columns if col.startswith("sample")][0]
+
+    table = pd.DataFrame({
+        "trigger": df["trigger"].to_numpy(),
+        "event": df["event"].astype("category") if "event" in df else pd.Categorical(["Unknown"] * len(df)),
+        "sample": df[sample_col].to_numpy(),
+        "phase_angle": df["phase_angle"].to_numpy(dtype = float)
+        })
+
+    if sfreq is not None:
+        table["sfreq"] = float(sfreq)
+
+    partition = Path(root) / f"subject={subject}"
+    partition.mkdir(parents = True, exist_ok = True)
+
+    # write to a temporary file first, so concurrent readers never see a half-written partition
+    tmp_path = partition / ".events.parquet.tmp"
+    table.to_parquet(tmp_path, index = False)
+    tmp_path.replace(partition / "events.parquet")
+
+
+def load_events(root, subjects = None, events = None, contains = None, phase_range = None, columns = None) -> pd.DataFrame:
+    """
+    Loads phase angle events for many subjects at once.
+
+    Parameters
+    ----------
+    root : str or pathlike
+        directory of the store
+    subjects : list of str, default None
+        subjects to load, all if None
+    events : list of str, default None
+        event names to load, e.g. ["w0_hit", "w15_hit"]
+    contains : str, default None
+        only load events whose name contains this string, e.g. "hit"
+    phase_range : tuple of float, default None
+        (low, high) only load events with low <= phase_angle < high. If low > high the range wraps around pi, e.g.
+        (3, -3) selects phases close to +-pi.
+    columns : list of str, default None
+        columns to read, all if None
+
+    Returns
+    -------
+    pd.DataFrame
+        with event as categorical
+    """
+    dataset = ds.dataset(root, format = "parquet", partitioning = PARTITIONING)
+
+    conditions = []
+    if subjects is not None:
+        conditions.append(ds.field("subject").isin([str(subject) for subject in subjects]))
+    if events is not None:
+        conditions.append(ds.field("event").cast(pa.string()).isin(list(events)))
+    if contains is not None:
+        conditions.append(pc.match_substring(ds.field("event").cast(pa.string()), contains))
+    if phase_range is not None:
+        low, high = phase_range
+        above, below = ds.field("phase_angle") >= low, ds.field("phase_angle") < high
+        conditions.append((above & below) if low <= high else (above | below))
+
+    condition = None
+    for tmp_condition in conditions:
+        condition = tmp_condition if condition is None else condition & tmp_condition
+
+    if columns is None:
+        columns = [col for col in dataset.schema.names if col in COLUMNS or col == "sfreq"]
+
+    table = dataset.to_table(columns = columns, filter = condition)
+    df = table.to_pandas()
+
+    if "subject" in df:
+        df["subject"] = df["subject"].astype("category")
+
+    return df
+
+
+def subjects_in_store(root) -> list:
+    return sorted(path.name.split("=", 1)[1] for path in Path(root).glob("subject=*") if (path / "events.parquet").exists())
+
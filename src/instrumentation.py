@@ -0,0 +1,170 @@
+"""
+Lightweight stage timing for the pipeline. Every stage records wall time, CPU time, resident memory and optional
+array sizes, and is written as one json line to the file set with `configure` (nothing is written otherwise). The
+overhead is a few system calls per stage, so it can stay on for cohort runs.
+
+The peak resident memory of a stage is measured by resetting the high-water mark of the process (VmHWM, through
+/proc/self/clear_refs) when the stage starts and reading it when it ends, so it is the peak within the stage rather
+than the peak of the process so far. Nested stages pass their peak on to the stage around them.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import resource
+import time
+import numpy as np
+import pandas as pd
+
+
+_log_path = None
+_context = contextvars.ContextVar("instrumentation_context", default = {})
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_open_peaks = [] # peak resident memory so far of each open stage, innermost last
+
+
+def configure(log_path = None):
+    """
+    Sets the json lines file stages are appended to (None disables logging). Appending whole lines is safe across the
+    worker processes of a cohort run.
+    """
+    global _log_path
+    _log_path = log_path
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 1024**2
+    except OSError:
+        return float("nan")
+
+
+def _max_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _hwm_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def _reset_hwm():
+    # sets the high-water mark of the process back to its current resident memory (linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _start_peak() -> float:
+    # the peak so far belongs to the enclosing stage, the high-water mark is then reset for the new one
+    if _open_peaks:
+        _open_peaks[-1] = max(_open_peaks[-1], _hwm_mb())
+    _reset_hwm()
+    _open_peaks.append(_hwm_mb())
+    return _rss_mb()
+
+
+def _end_peak() -> float:
+    peak = max(_open_peaks.pop(), _hwm_mb())
+    if _open_peaks:
+        _open_peaks[-1] = max(_open_peaks[-1], peak)
+    return peak
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Times a block of code as a pipeline stage.
+
+    Fields (e.g. subject) are added to the record and inherited by stages nested inside this one. The yielded dict
+    can be used to add more fields, e.g. array sizes, while the stage runs.
+
+    Example
+    -------
+    with stage("find_peaks", n_samples = len(ts)) as record:
+        peaks = ...
+        record["n_peaks"] = len(peaks)
+    """
+    context = {**_context.get(), **fields}
+    parent = context.get("stage")
+    context["stage"] = name if parent is None else f"{parent}/{name}"
+    token = _context.set(context)
+
+    record = dict(context)
+    logging = _log_path is not None
+    start_rss = _start_peak() if logging else None
+    wall, cpu = time.perf_counter(), time.process_time()
+
+    try:
+        yield record
+    finally:
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+        _context.reset(token)
+
+        if logging:
+            record["peak_rss_mb"] = _end_peak()
+            record["rss_mb"] = _rss_mb()
+            record["rss_delta_mb"] = record["rss_mb"] - start_rss
+            record["process_max_rss_mb"] = _max_rss_mb()
+            record["pid"] = os.getpid()
+            record["time"] = time.time()
+
+            with open(_log_path, "a") as f:
+                f.write(json.dumps(record, default = str) + "\n")
+
+
+def array_sizes(**arrays):
+    """
+    Number of elements and megabytes of arrays, to be added to a stage record.
+    """
+    sizes = {}
+    for name, array in arrays.items():
+        if isinstance(array, np.ndarray):
+            sizes[f"{name}_size"] = array.size
+            sizes[f"{name}_mb"] = array.nbytes / 1024**2
+    return sizes
+
+
+def instrumented(method):
+    """
+    Decorator timing a MEG_participant method as a stage, tagged with the subject id.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with stage(method.__name__, subject = getattr(self, "subj_id", None)):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def profile_table(log_path) -> pd.DataFrame:
+    """
+    Summarises a json lines log per stage over subjects: number of calls, total and mean wall time, total CPU time, the
+    maximum peak resident memory within the stage and the largest growth of resident memory over the stage (memory
+    the stage kept), sorted by total wall time.
+    """
+    df = pd.read_json(log_path, lines = True)
+
+    table = df.groupby("stage").agg(
+        calls = ("wall_s", "size"),
+        subjects = ("subject", "nunique"),
+        wall_total_s = ("wall_s", "sum"),
+        wall_mean_s = ("wall_s", "mean"),
+        cpu_total_s = ("cpu_s", "sum"),
+        peak_rss_mb = ("peak_rss_mb", "max"),
+        rss_delta_mb = ("rss_delta_mb", "max")
+        )
+
+    return table.sort_values("wall_total_s", ascending = False)
@@ -0,0 +1,191 @@
+"""
+Compact representation of the respiratory phase by its cycle landmarks. The phase is fully determined by the peaks
+(phase 0) and troughs (phase pi), increasing linearly in between (see respiration.landmarks_to_phase), so rather
+than a phase sample per sample of the recording only the landmarks are stored (kilobytes per recording), and the
+phase is evaluated where it is needed, at any (fractional) sample or time.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import preprocessing
+import respiration
+
+
+class CycleLandmarks:
+    """
+    Peaks and troughs of the respiration, in (possibly fractional) samples at sfreq from the start of the recording.
+
+    Parameters
+    ----------
+    peaks : np.ndarray
+        increasing sample positions of the peaks
+    troughs : np.ndarray
+        sample positions of the troughs, troughs[i] lying between peaks[i] and peaks[i + 1]
+    sfreq : float
+        sample rate the positions are in
+    n_samples : int
+        length of the recording in samples at sfreq
+    peak_values, trough_values : np.ndarray, default None
+        respiration at the peaks and troughs (e.g. the normalised respiration), for the cycle amplitudes
+    """
+    def __init__(self, peaks, troughs, sfreq: float, n_samples: int, peak_values = None, trough_values = None):
+        self.peaks = np.asarray(peaks, dtype = float)
+        self.troughs = np.asarray(troughs, dtype = float)
+        self.sfreq = float(sfreq)
+        self.n_samples = int(n_samples)
+        self.peak_values = None if peak_values is None else np.asarray(peak_values, dtype = float)
+        self.trough_values = None if trough_values is None else np.asarray(trough_values, dtype = float)
+
+        # peak, trough, peak, ... of the complete cycles, the phase ramps from each to the next
+        n_cycles = self.n_cycles
+        self._positions = np.empty(2 * n_cycles + 1 if len(self.peaks) else 0)
+        self._positions[0::2] = self.peaks[:n_cycles + 1]
+        self._positions[1::2] = self.troughs[:n_cycles]
+
+    def __repr__(self):
+        return f"<CycleLandmarks | {self.n_cycles} cycles, {self.n_samples / self.sfreq:.1f} s at {self.sfreq:g} Hz>"
+
+    @property
+    def n_cycles(self) -> int:
+        return min(len(self.troughs), max(len(self.peaks) - 1, 0))
+
+    def phase_at(self, samples) -> np.ndarray:
+        """
+        Phase angle at sample positions (fractional positions are interpolated), NaN before the first and after the
+        last peak.
+
+        The ramps are continuous in the position: phase_at(peak) is 0 and phase_at(trough) is -pi (= pi). The array of
+        respiration.landmarks_to_phase is this phase one sample later, phase_at(s + 1) at sample s, as its ramps end
+        on the sample before the next landmark.
+        """
+        samples = np.asarray(samples, dtype = float)
+        positions = self._positions
+
+        if len(positions) < 2:
+            return np.where(np.isin(samples, positions), 0., np.nan)
+
+        segment = np.searchsorted(positions, samples, side = "right") - 1
+        inside = (segment >= 0) & (segment < len(positions) - 1)
+        segment = np.clip(segment, 0, len(positions) - 2)
+
+        start, stop = positions[segment], positions[segment + 1]
+        fraction = (samples - start) / (stop - start)
+
+        # from a peak the phase ramps from 0 to pi, from a trough from -pi to 0
+        phase = np.pi * fraction - np.pi * (segment % 2)
+        phase = np.where(inside, phase, np.nan)
+
+        return np.where(samples == positions[-1], 0., phase)
+
+    def phase_at_times(self, times) -> np.ndarray:
+        """
+        Phase angle at times in seconds from the start of the recording.
+        """
+        return self.phase_at(np.asarray(times, dtype = float) * self.sfreq)
+
+    def to_array(self, n_samples: int = None, dtype = np.float64) -> np.ndarray:
+        """
+        The phase angle of every sample, as respiration.landmarks_to_phase does it (landmarks rounded to samples).
+        """
+        n_samples = self.n_samples if n_samples is None else n_samples
+        return respiration.landmarks_to_phase(n_samples, np.round(self.peaks).astype(int), np.round(self.troughs).astype(int), dtype = dtype)
+
+    def cycle_statistics(self, window: int = 10) -> pd.DataFrame:
+        """
+        Durations, amplitudes (if the values are known), I:E ratio and rolling variability of each cycle, see
+        respiration.cycle_statistics.
+        """
+        return respiration.cycle_statistics(self.peaks, self.troughs, self.sfreq, self.peak_values, self.trough_values, window = window)
+
+    @classmethod
+    def from_resampled(cls, peaks, troughs, sfreq: float, new_sfreq: float, segment_starts = None, segment_lengths = None, n_samples: int = None, **kwargs):
+        """
+        Landmarks found on the respiration resampled to new_sfreq (as by MEG_participant.load_resp, segment by
+        segment), as positions at the original sfreq, e.g. to look up the phase of events at the native resolution.
+
+        segment_starts, segment_lengths:
+            segments (split files) in samples at sfreq, see preprocessing.remap_samples
+        n_samples:
+            length of the recording at sfreq, by default the sum of segment_lengths
+        **kwargs:
+            peak_values and trough_values
+        """
+        if n_samples is None:
+            n_samples = int(np.sum(segment_lengths))
+
+        positions = [
+            preprocessing.unmap_samples(landmarks, sfreq, new_sfreq, segment_starts, segment_lengths)
+            for landmarks in (peaks, troughs)
+            ]
+
+        return cls(*positions, sfreq = sfreq, n_samples = n_samples, **kwargs)
+
+    def resampled(self, new_sfreq: float, segment_starts = None, segment_lengths = None):
+        """
+        The landmarks at new_sfreq, the inverse of from_resampled.
+        """
+        positions = [
+            preprocessing.remap_samples(landmarks, self.sfreq, new_sfreq, segment_starts, segment_lengths, exact = True)
+            for landmarks in (self.peaks, self.troughs)
+            ]
+
+        if segment_lengths is None:
+            segment_lengths = [self.n_samples]
+        up, down = preprocessing.resample_ratio(self.sfreq, new_sfreq)
+        n_samples = int(np.sum(-(-np.asarray(segment_lengths, dtype = np.int64) * up // down)))
+
+        return CycleLandmarks(*positions, sfreq = new_sfreq, n_samples = n_samples, peak_values = self.peak_values, trough_values = self.trough_values)
+
+    def save(self, path):
+        """
+        Saves the landmarks as a compressed .npz (integer positions are stored as integers, values as float32).
+        """
+        def compact(positions):
+            return positions.astype(np.int64) if np.array_equal(positions, np.round(positions)) else positions
+
+        values = {name: getattr(self, name).astype(np.float32) for name in ("peak_values", "trough_values") if getattr(self, name) is not None}
+
+        np.savez_compressed(path, peaks = compact(self.peaks), troughs = compact(self.troughs), sfreq = self.sfreq, n_samples = self.n_samples, **values)
+
+    @classmethod
+    def load(cls, path) -> "CycleLandmarks":
+        with np.load(path) as f:
+            values = {name: f[name] for name in ("peak_values", "trough_values") if name in f}
+            return cls(f["peaks"], f["troughs"], sfreq = float(f["sfreq"]), n_samples = int(f["n_samples"]), **values)
+
+
+def load_cohort(paths: dict) -> dict:
+    """
+    Landmarks of many subjects, subject to the path of their .npz (as saved by MEG_participant.extract_resp_angle).
+    Subjects without a file are left out.
+    """
+    return {subject: CycleLandmarks.load(path) for subject, path in paths.items() if Path(path).exists()}
+
+
+def cohort_cycle_statistics(cohort: dict, window: int = 10) -> pd.DataFrame:
+    """
+    The cycle statistics (CycleLandmarks.cycle_statistics) of many subjects in one table with a subject column, e.g.
+    of load_cohort.
+    """
+    tables = [landmarks.cycle_statistics(window = window).assign(subject = subject) for subject, landmarks in cohort.items()]
+    if not tables:
+        return pd.DataFrame()
+
+    table = pd.concat(tables, ignore_index = True)
+    return table[["subject"] + [column for column in table.columns if column != "subject"]]
+
+
+def summarise_cycle_statistics(table: pd.DataFrame, by = "subject") -> pd.DataFrame:
+    """
+    Per subject (or other grouping) summary of a cycle statistics table, for quality control of the breathing across
+    the cohort: number of complete cycles, median durations, I:E ratio, rate and amplitude, the coefficient of
+    variation of the cycle duration and the median rolling coefficient of variation.
+    """
+    complete = table.dropna(subset = ["peak_to_peak"])
+    grouped = complete.groupby(by)
+
+    summary = grouped[["peak_to_trough", "trough_to_peak", "peak_to_peak", "ie_ratio", "rate", "amplitude", "rolling_cv"]].median()
+    summary.insert(0, "n_cycles", grouped.size())
+    summary["cv"] = grouped["peak_to_peak"].std() / grouped["peak_to_peak"].mean()
+
+    return summary.reset_index()
@@ -0,0 +1,118 @@
+import json
+import os
+from fnmatch import fnmatch
+from pathlib import Path
+
+
+RAW_PATTERNS = ["*raw_[0-9].fif", "*raw.fif"]
+
+
+def _scan(meg_dir):
+    """
+    One recursive traversal of a subject's MEG directory.
+
+    Returns
+    -------
+    files : list of dict
+        raw files matching RAW_PATTERNS with path, size and mtime_ns, in the order used by populate_fnames
+    dirs : dict
+        mtime_ns of every directory visited, used to detect added or removed files later
+    """
+    files, dirs = [], {}
+    stack = [meg_dir]
+
+    while stack:
+        directory = stack.pop()
+        dirs[directory] = os.stat(directory).st_mtime_ns
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif any(fnmatch(entry.name, pattern) for pattern in RAW_PATTERNS):
+                    stat = entry.stat()
+                    files.append({"path": entry.path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns})
+
+    return sorted(files, key = lambda file: Path(file["path"])), dirs
+
+
+class RawManifest:
+    """
+    Project level manifest of the raw MEG files of every subject, stored as json.
+
+    Each subject's MEG directory (raw/<subj_id>/<meg_date>/MEG) is traversed once. On refresh, only the recorded
+    directories are stat'ed, and a subject is traversed again only if one of its directories changed (files added,
+    removed or renamed) or it is not in the manifest yet.
+
+    Parameters
+    ----------
+    path : str or pathlike
+        json file of the manifest
+    raw_root : str or pathlike
+        the project's raw directory
+    """
+    def __init__(self, path, raw_root):
+        self.path = Path(path)
+        self.raw_root = Path(raw_root)
+        self.subjects = {}
+
+        if self.path.exists():
+            with self.path.open() as f:
+                self.subjects = json.load(f)["subjects"]
+
+    @staticmethod
+    def _key(subj_id, meg_date):
+        return f"{subj_id}/{meg_date}"
+
+    def _is_stale(self, entry):
+        for directory, mtime_ns in entry["dirs"].items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime_ns:
+                    return True
+            except FileNotFoundError: # stale if it was there before
+                if mtime_ns is not None:
+                    return True
+        return False
+
+    def refresh(self, recordings):
+        """
+        Makes sure every entry of recordings (dicts with "subject" and "date" as in config.recordings) is up to date,
+        and saves the manifest if anything changed.
+        """
+        changed = False
+
+        for sub in recordings:
+            key = self._key(sub["subject"], sub["date"])
+
+            if key in self.subjects and not self._is_stale(self.subjects[key]):
+                continue
+
+            meg_dir = self.raw_root / sub["subject"] / sub["date"] / "MEG"
+            files, dirs = _scan(str(meg_dir)) if meg_dir.exists() else ([], {str(meg_dir): None}) # rescanned once it exists
+            self.subjects[key] = {"files": files, "dirs": dirs}
+            changed = True
+
+        if changed:
+            self.save()
+
+        return self
+
+    def save(self):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = self.path.with_suffix(".tmp")
+
+        with tmp_path.open("w") as f:
+            json.dump({"raw_root": str(self.raw_root), "subjects": self.subjects}, f, indent = 1)
+
+        tmp_path.replace(self.path)
+
+    def raw_files(self, subj_id, meg_date) -> list:
+        """
+        Raw files of a subject, in split order, without touching the filesystem.
+        """
+        key = self._key(subj_id, meg_date)
+
+        if key not in self.subjects:
+            raise KeyError(f"{key} is not in the raw manifest {self.path}, refresh it with the subject's recording")
+
+        return [Path(file["path"]) for file in self.subjects[key]["files"]]
@@ -0,0 +1,247 @@
+"""
+Causal respiratory phase estimation, e.g. to time stimuli to the respiratory phase during a recording.
+
+The offline phase (respiration.extract_phase_angle) ramps linearly between peaks and troughs and so needs the next
+landmark. Online, the respiration is band-pass filtered causally, a peak (trough) is detected once the signal has
+fallen (risen) by a hysteresis threshold from its running maximum (minimum), and the current phase is predicted from
+the last landmark and the recent durations of the same half cycle: it ramps from 0 at a peak to pi at the expected
+trough and from -pi at a trough to 0 at the expected peak, as the offline phase does.
+"""
+import time
+import numpy as np
+from scipy import signal
+import circstats
+import respiration
+
+
+class OnlinePhaseEstimator:
+    """
+    Causal phase estimator fed with consecutive samples or blocks of the respiration (e.g. as read from the ring
+    buffer of the acquisition).
+
+    Parameters
+    ----------
+    sfreq : float
+        sample rate of the respiration
+    l_freq, h_freq : float, default 0.05 and 1.
+        pass band of the causal Butterworth filter
+    order : int, default 2
+        order of the filter
+    hysteresis : float, default 0.3
+        drop (rise) after the running maximum (minimum), in running standard deviations of the filtered signal, at
+        which a peak (trough) is detected
+    min_interval : float, default 0.5
+        minimum time in seconds between a peak and the following trough (and vice versa)
+    n_cycles : int, default 5
+        number of recent half cycles the expected duration is the median of
+    prior_duration : float, default 2.
+        expected duration in seconds of each half cycle until n_cycles have been seen
+    std_time_constant : float, default 20.
+        time constant in seconds of the running variance of the filtered signal
+    breathing_freq : float, default 0.25
+        typical breathing frequency in Hz, the landmarks are corrected for the phase delay of the filter at it
+
+    Attributes
+    ----------
+    peaks, troughs : list of int
+        sample indices of the landmarks found so far, corrected for the group delay of the filter
+    detected_at : dict
+        landmark sample index to the sample index at which it was detected
+    """
+    def __init__(self, sfreq: float, l_freq = 0.05, h_freq = 1., order = 2, hysteresis = 0.3, min_interval = 0.5, n_cycles = 5, prior_duration = 2., std_time_constant = 20., breathing_freq = 0.25):
+        self.sfreq = sfreq
+        self.sos = signal.butter(order, [l_freq, h_freq], btype = "bandpass", output = "sos", fs = sfreq)
+        self._zi = None
+
+        # the extrema of the filtered breathing lag (or lead) those of the respiration by the phase delay of the filter
+        _, response = signal.sosfreqz(self.sos, worN = [breathing_freq], fs = sfreq)
+        self.delay = int(round(-np.angle(response[0]) / (2 * np.pi * breathing_freq) * sfreq))
+
+        self.hysteresis = hysteresis
+        self.min_interval = int(min_interval * sfreq)
+        self._decay = np.exp(-1 / (std_time_constant * sfreq))
+        self._var_zi = np.zeros(1)
+
+        # ring buffers of the recent durations in samples of peak -> trough and trough -> peak
+        self._durations = {"peak": np.full(n_cycles, prior_duration * sfreq), "trough": np.full(n_cycles, prior_duration * sfreq)}
+        self._n_durations = {"peak": 0, "trough": 0}
+        self._expected = {kind: float(np.median(durations)) for kind, durations in self._durations.items()}
+
+        self.n_samples = 0
+        self.peaks, self.troughs, self.detected_at = [], [], {}
+
+        # the landmark looked for, the running extremum since the last landmark and where it was reached
+        self._looking_for = None
+        self._extremum, self._extremum_index = None, None
+        self._last = None # (kind, sample index) of the last landmark
+
+    @property
+    def phase(self) -> float:
+        """
+        Phase predicted for the next sample.
+        """
+        return float(self._predict(np.array([self.n_samples]))[0])
+
+    def _predict(self, indices: np.ndarray) -> np.ndarray:
+        if self._last is None:
+            return np.full(len(indices), np.nan)
+
+        kind, index = self._last
+        progress = np.clip((indices - index) / self._expected[kind], 0, 1 - 1e-6)
+
+        # the phase waits just short of the next landmark if it is late
+        return np.pi * progress if kind == "peak" else -np.pi + np.pi * progress
+
+    def _add_landmark(self, kind: str, index: int, detected_at: int):
+        if self._last is not None and self._last[0] != kind:
+            # duration of the half cycle that just ended, into the ring buffer of its kind
+            previous = self._last[0]
+            self._durations[previous][self._n_durations[previous] % len(self._durations[previous])] = index - self._last[1]
+            self._n_durations[previous] += 1
+            self._expected[previous] = float(np.median(self._durations[previous]))
+
+        (self.peaks if kind == "peak" else self.troughs).append(index)
+        self.detected_at[index] = detected_at
+        self._last = (kind, index)
+
+    def update(self, block) -> np.ndarray:
+        """
+        Consumes the next sample(s) and returns the phase estimated at each of them, with the landmarks detected up
+        to that sample.
+        """
+        block = np.atleast_1d(np.asarray(block, dtype = float))
+        n = len(block)
+
+        if self._zi is None: # start the filter in steady state at the first sample
+            self._zi = signal.sosfilt_zi(self.sos) * block[0]
+
+        # section by section with lfilter, which has much less overhead than sosfilt on short blocks
+        filtered = block
+        for section, zi in zip(self.sos, self._zi):
+            filtered, zi[:] = signal.lfilter(section[:3], section[3:], filtered, zi = zi)
+
+        # exponentially weighted running variance of the (zero mean) filtered signal, normalised by the total weight
+        # so far so it is unbiased from the first samples on
+        var, self._var_zi = signal.lfilter([1 - self._decay], [1, -self._decay], filtered**2, zi = self._var_zi)
+        var /= 1 - self._decay**(self.n_samples + 1 + np.arange(n))
+        threshold = self.hysteresis * np.sqrt(var)
+
+        if self._looking_for is None:
+            self._looking_for, self._extremum, self._extremum_index = "peak", filtered[0], self.n_samples
+
+        phases = np.empty(n)
+        i = 0
+        while i < n:
+            segment = filtered[i:]
+            indices = self.n_samples + i + np.arange(len(segment))
+            sign = 1 if self._looking_for == "peak" else -1
+
+            # running maximum (minimum for troughs) since the last landmark, and where the signal fell (rose) from it
+            # by the threshold, at least min_interval after the last landmark
+            running = sign * np.maximum.accumulate(np.append(sign * self._extremum, sign * segment))[1:]
+            crossed = np.flatnonzero(sign * (running - segment) > threshold[i:])
+            if self._last is not None:
+                crossed = crossed[indices[crossed] >= self._last[1] + self.delay + self.min_interval]
+
+            stop = crossed[0] if len(crossed) else len(segment)
+
+            best = np.argmax(sign * segment[:stop + 1])
+            if sign * segment[best] > sign * self._extremum:
+                self._extremum, self._extremum_index = segment[best], indices[best]
+
+            phases[i:i + stop] = self._predict(indices[:stop])
+
+            if len(crossed) == 0:
+                break
+
+            self._add_landmark(self._looking_for, self._extremum_index - self.delay, indices[stop])
+            self._looking_for = "trough" if self._looking_for == "peak" else "peak"
+            self._extremum, self._extremum_index = segment[stop], indices[stop]
+
+            # the detection sample itself is estimated with the new landmark
+            phases[i + stop] = self._predict(indices[stop:stop + 1])[0]
+            i += stop + 1
+
+        self.n_samples += n
+
+        return phases
+
+
+def replay(resp_timeseries: np.ndarray, sfreq: float, reference_phase: np.ndarray = None, block_size = 10, reference_peaks: np.ndarray = None, **kwargs):
+    """
+    Streams a recorded respiration trace through an OnlinePhaseEstimator in blocks, as during acquisition, and
+    compares the online phase with the offline phase.
+
+    Parameters
+    ----------
+    resp_timeseries : np.ndarray
+        the respiration (e.g. MISC001 as from MEG_participant.load_resp)
+    sfreq : float
+    reference_phase : np.ndarray, default None
+        offline phase of resp_timeseries, from respiration.extract_phase_angle if None
+    block_size : int, default 10
+        samples per update
+    reference_peaks : np.ndarray, default None
+        offline peaks, for the detection delays (from reference_phase if None)
+    **kwargs
+        passed on to OnlinePhaseEstimator
+
+    Returns
+    -------
+    report : dict
+        update time per block in microseconds (median, 99th percentile and max), the phase error (online - offline
+        wrapped to [-pi, pi]: circular mean, median absolute and mean absolute in radians, over samples where both
+        are defined), the detection delay of the peaks (time from the offline peak to its online detection, median in
+        seconds) and the timing error of the detected peaks (median absolute in seconds)
+    online_phase : np.ndarray
+    estimator : OnlinePhaseEstimator
+    """
+    resp_timeseries = np.asarray(resp_timeseries, dtype = float)
+
+    if reference_phase is None:
+        _, reference_peaks, _, reference_phase = respiration.extract_phase_angle(resp_timeseries, widths = int(sfreq / 3), min_sample = int(sfreq / 6), peak_method = "fast")
+    if reference_peaks is None:
+        # samples where the offline phase wraps from negative to non-negative
+        reference_peaks = np.flatnonzero((reference_phase[1:] >= 0) & (reference_phase[:-1] < 0)) + 1
+
+    estimator = OnlinePhaseEstimator(sfreq, **kwargs)
+    online_phase = np.empty(len(resp_timeseries))
+    update_times = []
+
+    for start in range(0, len(resp_timeseries), block_size):
+        block = resp_timeseries[start:start + block_size]
+        tic = time.perf_counter_ns()
+        online_phase[start:start + len(block)] = estimator.update(block)
+        update_times.append((time.perf_counter_ns() - tic) / 1e3)
+
+    error = np.angle(np.exp(1j * (online_phase - reference_phase)))
+    error = error[~np.isnan(error)]
+
+    # each online peak matched to the nearest offline peak
+    online_peaks = np.array(estimator.peaks, dtype = int)
+    nearest = np.clip(np.searchsorted(reference_peaks, online_peaks), 1, max(len(reference_peaks) - 1, 1))
+    if len(reference_peaks) > 1 and len(online_peaks):
+        nearest = np.where(np.abs(reference_peaks[nearest - 1] - online_peaks) < np.abs(reference_peaks[nearest] - online_peaks), nearest - 1, nearest)
+        matched = reference_peaks[nearest]
+        detected = np.array([estimator.detected_at[peak] for peak in online_peaks])
+        detection_delay = float(np.median(detected - matched) / sfreq)
+        timing_error = float(np.median(np.abs(online_peaks - matched)) / sfreq)
+    else:
+        detection_delay = timing_error = np.nan
+
+    update_times = np.array(update_times)
+    report = {
+        "block_size": block_size,
+        "update_us_median": float(np.median(update_times)),
+        "update_us_p99": float(np.percentile(update_times, 99)),
+        "update_us_max": float(update_times.max()),
+        "phase_error_circular_mean": float(circstats.circ_mean(error)) if len(error) else np.nan,
+        "phase_error_median_abs": float(np.median(np.abs(error))) if len(error) else np.nan,
+        "phase_error_mean_abs": float(np.mean(np.abs(error))) if len(error) else np.nan,
+        "n_online_peaks": len(online_peaks),
+        "n_offline_peaks": len(reference_peaks),
+        "peak_detection_delay": detection_delay,
+        "peak_timing_error": timing_error,
+        }
+
+    return report, online_phase, estimator
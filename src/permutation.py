@@ -0,0 +1,146 @@
+"""
+Permutation tests of respiratory phase differences between two conditions (e.g. hits vs misses), per subject and at
+group level, computed on the phase angle event tables from respiration.phase_angle_events.
+"""
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _condition_vectors(df, condition_a, condition_b, subject_col, event_col, angle_col):
+    """
+    Unit vectors and condition masks per subject, computed once before permuting.
+    """
+    df = df[~df[angle_col].isna()]
+    events = df[event_col].astype(str)
+
+    is_a = events.str.contains(condition_a, regex = False).to_numpy()
+    is_b = events.str.contains(condition_b, regex = False).to_numpy()
+    keep = is_a ^ is_b # events matching exactly one of the conditions
+
+    df, is_a = df[keep], is_a[keep]
+    subjects = df[subject_col].to_numpy() if subject_col in df else np.zeros(len(df), dtype = int)
+
+    vectors = {}
+    for subject in pd.unique(subjects):
+        in_subject = subjects == subject
+        vectors[subject] = (np.exp(1j * df[angle_col].to_numpy()[in_subject]), is_a[in_subject])
+
+    return vectors
+
+
+def _statistics(sum_a, sum_b, n_a, n_b):
+    """
+    Difference in resultant length (a - b) and absolute difference in mean direction between the conditions.
+    """
+    R_diff = np.abs(sum_a) / n_a - np.abs(sum_b) / n_b
+    mean_diff = np.abs(np.angle(sum_a * np.conj(sum_b)))
+
+    return R_diff, mean_diff
+
+
+def _permutation_block(vectors, n_permutations, seed):
+    """
+    Null statistics for one block of permutations for all subjects.
+
+    Returns
+    -------
+    R_diff, mean_diff : np.ndarray
+        arrays of shape (n_permutations, n_subjects)
+    """
+    rng = np.random.default_rng(seed)
+    R_diff = np.empty((n_permutations, len(vectors)))
+    mean_diff = np.empty((n_permutations, len(vectors)))
+
+    for i, (unit_vectors, is_a) in enumerate(vectors):
+        n_a = is_a.sum()
+        n_b = len(is_a) - n_a
+        total = unit_vectors.sum()
+
+        # shuffle the condition labels independently in every row
+        permuted = rng.permuted(np.broadcast_to(is_a, (n_permutations, len(is_a))), axis = 1)
+        sum_a = permuted @ unit_vectors
+
+        R_diff[:, i], mean_diff[:, i] = _statistics(sum_a, total - sum_a, n_a, n_b)
+
+    return R_diff, mean_diff
+
+
+def phase_permutation_test(df: pd.DataFrame, condition_a = "hit", condition_b = "miss", n_permutations = 10000, block_size = 500, n_jobs = 1, seed = None, subject_col = "subject", event_col = "event", angle_col = "phase_angle"):
+    """
+    Permutation test of the difference in respiratory phase between two conditions.
+
+    Condition labels are permuted within each subject. Two statistics are tested: the difference in resultant length
+    (R_a - R_b, two-sided) and the absolute difference in mean direction (one-sided). The group statistics are the
+    averages of the subject statistics over subjects, and their null distribution uses the same permutation index for
+    all subjects.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        phase angle events, e.g. from respiration.phase_angle_events, concatenated over subjects
+    condition_a, condition_b : str
+        events whose name contains condition_a (resp. condition_b) belong to that condition
+    n_permutations : int, default 10000
+    block_size : int, default 500
+        number of permutations generated at once as one vectorized block
+    n_jobs : int, default 1
+        number of processes the blocks are distributed over
+    seed : int, default None
+        seed of the random generator. Each block gets its own child seed, so results only depend on the seed and the
+        block size, not on n_jobs.
+    subject_col, event_col, angle_col : str
+        column names. If subject_col is not in df, all events are treated as one subject.
+
+    Returns
+    -------
+    results : pd.DataFrame
+        observed statistics and p-values per subject, the last row ("group") holding the group level test
+    null : dict
+        null distributions, "R_diff" and "mean_diff" of shape (n_permutations, n_subjects)
+    """
+    vectors = _condition_vectors(df, condition_a, condition_b, subject_col, event_col, angle_col)
+    subjects = list(vectors)
+    vectors = [vectors[subject] for subject in subjects]
+
+    for subject, (_, is_a) in zip(subjects, vectors):
+        if is_a.all() or not is_a.any():
+            raise ValueError(f"Subject {subject} does not have events of both conditions")
+
+    observed_R, observed_mean = np.array([
+        _statistics(unit_vectors[is_a].sum(), unit_vectors[~is_a].sum(), is_a.sum(), (~is_a).sum())
+        for unit_vectors, is_a in vectors
+        ]).T
+
+    block_sizes = [block_size] * (n_permutations // block_size)
+    if n_permutations % block_size:
+        block_sizes.append(n_permutations % block_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+
+    if n_jobs == 1:
+        blocks = [_permutation_block(vectors, size, block_seed) for size, block_seed in zip(block_sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            blocks = list(executor.map(_permutation_block, [vectors] * len(block_sizes), block_sizes, seeds))
+
+    null = {
+        "R_diff": np.concatenate([block[0] for block in blocks]),
+        "mean_diff": np.concatenate([block[1] for block in blocks])
+    }
+
+    def p_value(null_stats, observed, two_sided):
+        if two_sided:
+            null_stats, observed = np.abs(null_stats), np.abs(observed)
+        return (1 + np.sum(null_stats >= observed, axis = 0)) / (1 + len(null_stats))
+
+    results = pd.DataFrame({
+        "subject": subjects + ["group"],
+        "n_a": [is_a.sum() for _, is_a in vectors] + [sum(is_a.sum() for _, is_a in vectors)],
+        "n_b": [(~is_a).sum() for _, is_a in vectors] + [sum((~is_a).sum() for _, is_a in vectors)],
+        "R_diff": np.append(observed_R, observed_R.mean()),
+        "R_diff_p": np.append(p_value(null["R_diff"], observed_R, True), p_value(null["R_diff"].mean(axis = 1), observed_R.mean(), True)),
+        "mean_diff": np.append(observed_mean, observed_mean.mean()),
+        "mean_diff_p": np.append(p_value(null["mean_diff"], observed_mean, False), p_value(null["mean_diff"].mean(axis = 1), observed_mean.mean(), False)),
+    })
+
+    return results, null
@@ -0,0 +1,194 @@
+"""
+Respiratory phase resolved MEG power in one streaming pass: power is computed chunk by chunk from the raw data and
+accumulated per phase bin and channel (count, mean and sum of squared deviations), so memory is O(bins x channels)
+whatever the length of the recording.
+"""
+import mne
+import numpy as np
+import pandas as pd
+from scipy import fft, signal
+
+
+def phase_bins(phase: np.ndarray, n_bins: int) -> np.ndarray:
+    """
+    Bin index of phase angles in [-pi, pi] for n_bins equally wide bins starting at -pi (pi is in the last bin).
+    NaN phases get bin -1.
+    """
+    phase = np.asarray(phase)
+    bins = np.floor((phase + np.pi) / (2 * np.pi) * n_bins)
+    bins = np.clip(np.nan_to_num(bins, nan = -1), -1, n_bins - 1).astype(int)
+
+    return bins
+
+
+class PhaseBinnedAccumulator:
+    """
+    Running count, mean and variance of signals (e.g. MEG or ROI power, (n_signals, n_times)) per phase bin.
+
+    Each update computes the statistics of the chunk per bin and merges them into the running statistics with the
+    pairwise update of Chan et al. (the batch version of Welford's algorithm), which stays accurate for long
+    recordings where sum of squares minus squared sum would not.
+
+    Parameters
+    ----------
+    n_bins : int
+        number of phase bins over [-pi, pi]
+    n_signals : int
+        number of channels or labels
+    names : list of str, default None
+        channel or label names
+    """
+    def __init__(self, n_bins: int, n_signals: int, names: list = None):
+        self.n_bins = n_bins
+        self.names = list(names) if names is not None else [str(i) for i in range(n_signals)]
+        self.count = np.zeros(n_bins, dtype = np.int64)
+        self.mean = np.zeros((n_bins, n_signals))
+        self.m2 = np.zeros((n_bins, n_signals))
+
+    @property
+    def edges(self) -> np.ndarray:
+        return np.linspace(-np.pi, np.pi, self.n_bins + 1)
+
+    @property
+    def centres(self) -> np.ndarray:
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    def _merge(self, count, mean, m2):
+        total = self.count + count
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            weight = np.where(total > 0, count / total, 0)[:, np.newaxis]
+            delta = mean - self.mean
+
+            self.mean += delta * weight
+            self.m2 += m2 + delta**2 * (self.count * weight.ravel())[:, np.newaxis]
+        self.count = total
+
+    def update(self, phase: np.ndarray, values: np.ndarray):
+        """
+        Adds a chunk of samples.
+
+        Parameters
+        ----------
+        phase : np.ndarray
+            (n_times,) phase angle of each sample, NaN samples are skipped
+        values : np.ndarray
+            (n_signals, n_times)
+        """
+        bins = phase_bins(phase, self.n_bins)
+        keep = bins >= 0
+
+        # samples sorted by bin, so the statistics of all bins and signals are segmented reductions
+        order = np.argsort(bins[keep], kind = "stable")
+        bins, values = bins[keep][order], np.asarray(values)[:, keep][:, order]
+
+        if len(bins) == 0:
+            return
+
+        present, starts, counts = np.unique(bins, return_index = True, return_counts = True)
+
+        means = np.add.reduceat(values, starts, axis = 1) / counts
+        deviations = values - np.repeat(means, counts, axis = 1)
+        m2s = np.add.reduceat(deviations**2, starts, axis = 1)
+
+        count = np.zeros(self.n_bins, dtype = np.int64)
+        mean, m2 = np.zeros_like(self.mean), np.zeros_like(self.m2)
+        count[present], mean[present], m2[present] = counts, means.T, m2s.T
+
+        self._merge(count, mean, m2)
+
+    def merge(self, other: "PhaseBinnedAccumulator"):
+        """
+        Adds the samples of another accumulator with the same bins and signals (e.g. another run or worker).
+        """
+        if other.n_bins != self.n_bins or other.names != self.names:
+            raise ValueError("Accumulators have different bins or signals")
+
+        self._merge(other.count, other.mean, other.m2)
+        return self
+
+    def var(self, ddof = 1) -> np.ndarray:
+        """
+        (n_bins, n_signals) variance, NaN for bins with too few samples.
+        """
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            return self.m2 / (self.count - ddof)[:, np.newaxis]
+
+    def sem(self) -> np.ndarray:
+        """
+        Standard error of the mean per bin. Samples of a continuous signal are not independent, so this is only a
+        lower bound of the uncertainty.
+        """
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            return np.sqrt(self.var() / self.count[:, np.newaxis])
+
+    def relative_mean(self) -> np.ndarray:
+        """
+        Mean per bin relative to the mean over all samples (1 = average power), comparable between subjects.
+        """
+        overall = (self.mean * self.count[:, np.newaxis]).sum(axis = 0) / self.count.sum()
+        return self.mean / overall
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Long format table with one row per bin and signal: bin, phase (bin centre), signal, count, mean and var.
+        """
+        n_signals = len(self.names)
+
+        return pd.DataFrame({
+            "bin": np.repeat(np.arange(self.n_bins), n_signals),
+            "phase": np.repeat(self.centres, n_signals),
+            "signal": np.tile(self.names, self.n_bins),
+            "count": np.repeat(self.count, n_signals),
+            "mean": self.mean.ravel(),
+            "var": self.var().ravel()
+            })
+
+    def save(self, path):
+        np.savez(path, count = self.count, mean = self.mean, m2 = self.m2, names = np.array(self.names))
+
+    @classmethod
+    def load(cls, path) -> "PhaseBinnedAccumulator":
+        with np.load(path) as f:
+            accumulator = cls(len(f["count"]), f["mean"].shape[1], names = f["names"].tolist())
+            accumulator.count, accumulator.mean, accumulator.m2 = f["count"], f["mean"], f["m2"]
+
+        return accumulator
+
+
+def iter_band_power(raw, l_freq: float, h_freq: float, picks = None, chunk_duration = 60., pad_duration = 10., boundaries = ()):
+    """
+    Band-limited power (squared Hilbert envelope) of a raw object, chunk by chunk.
+
+    Each chunk is read with pad_duration of data on both sides (within its file segment), band-pass filtered and
+    Hilbert transformed, and the padding is cut off again, so the chunk edges do not show filter or Hilbert edge
+    effects as long as the padding is longer than the filter. Works on raw objects that are not preloaded.
+
+    Parameters
+    ----------
+    boundaries : sequence of int
+        data indices where a new file segment starts, chunks do not cross them
+
+    Yields
+    ------
+    start : int
+        data index (from the first sample of raw) of the first sample of the chunk
+    power : np.ndarray
+        (n_picks, n_chunk_samples)
+    """
+    sfreq = raw.info["sfreq"]
+    picks = mne.pick_types(raw.info, meg = True, exclude = "bads") if picks is None else picks
+    chunk, pad = int(chunk_duration * sfreq), int(pad_duration * sfreq)
+
+    segment_starts = np.concatenate([[0], boundaries]).astype(int)
+    segment_stops = np.append(segment_starts[1:], raw.n_times)
+
+    for segment_start, segment_stop in zip(segment_starts, segment_stops):
+        for start in range(segment_start, segment_stop, chunk):
+            stop = min(start + chunk, segment_stop)
+            read_start, read_stop = max(start - pad, segment_start), min(stop + pad, segment_stop)
+
+            data = raw.get_data(picks = picks, start = read_start, stop = read_stop)
+            data = mne.filter.filter_data(data, sfreq, l_freq, h_freq, verbose = False)
+            envelope = signal.hilbert(data, N = fft.next_fast_len(data.shape[-1]), axis = -1)[:, start - read_start:stop - read_start]
+
+            yield start, envelope.real**2 + envelope.imag**2
@@ -0,0 +1,233 @@
+"""
+Single pass filtering and resampling of one channel (the respiration trace), replacing Raw.filter followed by
+Raw.resample. The low-pass (and optional high-pass) filter is folded into the anti-alias filter of a polyphase
+resampler, so the recording is filtered and resampled in one pass at the output rate, chunk by chunk.
+"""
+from fractions import Fraction
+import numpy as np
+from scipy import signal
+
+
+def resample_ratio(sfreq: float, new_sfreq: float, max_denominator: int = 1000):
+    """
+    Rational approximation up / down of new_sfreq / sfreq.
+    """
+    ratio = Fraction(new_sfreq / sfreq).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+def _transition_bandwidth(freq: float, kind: str, nyquist: float) -> float:
+    # same defaults as mne.filter.create_filter (h_trans_bandwidth / l_trans_bandwidth = "auto")
+    if kind == "low":
+        return min(max(0.25 * freq, 2.), nyquist - freq)
+    return min(max(0.25 * freq, 2.), freq)
+
+
+def design_filter(sfreq: float, new_sfreq: float, l_freq: float = None, h_freq: float = None) -> np.ndarray:
+    """
+    FIR filter (hamming window) for scipy.signal.resample_poly / upfirdn at the upsampled rate sfreq * up.
+
+    The pass band is l_freq to h_freq with the transition bandwidths and filter length MNE uses by default. The
+    low-pass edge is limited to the Nyquist frequency of new_sfreq, so the filter is also the anti-alias filter.
+    Without l_freq and h_freq it is the default anti-alias filter of resample_poly.
+    """
+    up, down = resample_ratio(sfreq, new_sfreq)
+    fs = sfreq * up
+    nyquist = min(sfreq, new_sfreq) / 2
+
+    if l_freq is None and h_freq is None:
+        max_rate = max(up, down)
+        return signal.firwin(2 * 10 * max_rate + 1, 1 / max_rate, window = ("kaiser", 5.0))
+
+    cutoffs, transitions = [], []
+
+    if l_freq is not None:
+        l_trans = _transition_bandwidth(l_freq, "high", nyquist)
+        cutoffs.append(l_freq - l_trans / 2)
+        transitions.append(l_trans)
+
+    h_freq = nyquist if h_freq is None else min(h_freq, nyquist)
+    h_trans = _transition_bandwidth(h_freq, "low", nyquist)
+    if h_freq + h_trans / 2 < nyquist:
+        cutoffs.append(h_freq + h_trans / 2)
+    else: # low-pass at the output Nyquist frequency, the cutoff has to be below it
+        h_trans = max(h_trans, 0.1 * nyquist)
+        cutoffs.append(nyquist - h_trans / 2)
+    transitions.append(h_trans)
+
+    n_taps = int(np.ceil(3.3 / min(transitions) * fs)) // 2 * 2 + 1
+
+    return signal.firwin(n_taps, cutoffs, window = "hamming", pass_zero = l_freq is None, fs = fs)
+
+
+def _upfirdn(h: np.ndarray, x: np.ndarray, up: int, down: int) -> np.ndarray:
+    """
+    Same output as scipy.signal.upfirdn(h, x, up, down). Long filters are applied as up FFT convolutions of x with the
+    polyphase components of h, each then read at the output positions, rather than as direct sums per output sample.
+    """
+    if len(h) <= 128 * up:
+        return signal.upfirdn(h, x, up, down)
+
+    n_out = -(-((len(x) - 1) * up + len(h)) // down)
+    positions = np.arange(n_out) * down
+    phases, indices = positions % up, positions // up
+
+    out = np.zeros(n_out)
+    for phase in range(up):
+        convolved = signal.oaconvolve(x, h[phase::up])
+        selected = (phases == phase) & (indices < len(convolved))
+        out[selected] = convolved[indices[selected]]
+
+    return out
+
+
+def polyphase_resample(ts: np.ndarray, sfreq: float, new_sfreq: float, l_freq: float = None, h_freq: float = None, chunk_size: int = 2_000_000) -> np.ndarray:
+    """
+    Filters and resamples a timeseries in a single pass.
+
+    The result is the same as scipy.signal.resample_poly(ts, up, down, window = design_filter(...)) with the edges
+    padded by point reflection (MNE's default), but the input is processed in chunks of chunk_size samples whose
+    filtered outputs are overlap-added, so the transient memory is bounded by the chunk size rather than the recording
+    length.
+
+    Parameters
+    ----------
+    ts : np.ndarray
+        1D timeseries
+    sfreq, new_sfreq : float
+        sample rate of ts and of the output
+    l_freq, h_freq : float, default None
+        pass band of the filter, see design_filter
+    chunk_size : int, default 2_000_000
+        number of input samples per chunk (rounded to a multiple of the decimation factor)
+
+    Returns
+    -------
+    np.ndarray
+        of length ceil(len(ts) * up / down), sample m at time m / new_sfreq
+    """
+    up, down = resample_ratio(sfreq, new_sfreq)
+    h = design_filter(sfreq, new_sfreq, l_freq, h_freq) * up
+
+    # same alignment as resample_poly: the filter is centred on output samples by padding it to a multiple of down
+    half_len = (len(h) - 1) // 2
+    n_pre_pad = down - half_len % down
+    h = np.concatenate([np.zeros(n_pre_pad), h])
+    n_pre_remove = (half_len + n_pre_pad) // down
+
+    n_out = -(-len(ts) * up // down)
+    out = np.zeros(n_out)
+
+    # the mean is removed so the padding does not cause a step, and the edges are padded with a point reflection of
+    # the signal (as MNE's filters do) by filtering the reflections as two extra chunks
+    ts_mean = np.mean(ts)
+    n_pad = min(len(h) // up + 1, len(ts) - 1)
+    left = 2 * ts[0] - ts[n_pad:0:-1]
+    right = 2 * ts[-1] - ts[-2:-n_pad - 2:-1]
+
+    # chunks have to start at multiples of down, the extra chunks are aligned by leading zeros
+    left_start = -(-n_pad // down) * down
+    right_start = len(ts) // down * down
+    chunks = [(-left_start, np.concatenate([np.full(left_start - n_pad, ts_mean), left]))]
+
+    chunk_size = max(chunk_size // down, 1) * down
+    chunks += [(start, ts[start:start + chunk_size]) for start in range(0, len(ts), chunk_size)]
+    chunks.append((right_start, np.concatenate([np.full(len(ts) - right_start, ts_mean), right])))
+
+    for start, chunk in chunks:
+        filtered = _upfirdn(h, chunk - ts_mean, up, down)
+
+        # a chunk starting at a multiple of down contributes from output start * up / down onwards
+        first = start * up // down - n_pre_remove
+        skip = max(-first, 0)
+        stop = min(first + len(filtered), n_out)
+
+        if stop > first + skip:
+            out[first + skip:stop] += filtered[skip:stop - first]
+
+    if l_freq is None:
+        out += ts_mean
+
+    return out
+
+
+def remap_samples(samples: np.ndarray, sfreq: float, new_sfreq: float, segment_starts = None, segment_lengths = None, exact: bool = False) -> np.ndarray:
+    """
+    Sample indices after resampling with polyphase_resample, rounded to the nearest output sample.
+
+    The mapping is done in integer arithmetic, round(index * up / down) with halves rounded up, so it is exact for
+    any recording length. If the recording was resampled per segment (e.g. per split file), segment_starts and
+    segment_lengths give the segments in input samples; samples are mapped within their segment and offset by the
+    output length of the segments before. With exact, the (fractional) positions are returned without rounding.
+    """
+    up, down = resample_ratio(sfreq, new_sfreq)
+    samples = np.asarray(samples, dtype = float if exact else np.int64)
+
+    if segment_starts is None:
+        return samples * up / down if exact else (2 * samples * up + down) // (2 * down)
+
+    segment_starts = np.asarray(segment_starts, dtype = np.int64)
+    out_lengths = -(-np.asarray(segment_lengths, dtype = np.int64) * up // down)
+    out_starts = np.concatenate([[0], np.cumsum(out_lengths)[:-1]])
+
+    segment = np.clip(np.searchsorted(segment_starts, samples, side = "right") - 1, 0, None)
+    within = samples - segment_starts[segment]
+
+    if exact:
+        return out_starts[segment] + within * up / down
+    return out_starts[segment] + (2 * within * up + down) // (2 * down)
+
+
+def unmap_samples(samples: np.ndarray, sfreq: float, new_sfreq: float, segment_starts = None, segment_lengths = None) -> np.ndarray:
+    """
+    Inverse of remap_samples with exact: (fractional) positions in the input of positions in the output of
+    polyphase_resample (per segment), e.g. peaks found on the resampled respiration as positions at the native rate.
+    """
+    up, down = resample_ratio(sfreq, new_sfreq)
+    samples = np.asarray(samples, dtype = float)
+
+    if segment_starts is None:
+        return samples * down / up
+
+    segment_starts = np.asarray(segment_starts, dtype = np.int64)
+    out_lengths = -(-np.asarray(segment_lengths, dtype = np.int64) * up // down)
+    out_starts = np.concatenate([[0], np.cumsum(out_lengths)[:-1]])
+
+    segment = np.clip(np.searchsorted(out_starts, samples, side = "right") - 1, 0, None)
+
+    return segment_starts[segment] + (samples - out_starts[segment]) * down / up
+
+
+def filter_resample_segments(data: np.ndarray, sfreq: float, new_sfreq: float, boundaries = (), events: np.ndarray = None, l_freq: float = None, h_freq: float = None, chunk_size: int = 2_000_000):
+    """
+    Filters and resamples a channel recorded in several segments (split files), each one separately as MNE does for
+    concatenated raws, and remaps the events to the output.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        1D data of all segments
+    boundaries : sequence of int
+        indices in data where a new segment starts (excluding the first)
+    events : np.ndarray, default None
+        MNE events with samples relative to the start of data (i.e. first_samp already subtracted)
+
+    Returns
+    -------
+    resampled : np.ndarray
+    events : np.ndarray or None
+        copy of events with samples relative to the start of resampled
+    """
+    starts = np.concatenate([[0], boundaries]).astype(np.int64)
+    lengths = np.diff(np.append(starts, len(data)))
+
+    resampled = np.concatenate([
+        polyphase_resample(data[start:start + length], sfreq, new_sfreq, l_freq = l_freq, h_freq = h_freq, chunk_size = chunk_size)
+        for start, length in zip(starts, lengths)
+        ])
+
+    if events is not None:
+        events = np.array(events, copy = True)
+        events[:, 0] = remap_samples(events[:, 0], sfreq, new_sfreq, starts, lengths)
+
+    return resampled, events
@@ -1,9 +1,16 @@
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
-from scipy import interpolate, signal
+import matplotlib.colors as mcolors
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+from scipy import signal
 from scipy.stats import gaussian_kde
 import pandas as pd
 import cmath
+from concurrent.futures import Future, ProcessPoolExecutor
+import circstats
+from instrumentation import stage, array_sizes
 
 
 
@@ -14,92 +21,156 @@ def eulers_formula(angle: float) -> complex:
 def average_vectors(vectors) -> np.ndarray:
     return sum(vectors) / len(vectors)
 
-def plot_phase_vectors(phase_angles, average_vector = None, ax = None):
+def _as_groups(values) -> list:
+    """
+    Splits ragged input into a list of 1D arrays, a flat sequence of numbers being a single group.
+    """
+    # the first element by position, values may be a pandas Series with any index
+    first = next(iter(values), None)
+    if first is not None and np.ndim(first) > 0:
+        return [np.asarray(group, dtype = float).ravel() for group in values]
+    return [np.asarray(values, dtype = float).ravel()]
+
+
+def _group_colors(colors, groups: list) -> np.ndarray:
+    """
+    RGBA color per vector, from one color or one color per group.
+    """
+    colors = mcolors.to_rgba_array(colors)
+    if len(colors) == 1:
+        colors = np.repeat(colors, len(groups), axis = 0)
+
+    return np.repeat(colors, [len(group) for group in groups], axis = 0)
+
+
+def _vector_collection(angles: list, magnitudes: list, colors, **kwargs) -> LineCollection:
+    """
+    All vectors from the origin of a polar plot as one LineCollection (a single artist however many vectors).
+    Magnitudes can be arrays matching the angles of each group or scalars.
+    """
+    colors = _group_colors(colors, angles)
+    magnitudes = np.concatenate([np.broadcast_to(magnitude, angle.shape) for angle, magnitude in zip(angles, magnitudes)])
+    angles = np.concatenate(angles)
+
+    # (angle, 0) -> (angle, magnitude), shape (n_vectors, 2 points, 2 coordinates)
+    segments = np.stack([np.column_stack([angles, np.zeros_like(angles)]), np.column_stack([angles, magnitudes])], axis = 1)
+
+    return LineCollection(segments, colors = colors, **kwargs)
+
+
+def _add_collection(ax, collection):
+    ax.add_collection(collection)
+    ax.autoscale_view()
+
+
+def plot_phase_vectors(phase_angles, average_vector = None, ax = None, colors = None, labels = None):
     """
     Plot phase vectors and their average on a polar plot.
+
+    phase_angles can be one array of angles or a list of arrays (e.g. one per subject or condition), drawn with one
+    color per group. The vectors are drawn as a single LineCollection, so the number of artists does not grow with the
+    number of trials. average_vector is a complex number, or one per group.
     """
     if not ax:
         fig, ax = plt.subplots(subplot_kw={'projection': 'polar'}, figsize=(7, 7))
 
+    groups = _as_groups(phase_angles)
+
+    if colors is None:
+        colors = 'forestgreen' if len(groups) == 1 else plt.cm.tab10(np.arange(len(groups)) % 10)
+
     # Plot each phase angle vector
-    for i, angle in enumerate(phase_angles):
-        ax.plot([0, angle], [0, 1], color='forestgreen', alpha=0.5, linewidth = 0.5, label='Phase Vector' if i == 0 else "")
+    _add_collection(ax, _vector_collection(groups, [1] * len(groups), colors, alpha=0.5, linewidth = 0.5))
+
+    # legend entries are drawn from proxy lines, as a collection has no single color
+    if labels is None:
+        labels = ['Phase Vector'] if len(groups) == 1 else [f'Group {i}' for i in range(len(groups))]
+    group_colors = mcolors.to_rgba_array(colors)
+    handles = [Line2D([], [], color=color, alpha=0.5, linewidth = 0.5, label=label) for color, label in zip(np.resize(group_colors, (len(groups), 4)), labels)]
 
     # Plot the average vector
-    if average_vector:
-        ax.plot([0, cmath.phase(average_vector)], [0, abs(average_vector)], 
-                color='red', linewidth=1, label='Average Vector')
+    if average_vector is not None:
+        average_vector = np.atleast_1d(average_vector)
+        average_colors = 'red' if len(average_vector) == 1 else colors
+        _add_collection(ax, _vector_collection([np.angle(average_vector)], [np.abs(average_vector)], average_colors, linewidth=1))
+        handles.append(Line2D([], [], color='red' if len(average_vector) == 1 else 'black', label='Average Vector'))
 
     # Configure plot
-    ax.legend()
+    ax.legend(handles=handles)
 
-def average_phase_angle(phase_angles):
+
+def _nan_where_any(result, angles, axis = None):
+    # circstats ignores NaNs, these functions return NaN for any NaN angle (along axis), as they always did
+    return np.where(np.isnan(np.asarray(angles, dtype = float)).any(axis = axis), np.nan, result)
+
+
+def average_phase_angle(phase_angles, axis = None):
     """
     Measure consistency in phase angles by averaging vectors in the complex plane.
     Returns the average phase and average magnitude.
     based on this video: https://www.youtube.com/watch?v=R1Pro555H6s
 
+    Works along `axis` of N-D arrays (see circstats), e.g. subjects x trials in one call. A NaN angle makes the
+    result NaN (circstats.mean_resultant_vector to ignore NaNs instead).
     """
-    # Convert phase angles to unit vectors
-    unit_vectors = [eulers_formula(angle) for angle in phase_angles]
-    
-    # Compute the average vector
-    average = average_vectors(unit_vectors)
+    average = _nan_where_any(circstats.mean_resultant_vector(phase_angles, axis = axis), phase_angles, axis = axis)
     
     # Compute the phase and magnitude of the average vector
-    average_phase = cmath.phase(average)
-    average_magnitude = abs(average)
+    average_phase = np.angle(average)[()]
+    average_magnitude = np.abs(average)[()]
     
     return average_phase, average_magnitude
 
+
 def plot_average_phase_vectors(phase_angles, magnitiudes, ax = None, color = "red"):
     """
     Plot phase vectors and their average on a polar plot.
+
+    phase_angles and magnitiudes can be arrays or lists of arrays (groups, e.g. the subject averages of each condition)
+    with color a single color or one per group. All vectors are drawn as a single LineCollection.
     """
     if not ax:
         fig, ax = plt.subplots(subplot_kw={'projection': 'polar'}, figsize=(7, 7))
 
     # Plot each phase angle vector
-    for angle, magni in zip(phase_angles, magnitiudes):
-        ax.plot([0, angle], [0, magni], 
-            color=color, linewidth=1)
+    _add_collection(ax, _vector_collection(_as_groups(phase_angles), _as_groups(magnitiudes), color, linewidth=1))
 
     # Configure plot
     #ax.legend()
 
 
-def circular_mean(angles: np.ndarray) -> float:
+def circular_mean(angles: np.ndarray, axis = None) -> float:
     """
     Calculate the circular mean of an array of angles (in radians).
     
     Parameters:
     angles (np.array): An array of angles in radians.
+    axis (int, optional): Axis along which the mean is computed. By default all angles are used.
 
     Returns:
-    float: The circular mean of the angles in radians.
+    float: The circular mean of the angles in radians, NaN if any angle is NaN (circstats.circ_mean to ignore NaNs
+    instead).
     """
-    # Compute the sum of the unit vectors for each angle
-    sin_sum = np.sum(np.sin(angles))
-    cos_sum = np.sum(np.cos(angles))
-    
-    # Compute the mean angle in radians
-    mean_angle_rad = np.arctan2(sin_sum, cos_sum)
+    mean_angle_rad = _nan_where_any(circstats.circ_mean(angles, axis = axis), angles, axis = axis)
     
     # Ensure the angle is in the range [0, 2*pi)
-    if mean_angle_rad < 0:
-        mean_angle_rad += 2 * np.pi
+    mean_angle_rad = np.where(mean_angle_rad < 0, mean_angle_rad + 2 * np.pi, mean_angle_rad)
 
-    return mean_angle_rad
+    return mean_angle_rad[()]
 
 
 def polar_density_plot(angles: list[np.ndarray], labels: list[str], plot_circular_mean: bool = True, bw_method = 0.05):
     """
     Plot polar density plots for multiple angle datasets.
 
+    The densities are circular kernel density estimates with a von Mises kernel (see circstats.circular_kde).
 
     bw_method:
-        The method used to calculate the estimator bandwidth. 
-        This can be "scott", "silverman", a scalar constant or a callable. If a scalar, this will be used directly as kde.factor. If a callable, it should take a gaussian_kde instance as only parameter and return a scalar. If None (default), "scott" is used.
+        "taylor" for automatic selection of the kernel concentration (circstats.taylor_bandwidth), or any bw_method of
+        the gaussian KDE of the angles extended by +-2pi, which is what was used before: "scott", "silverman", None
+        ("scott"), a scalar used as kde.factor or a callable taking the gaussian_kde and returning the factor. The
+        gaussian kernel is converted to the von Mises kernel with the same width, so the density has the same shape
+        (but now integrates to 1 over the circle rather than over the extended range).
     """
     fig, ax = plt.subplots(1, 1, figsize=(4, 4), dpi=300, subplot_kw={'projection': 'polar'})
 
@@ -109,21 +180,23 @@ def polar_density_plot(angles: list[np.ndarray], labels: list[str], plot_circula
     colors = plt.cm.tab10(np.linspace(0, 1, len(angles)))
 
     for i, (tmp_angles, label) in enumerate(zip(angles, labels)):
+        tmp_angles = np.asarray(tmp_angles)
+
         # Scatter plot for data points
         ax.scatter(tmp_angles, [0.1] * len(tmp_angles), s=2, alpha=0.8, color=colors[i], 
                 label=f"{label} (n={len(tmp_angles)})")
 
-        # Extend the angles to avoid boundary artifacts
-        extended_angles = np.concatenate([tmp_angles + 2 * np.pi, tmp_angles, tmp_angles - 2 * np.pi])
-
-        # Density plot using Gaussian KDE
-        density = gaussian_kde(extended_angles, bw_method=bw_method)
-        xs = np.linspace(-2 * np.pi, 2 * np.pi, 2000)  # Extend range
-        density_vals = density(xs)
+        if isinstance(bw_method, str) and bw_method == "taylor":
+            kappa = "taylor"
+        else:
+            # width of the gaussian kernel on the angles extended by +-2pi, only its bandwidth is used
+            valid = tmp_angles[~np.isnan(tmp_angles)]
+            kde = gaussian_kde(np.concatenate([valid + 2 * np.pi, valid, valid - 2 * np.pi]), bw_method=bw_method)
+            kappa = 1 / kde.covariance[0, 0]
 
-        # Mask to plot only [-pi, pi]
-        mask = (xs >= -np.pi) & (xs <= np.pi)
-        ax.plot(xs[mask], density_vals[mask], color=colors[i], linewidth=1.5)
+        # Density plot using a von Mises KDE, closing the curve at +-pi
+        xs, density_vals = circstats.circular_kde(tmp_angles, kappa=kappa)
+        ax.plot(np.append(xs, np.pi), np.append(density_vals, density_vals[0]), color=colors[i], linewidth=1.5)
 
         # Plot circular mean 
         if plot_circular_mean:
@@ -139,7 +212,328 @@ def polar_density_plot(angles: list[np.ndarray], labels: list[str], plot_circula
     plt.show()
 
 
-def extract_phase_angle(resp_timeseries:np.array, widths = 500, min_sample = 100, figpath = None):
+def ricker_kernel(points: int, width: float) -> np.ndarray:
+    """
+    Ricker (mexican hat) wavelet, identical to the one used internally by scipy.signal.find_peaks_cwt.
+    """
+    A = 2 / (np.sqrt(3 * width) * (np.pi**0.25))
+    vec = np.arange(0, points) - (points - 1.0) / 2
+    wsq = width**2
+    mod = (1 - vec**2 / wsq)
+    gauss = np.exp(-vec**2 / (2 * wsq))
+
+    return A * mod * gauss
+
+
+def ricker_response(ts: np.ndarray, width: float, positions: np.ndarray = None) -> np.ndarray:
+    """
+    Convolve a timeseries with a Ricker wavelet the same way as the CWT in scipy.signal.find_peaks_cwt does (mode "same").
+
+    Parameters
+    ----------
+    ts : np.ndarray
+        1D timeseries
+    width : float
+        width of the wavelet in samples
+    positions : np.ndarray, default None
+        If provided, the response is only evaluated at these sample indices (direct dot products).
+        Otherwise the full response is computed with an FFT convolution.
+    """
+    N = int(min(10 * width, len(ts)))
+    kernel = ricker_kernel(N, width)
+
+    if positions is None:
+        return signal.fftconvolve(ts, kernel[::-1], mode = "same")
+
+    # windows ts[position - N // 2:position - N // 2 + N] (zero outside ts) gathered for a batch of positions at a
+    # time, so neither a padded copy of ts nor all windows at once are held in memory
+    positions = np.asarray(positions)
+    response = np.empty(len(positions))
+    batch_size = max(1, 2**18 // N)
+    offsets = np.arange(N) - N // 2
+
+    for start in range(0, len(positions), batch_size):
+        indices = positions[start:start + batch_size, np.newaxis] + offsets
+        inside = (indices >= 0) & (indices < len(ts))
+        windows = np.where(inside, ts[np.clip(indices, 0, len(ts) - 1)], 0)
+        response[start:start + batch_size] = windows @ kernel
+
+    return response
+
+
+def find_respiration_peaks(normalised_ts: np.ndarray, method = "cwt", widths = 500, min_sample = 100, decimation = None, prominence = 0.5, min_snr = 1, noise_perc = 10, noise_window = None):
+    """
+    Find the peaks (end of inspiration) in a normalised respiration timeseries.
+
+    Parameters
+    ----------
+    normalised_ts : np.ndarray
+        normalised (z-scored) respiration timeseries
+    method : str, default "cwt"
+        "cwt": scipy.signal.find_peaks_cwt. Slow on long recordings as the ridge line search runs over every sample.
+        "fast": the Ricker wavelet response (same as the CWT with a single width) is computed with an FFT on a decimated
+            copy of the signal, peaks are found with scipy.signal.find_peaks using `min_sample` as minimum distance and
+            `prominence`, filtered on signal-to-noise ratio like in the CWT method and finally refined on the wavelet
+            response at the full sampling rate.
+    widths : int or array, default 500
+        width(s) of the wavelet in samples. The "fast" method only uses the largest width.
+    min_sample : int, default 100
+        minimum number of samples between two peaks ("fast" only)
+    decimation : int, default None
+        decimation factor for the "fast" method. If None, chosen so that the largest width spans roughly 20 decimated samples.
+    prominence : float, default 0.5
+        minimum prominence of a peak in the (decimated) wavelet response ("fast" only)
+    min_snr, noise_perc : float, default 1 and 10
+        signal-to-noise filter of the peaks, same meaning as in scipy.signal.find_peaks_cwt ("fast" only)
+    noise_window : int, default None
+        samples of the window the noise floor of the signal-to-noise filter is estimated in (window_size of
+        scipy.signal.find_peaks_cwt). If None, 1/20th of the length of normalised_ts.
+
+    Returns
+    -------
+    peaks : np.ndarray
+        sorted sample indices of the peaks
+
+    Notes
+    -----
+    Tolerance: on synthetic respiration (300 Hz, 0.2 - 0.3 Hz breathing, widths = 100) the "fast" method returns the
+    same peak indices as "cwt" except for peaks whose signal-to-noise ratio lies within ~1% of `min_snr` (the noise
+    floor is estimated on the decimated response), which may be dropped or kept. It takes ~0.25 s on a one hour
+    recording, where "cwt" takes several minutes. Check the sanity check plots when switching method.
+    """
+    if method == "cwt":
+        return signal.find_peaks_cwt(normalised_ts, widths = widths, window_size = noise_window)
+
+    if method != "fast":
+        raise ValueError(f"Unknown peak detection method: {method}")
+
+    width = float(np.max(widths))
+
+    if decimation is None:
+        decimation = max(1, int(width // 20))
+
+    # decimate by averaging blocks of samples
+    n_blocks = len(normalised_ts) // decimation
+    decimated = normalised_ts[:n_blocks * decimation].reshape(n_blocks, decimation).mean(axis = 1)
+
+    response = ricker_response(decimated, width / decimation)
+    coarse, _ = signal.find_peaks(response, distance = max(1, min_sample // decimation), prominence = prominence)
+
+    # same signal-to-noise filter as find_peaks_cwt, the noise floor being the 10th percentile of the response in a
+    # window of noise_window samples (1/20th of the recording by default) around the peak. Only evaluated at the
+    # candidate peaks.
+    half_window = int(np.ceil(len(response) / 20 if noise_window is None else noise_window / decimation)) // 2
+    noise = np.array([np.percentile(response[max(peak - half_window, 0):peak + half_window + 1], noise_perc) for peak in coarse])
+    coarse = coarse[np.abs(response[coarse] / noise) >= min_snr]
+
+    if len(coarse) == 0:
+        return coarse
+
+    # refine on the wavelet response at full sampling rate
+    centres = coarse * decimation + decimation // 2
+    offsets = np.arange(-decimation, decimation + 1)
+    candidates = np.clip(centres[:, None] + offsets[None, :], 0, len(normalised_ts) - 1)
+
+    fine_response = ricker_response(normalised_ts, width, positions = candidates.ravel()).reshape(candidates.shape)
+    peaks = candidates[np.arange(len(candidates)), np.argmax(fine_response, axis = 1)]
+
+    return np.unique(peaks)
+
+
+def find_troughs(normalised_ts: np.ndarray, peaks: np.ndarray) -> np.ndarray:
+    """
+    Find the trough (minimum) between each pair of consecutive peaks.
+
+    All cycles are handled at once with a segmented minimum (np.minimum.reduceat). If the minimum is reached at several
+    samples within a cycle, the trough is placed at the (truncated) mean of those samples.
+
+    Parameters
+    ----------
+    normalised_ts : np.ndarray
+        normalised respiration timeseries
+    peaks : np.ndarray
+        strictly increasing sample indices of the peaks
+
+    Returns
+    -------
+    troughs : np.ndarray
+        sample indices of the troughs, one less than the number of peaks
+    """
+    peaks = np.asarray(peaks, dtype = int)
+
+    if len(peaks) < 2:
+        return np.array([], dtype = int)
+
+    segment_starts = peaks[:-1] - peaks[0]
+    segment_lengths = np.diff(peaks)
+    segments = normalised_ts[peaks[0]:peaks[-1]]
+
+    minima = np.minimum.reduceat(segments, segment_starts)
+
+    # positions of all samples equal to the minimum of their cycle (usually one per cycle)
+    min_positions = np.flatnonzero(segments == np.repeat(minima, segment_lengths))
+    cycle = np.searchsorted(segment_starts, min_positions, side = "right") - 1
+
+    counts = np.bincount(cycle, minlength = len(segment_starts))
+    sums = np.bincount(cycle, weights = min_positions - segment_starts[cycle], minlength = len(segment_starts))
+
+    return (sums / counts + peaks[:-1]).astype(int)
+
+
+def _fill_ramps(out: np.ndarray, starts: np.ndarray, lengths: np.ndarray, first: np.ndarray, last: float, max_samples: int = 2**16):
+    """
+    Write out[start:start + length] = np.linspace(first, last, length) for every segment, vectorised over groups of
+    segments covering about max_samples samples, so the index temporaries do not scale with the length of out.
+    """
+    keep = lengths > 0
+    starts, lengths, first = starts[keep], lengths[keep], first[keep]
+
+    cumulative = np.cumsum(lengths)
+    i = 0
+    while i < len(starts):
+        j = max(int(np.searchsorted(cumulative, cumulative[i] - lengths[i] + max_samples, side = "right")), i + 1)
+        _fill_ramp_group(out, starts[i:j], lengths[i:j], first[i:j], last)
+        i = j
+
+
+def _fill_ramp_group(out: np.ndarray, starts: np.ndarray, lengths: np.ndarray, first: np.ndarray, last: float):
+    # position within its segment for every sample covered by the segments
+    offsets = np.cumsum(lengths) - lengths
+    within = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        step = np.where(lengths > 1, (last - first) / (lengths - 1), 0)
+
+    values = within * np.repeat(step, lengths) + np.repeat(first, lengths)
+
+    # like np.linspace, the last sample is exactly the endpoint
+    ends = offsets + lengths - 1
+    values[ends[lengths > 1]] = last
+
+    out[np.repeat(starts, lengths) + within] = values
+
+
+def landmarks_to_phase(n_samples: int, peaks: np.ndarray, troughs: np.ndarray, dtype = np.float64) -> np.ndarray:
+    """
+    Calculate the continuous phase angle from peaks (phase 0) and troughs (phase pi).
+
+    The phase increases linearly from 0 to pi between a peak and the following trough, and from -pi to 0 between a
+    trough and the following peak. Samples before the first and after the last peak are NaN.
+
+    Parameters
+    ----------
+    n_samples : int
+        length of the timeseries
+    peaks : np.ndarray
+        sample indices of the peaks
+    troughs : np.ndarray
+        sample indices of the troughs, troughs[i] lying between peaks[i] and peaks[i + 1]
+    dtype : default np.float64
+        dtype of the phase angle, e.g. np.float32 to halve its memory
+
+    Returns
+    -------
+    phase_angle : np.ndarray
+    """
+    peaks = np.asarray(peaks, dtype = int)
+    troughs = np.asarray(troughs, dtype = int)
+
+    phase_angle = np.full(n_samples, np.nan, dtype = dtype)
+
+    # set troughs to pi and peaks to 0
+    phase_angle[troughs], phase_angle[peaks] = np.pi, 0
+
+    n_cycles = min(len(troughs), max(len(peaks) - 1, 0))
+    peak1, peak2, troughs = peaks[:n_cycles], peaks[1:n_cycles + 1], troughs[:n_cycles]
+
+    # interpolate the phase angle between peaks and troughs
+    with np.errstate(divide = "ignore"):
+        _fill_ramps(phase_angle, peak1, troughs - peak1, np.pi / (troughs - peak1), np.pi)
+        _fill_ramps(phase_angle, troughs, peak2 - troughs, -np.pi + np.pi / (peak2 - troughs), 0)
+
+    return phase_angle
+
+
+def _blocks(n_samples: int, block_size: int):
+    return (slice(start, start + block_size) for start in range(0, n_samples, block_size))
+
+
+def nan_mean_std(ts: np.ndarray, block_size: int = 2**16):
+    """
+    Mean and standard deviation (ddof 0) ignoring NaN, as np.nanmean and np.nanstd, accumulated in float64 block by
+    block so no temporaries of the length of ts are made.
+    """
+    n, total = 0, 0.
+    for block in _blocks(len(ts), block_size):
+        values = ts[block][~np.isnan(ts[block])]
+        n += len(values)
+        total += values.sum(dtype = np.float64)
+
+    mean = total / n if n else np.nan
+
+    squares = 0.
+    for block in _blocks(len(ts), block_size):
+        deviations = ts[block][~np.isnan(ts[block])].astype(np.float64) - mean
+        squares += deviations @ deviations
+
+    return mean, np.sqrt(squares / n) if n else np.nan
+
+
+def interpolate_nans(ts: np.ndarray, block_size: int = 2**16) -> int:
+    """
+    Linear interpolation of the NaN runs of ts, in place. Leading and trailing runs are extrapolated from the first
+    and last two valid samples (like interpolate.interp1d with fill_value = "extrapolate"). Only the NaN samples and
+    the valid samples next to them are evaluated.
+
+    Returns
+    -------
+    int
+        number of interpolated samples
+    """
+    nan_idx = np.concatenate([np.flatnonzero(np.isnan(ts[block])) + block.start for block in _blocks(len(ts), block_size)] or [np.array([], dtype = int)])
+
+    if len(nan_idx) == 0:
+        return 0
+    if len(nan_idx) == len(ts):
+        raise ValueError("Cannot interpolate a timeseries without valid samples")
+
+    breaks = np.flatnonzero(np.diff(nan_idx) > 1)
+    run_starts = nan_idx[np.concatenate([[0], breaks + 1])]
+    run_stops = nan_idx[np.concatenate([breaks, [-1]])] + 1
+
+    # the valid samples on either side of the runs
+    anchors = np.unique(np.concatenate([run_starts - 1, run_stops]))
+    anchors = anchors[(anchors >= 0) & (anchors < len(ts))]
+    values = np.interp(nan_idx, anchors, ts[anchors].astype(np.float64))
+
+    def valid_after(i):
+        # first valid sample from i onwards (i is at most the start of a NaN run)
+        j = np.searchsorted(run_starts, i)
+        return run_stops[j] if j < len(run_starts) and run_starts[j] == i else i
+
+    def valid_before(i):
+        # last valid sample up to i (i is at least the end of a NaN run)
+        j = np.searchsorted(run_stops, i + 1)
+        return run_starts[j] - 1 if j < len(run_stops) and run_stops[j] == i + 1 else i
+
+    # np.interp holds the end values constant, the edge runs are extrapolated instead
+    edges = []
+    if run_starts[0] == 0:
+        edges.append((nan_idx < anchors[0], anchors[0], valid_after(anchors[0] + 1)))
+    if run_stops[-1] == len(ts):
+        edges.append((nan_idx > anchors[-1], valid_before(anchors[-1] - 1), anchors[-1]))
+
+    for edge, x0, x1 in edges:
+        if 0 <= x0 < x1 < len(ts):
+            y0, y1 = float(ts[x0]), float(ts[x1])
+            values[edge] = y0 + (nan_idx[edge] - x0) * (y1 - y0) / (x1 - x0)
+
+    ts[nan_idx] = values
+
+    return len(nan_idx)
+
+
+def extract_phase_angle(resp_timeseries:np.array, widths = 500, min_sample = 100, peak_method = "cwt", figpath = None, dtype = None, copy = True):
     """ 
     Extracts continuous phase angle for respiration data by running an adapted peak detection algorithm
 
@@ -150,92 +544,456 @@ def extract_phase_angle(resp_timeseries:np.array, widths = 500, min_sample = 100
     resp_timeseries : np.array
         an array with the respiratory measurements
 
+    widths : int or array, default 500
+        width(s) in samples used for peak detection
+
+    min_sample : int, default 100
+        minimum number of samples between peaks (only used by the "fast" peak detection method)
+
+    peak_method : str, default "cwt"
+        peak detection method, see find_respiration_peaks
+
     figpath : str or pathlike, default None
         If provided, a plot useful for sanity check of extraction of phase angle is generated and saved to destination
 
+    dtype : default None
+        dtype of the normalised timeseries and the phase angle, e.g. np.float32 to halve the memory. Float64 (or the
+        floating dtype of resp_timeseries) if None.
+
+    copy : bool, default True
+        if False and resp_timeseries is a writable array of the dtype, it is cleaned and normalised in place (and
+        returned as normalised_ts) rather than copied. A conversion to dtype is always a new array.
+
     returns 
         normalised_ts, peaks, troughs, phase_angle
+
+    Notes
+    -----
+    Outlier removal, interpolation and normalisation work in place on a single buffer in blocks (statistics are
+    accumulated in float64), so besides the phase angle no other arrays of the length of the recording are made.
     """
-    r = resp_timeseries.copy()
+    if dtype is None:
+        dtype = resp_timeseries.dtype if np.issubdtype(resp_timeseries.dtype, np.floating) else np.float64
+    r = np.asarray(resp_timeseries, dtype = dtype)
+    if (copy and np.may_share_memory(r, resp_timeseries)) or not r.flags.writeable:
+        r = r.copy()
+    block_size = 2**16
 
     # normalise timeseries and set outliers to NaN
-    z_scores = np.abs((r - np.nanmean(r)) / np.nanstd(r))
-    print(f"Found {sum(z_scores > 2.5)} outliers")
-    r[z_scores > 2.5] = np.nan
+    with stage("outliers", **array_sizes(resp_timeseries = r)):
+        mean, std = nan_mean_std(r, block_size)
+        n_outliers = 0
+        for block in _blocks(len(r), block_size):
+            with np.errstate(invalid = "ignore"):
+                outliers = np.abs((r[block] - mean) / std) > 2.5
+            n_outliers += int(outliers.sum())
+            r[block][outliers] = np.nan
+        print(f"Found {n_outliers} outliers")
     
     # linear interpolation of outlier segments
-    nans = np.isnan(r)
-    x_vals = np.where(~nans)[0]
-    y_vals = r[~nans]
-    interpolated_values = interpolate.interp1d(x_vals, y_vals, kind='linear', fill_value="extrapolate")
-    r[nans] = interpolated_values(np.where(nans)[0])
-    print("Done with linear interpolation of NaN")
+    with stage("interpolate"):
+        interpolate_nans(r, block_size)
+        print("Done with linear interpolation of NaN")
 
     # normalize the interpolated time series
-    normalised_ts = (r - np.nanmean(r)) / np.nanstd(r)
-    print("Done normalising")
+    with stage("normalise"):
+        mean, std = nan_mean_std(r, block_size)
+        for block in _blocks(len(r), block_size):
+            r[block] -= mean
+            r[block] /= std
+        normalised_ts = r
+        print("Done normalising")
 
     # finding peaks and troughs
     print("Looking for peaks - this may take a while")
-    peaks = signal.find_peaks_cwt(normalised_ts, widths = widths)#, distance = min_sample)
-    # old way of doing it -> peaks = signal.find_peaks(normalised_ts)[0] figure out what works best on data!!
+    with stage("find_peaks", method = peak_method, widths = widths) as record:
+        peaks = find_respiration_peaks(normalised_ts, method = peak_method, widths = widths, min_sample = min_sample)
+        # old way of doing it -> peaks = signal.find_peaks(normalised_ts)[0] figure out what works best on data!!
+        record["n_peaks"] = len(peaks)
 
     print("Done looking for peaks")
-    troughs = np.array([], dtype = int)
 
-    for peak1, peak2 in zip(peaks, peaks[1:]):                  # finding the troughs -> the minimum between the peaks
-        tmp_resp = normalised_ts[peak1:peak2]                   # respiration time course between the peaks
+    # finding the troughs -> the minimum between the peaks
+    with stage("find_troughs"):
+        troughs = find_troughs(normalised_ts, peaks)
+
+    # calculate the phase angle
+    with stage("phase") as record:
+        phase_angle = landmarks_to_phase(len(normalised_ts), peaks, troughs, dtype = dtype)
+        record.update(array_sizes(phase_angle = phase_angle))
+
+    if figpath:
+        sanity_check_phase_angle(resp_timeseries, normalised_ts, peaks, troughs, phase_angle, figpath)
 
-        # DIFFERENT WAYS OF FINDING TROUGH
+    return normalised_ts, peaks, troughs, phase_angle
 
-        # take the index in the middle between the two peaks
-        #trough_ind = peak2 - peak1
 
-        # finding minimum between two peaks
-        trough_ind_tmp = np.where(tmp_resp == min(tmp_resp))
-        try:
-            trough_ind = int(trough_ind_tmp[0] + peak1)                # get the index relative to the entire time series
-        except TypeError:
-            trough_ind = int(np.mean(trough_ind_tmp[0]) + peak1) 
 
+def _update_stats(stats: tuple, values: np.ndarray) -> tuple:
+    """
+    Merges the non-NaN values into running (count, mean, sum of squared deviations), with the pairwise update of
+    Chan et al.
+    """
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return stats
 
-        # other ways??
+    n, mean, m2 = stats
+    block_mean = values.mean(dtype = np.float64)
+    block_m2 = np.sum((values - block_mean)**2, dtype = np.float64)
 
+    total = n + len(values)
+    delta = block_mean - mean
 
-        troughs = np.append(troughs, trough_ind) 
+    return total, mean + delta * len(values) / total, m2 + block_m2 + delta**2 * n * len(values) / total
 
-    # calculate the phase angle
-    phase_angle = np.zeros(len(normalised_ts))
-    phase_angle[:] = np.nan # fill with nans
-    
-    # set troughs to pi and peaks to 0
-    phase_angle[troughs], phase_angle[peaks] = np.pi, 0
 
-    # interpolate the phase angle between peaks and troughs
-    for peak1, peak2, trough in zip(peaks, peaks[1:], troughs):
-        phase_angle[peak1:trough] = np.linspace(0 + np.pi/(trough-peak1), np.pi,  trough-peak1)
-        phase_angle[trough:peak2] = np.linspace(-np.pi + np.pi/(peak2-trough), 0, peak2-trough)
+def _stats_mean_std(stats: tuple):
+    n, mean, m2 = stats
+    return (mean, np.sqrt(m2 / n)) if n else (np.nan, np.nan)
 
-    if figpath:
-        sanity_check_phase_angle(resp_timeseries, normalised_ts, peaks, troughs, phase_angle, figpath)
 
-    return normalised_ts, peaks, troughs, phase_angle
+def _iter_blocks(resp_timeseries, block_size: int):
+    # arrays (e.g. memory maps) are read block by block, anything else is taken to be an iterable of blocks
+    if isinstance(resp_timeseries, np.ndarray):
+        for block in _blocks(len(resp_timeseries), block_size):
+            yield resp_timeseries[block]
+    else:
+        yield from resp_timeseries
+
+
+def _iter_cleaned(blocks, dtype, stats = None, threshold = 2.5):
+    """
+    Sets outliers to NaN and interpolates them as extract_phase_angle does, block by block. A NaN run at the end of a
+    block is held back until the next valid sample (or extrapolated at the end of the recording).
+
+    stats:
+        (mean, std) of the raw signal for the outlier threshold, or None for the running statistics of the samples
+        seen so far
+    """
+    running = (0, 0., 0.)
+    carry, n_anchor = np.empty(0, dtype = dtype), 0 # carry starts with the last valid sample yielded (the anchor)
+    emitted = 0
+    last_valid = {} # position to value of the last two valid samples
+
+    for block in blocks:
+        block = np.array(block, dtype = dtype)
+
+        if stats is None:
+            running = _update_stats(running, block)
+        mean, std = _stats_mean_std(running) if stats is None else stats
+
+        with np.errstate(invalid = "ignore"):
+            block[np.abs((block - mean) / std) > threshold] = np.nan
+
+        work = np.concatenate([carry, block])
+        valid = np.flatnonzero(~np.isnan(work))
+
+        # a leading NaN run is extrapolated from the first two valid samples of the recording
+        if len(valid) < (1 if n_anchor else 2):
+            carry = work
+            continue
+
+        base = emitted - n_anchor
+        end = valid[-1] + 1
+        out = work[:end]
+        interpolate_nans(out)
+
+        for i in valid[-2:]:
+            last_valid[base + i] = work[i]
+        last_valid = dict(sorted(last_valid.items())[-2:])
 
+        if end > n_anchor:
+            yield out[n_anchor:]
+            emitted += end - n_anchor
+        carry, n_anchor = work[end - 1:].copy(), 1 # the yielded blocks may be changed in place
 
+    if len(carry) == n_anchor:
+        return
 
-def sanity_check_phase_angle(resp_timeseries = None, normalised_ts = None, peaks = None, troughs = None, phase_angle = None, savepath = None):
+    if n_anchor == 0: # fewer than two valid samples in the whole recording
+        interpolate_nans(carry)
+        yield carry
+        return
+
+    # trailing NaN run, extrapolated from the last two valid samples like interpolate_nans does
+    (x0, y0), (x1, y1) = [(x, float(y)) for x, y in last_valid.items()]
+    positions = emitted + np.arange(len(carry) - 1)
+    yield (y0 + (positions - x0) * (y1 - y0) / (x1 - x0)).astype(dtype)
+
+
+def iter_phase_angle(resp_timeseries, chunk_size = 2**19, overlap = None, widths = 500, min_sample = 100, peak_method = "fast", noise_window = None, statistics = "global", dtype = np.float32, block_size = 2**16):
+    """
+    Streaming version of extract_phase_angle, for recordings too long to hold in memory (e.g. several concatenated
+    sessions). The signal is cleaned and normalised block by block and the peaks are detected in overlapping windows
+    of chunk_size samples. Each window only contributes the peaks in its core, the window without overlap / 2 samples
+    on either side, and the cores tile the recording, so no peak is lost or found twice at window edges. Troughs
+    spanning two windows are tracked with a running minimum.
+
+    Memory is bounded by chunk_size (plus the longest outlier run); the phase is yielded up to the last peak found.
+
+    Parameters
+    ----------
+    resp_timeseries : np.ndarray or iterable of np.ndarray
+        the respiration, e.g. a memory map, or an iterable of consecutive blocks (e.g. read from several files)
+    chunk_size : int, default 2**19
+        samples per peak detection window
+    overlap : int, default None
+        samples shared by consecutive windows, by default noise_window + 10 widths, so the peaks in the cores are
+        detected as if the window was the whole recording
+    widths, min_sample, peak_method :
+        see extract_phase_angle. Defaults to the "fast" method
+    noise_window : int, default None
+        see find_respiration_peaks. By default 1/20th of the recording as in extract_phase_angle, but at most
+        chunk_size / 4 (and chunk_size / 4 for iterables of unknown length)
+    statistics : str, default "global"
+        "global": the outlier threshold and normalisation use the statistics of the whole recording, like
+            extract_phase_angle, which takes two extra passes over resp_timeseries (an array)
+        "running": the statistics of the samples seen so far, in a single pass, for iterables
+    dtype : default np.float32
+        dtype of the normalised signal and the phase angle
+    block_size : int, default 2**16
+        samples read at a time from an array
+
+    Yields
+    ------
+    start : int
+        sample index of the first sample of phase
+    phase : np.ndarray
+        the phase angle of consecutive samples, covering the whole recording over all iterations
+    peaks, troughs : np.ndarray
+        sample indices of the peaks and troughs confirmed in this iteration
+
+    Notes
+    -----
+    With statistics = "global" and the default overlap, the landmarks (and so the phase) are the same as those of
+    find_respiration_peaks on the normalised recording with the same noise_window. That is the result of
+    extract_phase_angle as long as 1/20th of the recording fits in chunk_size / 4 (recordings up to ~2.4 hours at
+    300 Hz with the default chunk_size); longer recordings get a local noise floor. With statistics = "running" the
+    outlier threshold and the prominence of the "fast" method depend on the statistics at the time, so the
+    landmarks of the first minutes may differ.
+    """
+    if statistics not in ("global", "running"):
+        raise ValueError(f"Unknown statistics: {statistics}")
+
+    is_array = isinstance(resp_timeseries, np.ndarray)
+    if statistics == "global" and not is_array:
+        raise ValueError('statistics = "global" needs the recording as an array, use "running" for iterables')
+
+    width = float(np.max(widths))
+    decimation = max(1, int(width // 20)) if peak_method == "fast" else 1
+
+    if noise_window is None:
+        noise_window = min(int(np.ceil(len(resp_timeseries) / 20)), chunk_size // 4) if is_array else chunk_size // 4
+    if overlap is None:
+        overlap = noise_window + int(10 * width)
+
+    # windows start at multiples of the decimation, so the "fast" method averages the same blocks as on the recording
+    margin = -(-(overlap // 2) // decimation) * decimation
+    step = (chunk_size - 2 * margin) // decimation * decimation
+    if step <= 0:
+        raise ValueError(f"chunk_size ({chunk_size}) has to be larger than the overlap ({2 * margin})")
+
+    def normalised_blocks():
+        if statistics == "running":
+            running = (0, 0., 0.)
+            for block in _iter_cleaned(_iter_blocks(resp_timeseries, block_size), dtype):
+                running = _update_stats(running, block)
+                mean, std = _stats_mean_std(running)
+                yield (block - mean) / std
+            return
+
+        raw_stats = nan_mean_std(resp_timeseries, block_size)
+
+        clean_stats = (0, 0., 0.)
+        for block in _iter_cleaned(_iter_blocks(resp_timeseries, block_size), dtype, raw_stats):
+            clean_stats = _update_stats(clean_stats, block)
+        mean, std = _stats_mean_std(clean_stats)
+
+        for block in _iter_cleaned(_iter_blocks(resp_timeseries, block_size), dtype, raw_stats):
+            block -= mean
+            block /= std
+            yield block
+
+    # landmarks not yet turned into phase (from the last peak emitted) and the running minimum since the last peak
+    peaks, troughs = [], []
+    minimum = [np.inf, 0., 0] # value, summed offsets from the last peak of the samples at the minimum, their count
+    emitted = 0
+
+    def track_minimum(values, start):
+        if len(peaks) == 0 or len(values) == 0:
+            return
+        value = values.min()
+        if value <= minimum[0]:
+            at_minimum = np.flatnonzero(values == value) + start - peaks[-1]
+            if value < minimum[0]:
+                minimum[:] = [value, 0., 0]
+            minimum[1] += at_minimum.sum(dtype = np.float64)
+            minimum[2] += len(at_minimum)
+
+    def process(window, window_start, core_start, core_end):
+        found = find_respiration_peaks(window, method = peak_method, widths = widths, min_sample = min_sample, noise_window = noise_window)
+        found = np.asarray(found, dtype = int) + window_start
+        found = found[(found >= core_start) & (found < core_end)]
+
+        if len(found) == 0:
+            track_minimum(window[core_start - window_start:core_end - window_start], core_start)
+            return np.array([], dtype = int), np.array([], dtype = int)
+
+        # the trough between the last peak of the earlier windows and the first new one
+        new_troughs = []
+        track_minimum(window[core_start - window_start:found[0] - window_start], core_start)
+        if len(peaks) > 0:
+            new_troughs.append(int(minimum[1] / minimum[2] + peaks[-1]))
+
+        # troughs between the new peaks are all within the window
+        new_troughs.extend(find_troughs(window, found - window_start) + window_start)
+
+        peaks.extend(found)
+        troughs.extend(new_troughs)
+        minimum[:] = [np.inf, 0., 0]
+        track_minimum(window[found[-1] - window_start:core_end - window_start], found[-1])
+
+        return found, np.array(new_troughs, dtype = int)
+
+    def emit(stop, final = False):
+        # phase of the samples from emitted up to the last peak (up to stop at the end of the recording)
+        nonlocal peaks, troughs, emitted
+        last = peaks[-1] if len(peaks) > 0 else emitted
+        n_samples = stop - emitted if final else last - emitted
+
+        if n_samples <= 0:
+            return None
+
+        phase = landmarks_to_phase(n_samples, np.array(peaks) - emitted, np.array(troughs, dtype = int) - emitted, dtype = dtype) if final else \
+            landmarks_to_phase(n_samples + 1, np.array(peaks) - emitted, np.array(troughs, dtype = int) - emitted, dtype = dtype)[:-1]
+        start, emitted = emitted, emitted + n_samples
+        peaks, troughs = peaks[-1:], []
+
+        return start, phase
+
+    buffer, buffer_start = np.empty(0, dtype = dtype), 0
+
+    for block in normalised_blocks():
+        buffer = np.concatenate([buffer, block])
+
+        while len(buffer) >= step + 2 * margin:
+            core_start = buffer_start + margin if buffer_start > 0 else 0
+            new_peaks, new_troughs = process(buffer[:step + 2 * margin], buffer_start, core_start, buffer_start + step + margin)
+
+            emitted_phase = emit(None)
+            if emitted_phase is not None:
+                yield emitted_phase + (new_peaks, new_troughs)
+            elif len(new_peaks) or len(new_troughs):
+                yield emitted, np.empty(0, dtype = dtype), new_peaks, new_troughs
+
+            buffer, buffer_start = buffer[step:], buffer_start + step
+
+    # the last window, its core reaching the end of the recording
+    stop = buffer_start + len(buffer)
+    core_start = buffer_start + margin if buffer_start > 0 else 0
+    new_peaks, new_troughs = process(buffer, buffer_start, core_start, stop) if stop > core_start else (np.array([], dtype = int), np.array([], dtype = int))
+
+    emitted_phase = emit(stop, final = True)
+    if emitted_phase is not None:
+        yield emitted_phase + (new_peaks, new_troughs)
+
+
+def extract_phase_angle_streaming(resp_timeseries, out = None, **kwargs):
+    """
+    Runs iter_phase_angle and collects the phase angle, e.g. into a memory map on disk.
+
+    Parameters
+    ----------
+    resp_timeseries : np.ndarray or iterable of np.ndarray
+        see iter_phase_angle
+    out : np.ndarray, default None
+        array of the length of the recording the phase angle is written to, e.g. np.lib.format.open_memmap(...).
+        If None, a new array.
+    **kwargs
+        passed on to iter_phase_angle
+
+    Returns
+    -------
+    peaks, troughs, phase_angle
+    """
+    peaks, troughs, phases = [], [], []
+
+    for start, phase, new_peaks, new_troughs in iter_phase_angle(resp_timeseries, **kwargs):
+        if out is None:
+            phases.append(phase)
+        else:
+            out[start:start + len(phase)] = phase
+        peaks.append(new_peaks)
+        troughs.append(new_troughs)
+
+    phase_angle = np.concatenate(phases) if out is None else out
+
+    return np.concatenate(peaks).astype(int), np.concatenate(troughs).astype(int), phase_angle
+
+
+def minmax_decimate(ts: np.ndarray, n_bins: int):
+    """
+    Reduces a timeseries to the minimum and maximum of each of n_bins equally sized bins, kept in their original
+    order. Plotted as a line this looks the same as the full timeseries at a resolution of n_bins pixels, and
+    peaks and troughs stay visible.
+
+    NaNs are ignored, bins with only NaNs give NaN (a gap in the line).
+
+    Returns
+    -------
+    x : np.ndarray
+        sample indices of the kept points
+    y : np.ndarray
+        values of the kept points
+    """
+    ts = np.asarray(ts, dtype = float)
+    bin_size = int(np.ceil(len(ts) / n_bins))
+
+    if bin_size <= 2:
+        return np.arange(len(ts)), ts
+
+    n_bins = int(np.ceil(len(ts) / bin_size))
+    padded = np.full(n_bins * bin_size, np.nan)
+    padded[:len(ts)] = ts
+    bins = padded.reshape(n_bins, bin_size)
+
+    nans = np.isnan(bins)
+    argmin = np.argmin(np.where(nans, np.inf, bins), axis = 1)
+    argmax = np.argmax(np.where(nans, -np.inf, bins), axis = 1)
+
+    x = np.sort(np.column_stack([argmin, argmax]), axis = 1) + (np.arange(n_bins) * bin_size)[:, np.newaxis]
+    x = x.ravel()
+    x = x[x < len(ts)]
+
+    return x, ts[x]
+
+
+def sanity_check_phase_angle(resp_timeseries = None, normalised_ts = None, peaks = None, troughs = None, phase_angle = None, savepath = None, max_points = None):
+    """
+    Plots the timeseries with the detected peaks and troughs, and the phase angle.
+
+    Long timeseries are min/max decimated (see minmax_decimate) to roughly the pixel width of the figure before
+    plotting, which gives the same picture at a fraction of the rendering time and memory.
+
+    max_points:
+        number of bins used for decimation. Defaults to the width of the figure in pixels.
+    """
     fig, axes = plt.subplots(2, 1, figsize = (40, 4), dpi = 300)
 
+    if max_points is None:
+        max_points = int(fig.get_figwidth() * fig.dpi)
+
     for var, label, color in zip([resp_timeseries, normalised_ts], ["original timeseries", "normalised interpolated timeseries"], ["darkblue", "forestgreen", "k"]):
         if var is not None:
-            axes[0].plot(var, label = label, linewidth=1, color = color, alpha = 0.6)
+            axes[0].plot(*minmax_decimate(var, max_points), label = label, linewidth=1, color = color, alpha = 0.6)
     
     for var, label in zip([peaks, troughs], ["peaks", "troughs"]):
-        tmp_y = [normalised_ts[i] for i in var]
-        axes[0].scatter(var, tmp_y, zorder=1, alpha=0.5, s=2, label = label)
+        var = np.asarray(var, dtype = int)
+        axes[0].scatter(var, normalised_ts[var], zorder=1, alpha=0.5, s=2, label = label)
 
     if phase_angle is not None: 
-        axes[1].plot(phase_angle, color = "grey", linewidth = 1)
+        axes[1].plot(*minmax_decimate(phase_angle, max_points), color = "grey", linewidth = 1)
         axes[1].set_ylabel("phase angle")
 
     axes[0].legend()
@@ -247,35 +1005,108 @@ def sanity_check_phase_angle(resp_timeseries = None, normalised_ts = None, peaks
 
     if savepath:
         plt.savefig(savepath)
+        plt.close(fig)
 
     else:
         return fig, axes
 
 
-def summary_plots(peaks, troughs, phase_angle, savepath = None):
-    fig, axes = plt.subplots(2, 2, figsize = (10, 8), dpi = 300, sharey = "row")
+_figure_executor = None
 
-    # time between peaks and troughs
-    peak_to_trough = []
-    trough_to_peak = []
-    peak_to_peak = []
-    trough_to_trough = []
+def _render(plot_func, *args, **kwargs):
+    plot_func(*args, **kwargs)
+    plt.close("all")
+
+
+def render_deferred(plot_func, *args, **kwargs) -> Future:
+    """
+    Runs a plotting function that saves its figure (e.g. sanity_check_phase_angle with a savepath) in a separate
+    process, so the caller does not wait for rendering. Figures are rendered one at a time in the order submitted.
+
+    Returns
+    -------
+    concurrent.futures.Future
+        call .result() to wait for the figure (and get any exception raised while plotting)
+    """
+    global _figure_executor
 
-    hz = 1/100
+    if _figure_executor is None:
+        _figure_executor = ProcessPoolExecutor(max_workers = 1, initializer = matplotlib.use, initargs = ("Agg",))
 
-    for peak, trough in zip(peaks, troughs):
-        peak_to_trough.append((trough - peak)*hz)
+    return _figure_executor.submit(_render, plot_func, *args, **kwargs)
 
-    for peak, trough in zip(peaks[1:], troughs):
-        trough_to_peak.append((peak - trough)*hz)
 
-    for peak1, peak2 in zip(peaks, peaks[1:]):
-        peak_to_peak.append((peak2 - peak1)*hz)
+def cycle_statistics(peaks: np.ndarray, troughs: np.ndarray, sfreq: float, peak_values: np.ndarray = None, trough_values: np.ndarray = None, window: int = 10) -> pd.DataFrame:
+    """
+    Statistics of each breathing cycle, from peak i (end of inspiration) over trough i to peak i + 1, in one
+    vectorised pass over the landmarks.
 
-    for trough1, trough2 in zip(troughs, troughs[1:]):
-        trough_to_trough.append((trough2 - trough1)*hz)
+    Parameters
+    ----------
+    peaks : np.ndarray
+        sample positions of the peaks
+    troughs : np.ndarray
+        sample positions of the troughs, troughs[i] lying between peaks[i] and peaks[i + 1]
+    sfreq : float
+        sample rate the positions are in
+    peak_values, trough_values : np.ndarray, default None
+        respiration at the peaks and troughs (e.g. normalised_ts[peaks]), for the amplitudes
+    window : int, default 10
+        number of cycles of the (centred) rolling variability
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per peak: cycle, peak and trough (samples), time (of the peak in seconds), the durations in seconds
+        peak_to_trough (expiration), trough_to_peak (inspiration), peak_to_peak (the cycle) and trough_to_trough,
+        ie_ratio (inspiration / expiration duration), rate (breaths per minute), amplitude (peak - trough) and
+        rolling_std and rolling_cv (standard deviation and coefficient of variation of peak_to_peak over window
+        cycles). Durations that need a landmark after the last one are NaN.
+    """
+    peaks = np.asarray(peaks, dtype = float)
+    troughs = np.asarray(troughs, dtype = float)
+    n = len(peaks)
+
+    def padded(values, length = n):
+        out = np.full(length, np.nan)
+        out[:min(len(values), length)] = values[:length]
+        return out
+
+    # landmark i + 1 of each cycle i, NaN after the last one
+    trough = padded(troughs)
+    next_peak, next_trough = padded(peaks[1:]), padded(troughs[1:])
+
+    table = pd.DataFrame({
+        "cycle": np.arange(n),
+        "peak": peaks,
+        "trough": trough,
+        "time": peaks / sfreq,
+        "peak_to_trough": (trough - peaks) / sfreq,
+        "trough_to_peak": (next_peak - trough) / sfreq,
+        "peak_to_peak": (next_peak - peaks) / sfreq,
+        "trough_to_trough": (next_trough - trough) / sfreq,
+        })
+
+    table["ie_ratio"] = table["trough_to_peak"] / table["peak_to_trough"]
+    table["rate"] = 60 / table["peak_to_peak"]
+    table["amplitude"] = padded(peak_values) - padded(trough_values) if peak_values is not None and trough_values is not None else np.nan
+
+    rolling = table["peak_to_peak"].rolling(window, center = True, min_periods = 2)
+    table["rolling_std"] = rolling.std()
+    table["rolling_cv"] = table["rolling_std"] / rolling.mean()
+
+    return table
+
+
+def summary_plots(peaks, troughs, phase_angle, savepath = None, sfreq = 300):
+    fig, axes = plt.subplots(2, 2, figsize = (10, 8), dpi = 300, sharey = "row")
 
-    for ax, data, label in zip(axes.flatten(), [peak_to_trough, trough_to_peak, peak_to_peak, trough_to_trough], ["peak and trough", "trough and peak", "peaks", "troughs"]):
+    # time between peaks and troughs
+    table = cycle_statistics(peaks, troughs, sfreq)
+    columns = ["peak_to_trough", "trough_to_peak", "peak_to_peak", "trough_to_trough"]
+
+    for ax, column, label in zip(axes.flatten(), columns, ["peak and trough", "trough and peak", "peaks", "troughs"]):
+        data = table[column].dropna()
         ax.scatter(range(len(data)), data, s=2)
         ax.set_title(f"Time between {label}")
         ax.set_ylabel("Time (s)")
@@ -292,36 +1123,40 @@ def phase_angle_events(phase_angles: np.ndarray, events: np.ndarray, hz: int, ev
     Collects phase angle events and returns a DataFrame.
 
     Args:
-        phase_angles (np.ndarray): Array of phase angles.
+        phase_angles (np.ndarray or landmarks.CycleLandmarks): Array of phase angles, or the landmarks the phase is
+            evaluated from at the event samples (at the same sample rate).
         events (np.ndarray): Array of events, where each event contains sample, _, trigger.
         hz (int): sample rate.
         event_ids (dict, optional): Mapping of event names to trigger values.
 
     Returns:
-        pd.DataFrame: DataFrame containing phase angles, triggers, and optional event names.
+        pd.DataFrame: DataFrame containing phase angles, triggers, and optional event names (categorical, "Unknown" for triggers not in event_ids).
     """
 
-    data = []
+    events = np.asarray(events)
+    samples, triggers = events[:, 0], events[:, 2]
 
-    for event in events:
-        sample, _, trigger = event
-        if sample < len(phase_angles):
-            new_data = {
-                "phase_angle": phase_angles[sample],
-                "trigger": trigger,
-                f"sample_{hz}": sample
-            }
-            data.append(new_data)
-        else:
-            print(f"Failed on sample {sample}, length of phase angle: {len(phase_angles)}")
+    landmarks = hasattr(phase_angles, "phase_at")
+    n_samples = phase_angles.n_samples if landmarks else len(phase_angles)
+
+    in_range = samples < n_samples
+    for sample in samples[~in_range]:
+        print(f"Failed on sample {sample}, length of phase angle: {n_samples}")
 
-    df = pd.DataFrame(data)
+    samples, triggers = samples[in_range], triggers[in_range]
+
+    df = pd.DataFrame({
+        "phase_angle": phase_angles.phase_at(samples) if landmarks else phase_angles[samples],
+        "trigger": triggers,
+        f"sample_{hz}": samples
+        })
 
     if event_ids:
-        # Create reverse mapping from trigger to event name
-        trigger_to_event = {v: k for k, v in event_ids.items()}
-        
-        df["event"] = df["trigger"].map(trigger_to_event).fillna("Unknown")
+        # Create reverse mapping from trigger to event name, as integer codes into the categories
+        categories = list(event_ids) + ["Unknown"]
+        trigger_codes = pd.Index(list(event_ids.values())).get_indexer(triggers)
+        trigger_codes[trigger_codes == -1] = len(categories) - 1
 
-    return df
+        df["event"] = pd.Categorical.from_codes(trigger_codes, categories = categories)
 
+    return df
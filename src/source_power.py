@@ -0,0 +1,272 @@
+"""
+Induced power in volume source space labels (e.g. the cerebellar AAL regions), computed from epochs on disk.
+
+Rather than transforming every source time course, the Morlet transform is computed once on the sensor data and
+projected into each label: the summed power of the sources of a label is ||K Y||^2 where K is the label's rows of
+the inverse kernel and Y the complex sensor transform, and K is replaced by its (rank truncated) S V^T from an SVD,
+which has at most as many rows as there are channels. Tasks of label groups x frequency blocks run in a process pool.
+"""
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import mne
+import numpy as np
+from mne.minimum_norm import apply_inverse
+from mne.time_frequency import tfr_array_morlet
+from epoching import EpochStore
+
+
+# atlas values of the cerebellar regions in the AAL atlas (ROI_MNI_V4.txt)
+AAL_CEREBELLUM = {
+    "Cerebelum_Crus1_L": 9001, "Cerebelum_Crus1_R": 9002,
+    "Cerebelum_Crus2_L": 9011, "Cerebelum_Crus2_R": 9012,
+    "Cerebelum_3_L": 9021, "Cerebelum_3_R": 9022,
+    "Cerebelum_4_5_L": 9031, "Cerebelum_4_5_R": 9032,
+    "Cerebelum_6_L": 9041, "Cerebelum_6_R": 9042,
+    "Cerebelum_7b_L": 9051, "Cerebelum_7b_R": 9052,
+    "Cerebelum_8_L": 9061, "Cerebelum_8_R": 9062,
+    "Cerebelum_9_L": 9071, "Cerebelum_9_R": 9072,
+    "Cerebelum_10_L": 9081, "Cerebelum_10_R": 9082,
+}
+
+
+def setup_label_source_space(subject: str, subjects_dir, atlas, labels: list, atlas_lut: dict = None, pos = 5., bem = None, n_jobs = None):
+    """
+    Volume source space with one source space per label of an atlas volume in the subject's MRI space.
+
+    Parameters
+    ----------
+    atlas : str or pathlike
+        label volume (.mgz), e.g. the AAL atlas warped to the subject
+    labels : list of str
+        label names
+    atlas_lut : dict, default None
+        label name to atlas value, AAL_CEREBELLUM if None
+    pos : float, default 5.
+        grid spacing in mm
+    """
+    atlas_lut = AAL_CEREBELLUM if atlas_lut is None else atlas_lut
+
+    return mne.setup_volume_source_space(
+        subject, pos = pos, mri = str(atlas), bem = bem, subjects_dir = subjects_dir,
+        volume_label = {label: atlas_lut[label] for label in labels}, add_interpolator = False, n_jobs = n_jobs, verbose = False
+        )
+
+
+def label_slices(src, labels: list = None) -> dict:
+    """
+    Label name to the slice of its sources in the source order of src (and so of the inverse kernel). With labels,
+    source spaces without a "seg_name" (e.g. made from a sphere, or read back from a file) are named in order.
+    """
+    slices, start = {}, 0
+
+    for i, space in enumerate(src):
+        name = space.get("seg_name") or labels[i]
+        slices[name] = slice(start, start + int(space["nuse"]))
+        start += int(space["nuse"])
+
+    return slices
+
+
+def baseline_covariance(store: EpochStore, tmax = 0., picks = "meg", batch_size = 64) -> mne.Covariance:
+    """
+    Empirical noise covariance over the samples up to tmax of all epochs, accumulated batch by batch.
+    """
+    picks = mne.pick_types(store.info, meg = True) if picks == "meg" else np.asarray(picks)
+    times = store.times <= tmax
+
+    n, sums, products = 0, np.zeros(len(picks)), np.zeros((len(picks), len(picks)))
+
+    for data, _ in store.iter_epochs(batch_size = batch_size):
+        samples = data[:, picks][:, :, times].transpose(1, 0, 2).reshape(len(picks), -1).astype(float)
+        n += samples.shape[1]
+        sums += samples.sum(axis = 1)
+        products += samples @ samples.T
+
+    cov = (products - np.outer(sums, sums) / n) / (n - 1)
+    ch_names = [store.ch_names[pick] for pick in picks]
+
+    return mne.Covariance(cov, ch_names, bads = [], projs = store.info["projs"], nfree = n - 1, verbose = False)
+
+
+def inverse_kernel(inverse_operator, info, method = "dSPM", lambda2 = 1. / 9.):
+    """
+    Vector inverse kernel, applying the inverse to an identity "evoked" with one sample per channel.
+
+    Returns
+    -------
+    kernel : np.ndarray
+        (n_sources, 3, n_channels)
+    ch_names : list of str
+        channels of the kernel columns
+    """
+    ch_names = [ch for ch in inverse_operator["info"]["ch_names"] if ch not in inverse_operator["info"]["bads"]]
+    info = mne.pick_info(info, [info["ch_names"].index(ch) for ch in ch_names])
+
+    identity = mne.EvokedArray(np.eye(len(ch_names)), info, tmin = 0, nave = 1, verbose = False)
+    stc = apply_inverse(identity, inverse_operator, lambda2, method, pick_ori = "vector", verbose = False)
+
+    return stc.data, ch_names
+
+
+def label_projections(kernel: np.ndarray, slices: dict, rtol = 1e-6) -> dict:
+    """
+    Per label the (rank, n_channels) matrix P = S V^T of the SVD of its kernel rows, so ||P y|| = ||K y|| for any
+    sensor vector y, and the number of sources. Singular values below rtol times the largest are dropped.
+    """
+    projections = {}
+
+    for label, sources in slices.items():
+        rows = kernel[sources].reshape(-1, kernel.shape[-1])
+        _, s, vt = np.linalg.svd(rows, full_matrices = False)
+        keep = s > s[0] * rtol
+        projections[label] = (s[keep, np.newaxis] * vt[keep], sources.stop - sources.start)
+
+    return projections
+
+
+def _label_power_task(store_path, ch_idx, projections, conditions, freqs, n_cycles, decim, batch_size):
+    """
+    Summed source power of some labels at some frequencies, per condition.
+
+    Returns
+    -------
+    dict
+        label to (n_conditions, n_freqs, n_times) power summed over epochs and averaged over sources
+    """
+    store = EpochStore(store_path)
+    power = {label: None for label in projections}
+
+    for i, condition in enumerate(conditions):
+        for data, _ in store.iter_epochs(condition, batch_size = batch_size):
+            tfr = tfr_array_morlet(data[:, ch_idx].astype(float), store.meta["sfreq"], freqs, n_cycles = n_cycles, decim = decim, output = "complex", verbose = False)
+
+            for label, (projection, n_sources) in projections.items():
+                # (epochs, rank, freqs, times) source space components of the label
+                projected = np.einsum("rc,ecft->erft", projection, tfr, optimize = True)
+                batch_power = (projected.real**2 + projected.imag**2).sum(axis = (0, 1)) / n_sources
+
+                if power[label] is None:
+                    power[label] = np.zeros((len(conditions),) + batch_power.shape)
+                power[label][i] += batch_power
+
+    return power
+
+
+def extract_label_power(store: EpochStore, projections: dict, ch_names: list, freqs, conditions: list = None, n_cycles = None, decim = 1, baseline = (-0.1, 0), baseline_mode = "mean", n_jobs = 1, freq_block_size = None, label_blocks = 1, batch_size = 8):
+    """
+    Induced power (average over epochs of the single epoch power) of source space labels per condition.
+
+    Parameters
+    ----------
+    store : epoching.EpochStore
+    projections : dict
+        output of label_projections
+    ch_names : list of str
+        channels of the kernel (inverse_kernel)
+    freqs : array
+        frequencies in Hz
+    conditions : list of str, default None
+        event names, all conditions with epochs if None
+    n_cycles : float or array, default None
+        cycles of the Morlet wavelets, freqs / 2 if None
+    decim : int, default 1
+        decimation of the power in time
+    baseline, baseline_mode : default (-0.1, 0) and "mean"
+        passed on to mne.baseline.rescale, applied to the averaged power (None for no baseline correction)
+    n_jobs : int, default 1
+        worker processes
+    freq_block_size : int, default None
+        frequencies per task, by default the frequencies are split in n_jobs blocks
+    label_blocks : int, default 1
+        groups the labels are split in. The sensor transform is shared by the labels of a task, so splitting labels
+        only pays off with more workers than frequency blocks.
+    batch_size : int, default 8
+        epochs transformed at a time, memory is about batch_size * n_channels * n_freqs * n_times * 16 bytes per task
+
+    Returns
+    -------
+    power : dict
+        label to (n_conditions, n_freqs, n_times) array
+    info : dict
+        conditions, n_epochs per condition, freqs, times and n_sources per label
+    """
+    freqs = np.asarray(freqs, dtype = float)
+    n_cycles = freqs / 2. if n_cycles is None else n_cycles
+    n_cycles = np.broadcast_to(n_cycles, freqs.shape)
+
+    if conditions is None:
+        conditions = [name for name, count in store.conditions.items() if count > 0]
+
+    ch_idx = np.array([store.ch_names.index(ch) for ch in ch_names])
+
+    if freq_block_size is None:
+        freq_block_size = int(np.ceil(len(freqs) / max(n_jobs, 1)))
+    freq_blocks = [np.arange(start, min(start + freq_block_size, len(freqs))) for start in range(0, len(freqs), freq_block_size)]
+    label_groups = [list(group) for group in np.array_split(list(projections), min(label_blocks, len(projections)))]
+
+    tasks = [(labels, block) for labels in label_groups for block in freq_blocks]
+
+    def task_args(labels, block):
+        return (str(store.path), ch_idx, {label: projections[label] for label in labels}, conditions, freqs[block], n_cycles[block], decim, batch_size)
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            results = list(executor.map(_label_power_task, *zip(*[task_args(labels, block) for labels, block in tasks])))
+    else:
+        results = [_label_power_task(*task_args(labels, block)) for labels, block in tasks]
+
+    n_epochs = np.array([store.conditions[condition] for condition in conditions])
+    times = store.times[::decim]
+
+    power = {}
+    for (labels, block), result in zip(tasks, results):
+        for label in labels:
+            if label not in power:
+                power[label] = np.zeros((len(conditions), len(freqs), len(times)))
+            power[label][:, block] = result[label]
+
+    for label in power:
+        power[label] /= np.maximum(n_epochs, 1)[:, np.newaxis, np.newaxis]
+        if baseline is not None:
+            power[label] = mne.baseline.rescale(power[label], times, baseline, mode = baseline_mode, copy = False, verbose = False)
+
+    info = {
+        "conditions": conditions,
+        "n_epochs": n_epochs.tolist(),
+        "freqs": freqs.tolist(),
+        "times": times.tolist(),
+        "n_sources": {label: n_sources for label, (_, n_sources) in projections.items()},
+        "baseline": baseline,
+        "baseline_mode": baseline_mode
+        }
+
+    return power, info
+
+
+def save_label_power(power: dict, info: dict, path, dtype = np.float32):
+    """
+    Writes one <label>.npy per label, (n_conditions, n_freqs, n_times) in dtype, and power_info.json.
+    """
+    path = Path(path)
+    path.mkdir(parents = True, exist_ok = True)
+
+    for label, label_power in power.items():
+        np.save(path / f"{label}.npy", label_power.astype(dtype))
+
+    with (path / "power_info.json").open("w") as f:
+        json.dump(info, f, default = str)
+
+
+def load_label_power(path, labels: list = None, mmap_mode = "r"):
+    """
+    Reads the output of save_label_power, memory-mapped by default.
+    """
+    path = Path(path)
+
+    with (path / "power_info.json").open() as f:
+        info = json.load(f)
+
+    labels = list(info["n_sources"]) if labels is None else labels
+
+    return {label: np.load(path / f"{label}.npy", mmap_mode = mmap_mode) for label in labels}, info
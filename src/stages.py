@@ -0,0 +1,177 @@
+"""
+Incremental reruns of the pipeline of a participant. Stages declare the fnames they read and write and their
+parameters, and a stage is skipped when neither its parameters nor its input files changed since it last ran and its
+outputs are still there. Stages producing the inputs of another stage run first, so changing a parameter (e.g. the
+peak detection widths) reruns that stage and the stages downstream of it only.
+"""
+import json
+from pathlib import Path
+from cache import file_fingerprint, make_key
+from instrumentation import stage as timed_stage
+
+
+def path_fingerprint(path):
+    """
+    Fingerprint of a file, of all files in a directory, or None if it does not exist.
+    """
+    path = Path(path)
+
+    if path.is_dir():
+        return sorted((file_fingerprint(f) for f in path.rglob("*") if f.is_file()), key = lambda fingerprint: fingerprint["path"])
+    if path.exists():
+        return file_fingerprint(path)
+    return None
+
+
+def fnames_fingerprint(fnames: dict, names: list) -> dict:
+    """
+    Fingerprints of the paths (or lists of paths, e.g. subj_raws_list) of fnames entries.
+    """
+    fingerprints = {}
+    for name in names:
+        paths = fnames[name]
+        fingerprints[name] = [path_fingerprint(path) for path in paths] if isinstance(paths, (list, tuple)) else path_fingerprint(paths)
+
+    return fingerprints
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+    func : callable
+        called as func(participant, **params)
+    inputs : list of str
+        fnames keys the stage reads
+    outputs : list of str
+        fnames keys the stage writes
+    params : dict
+        keyword arguments of func, part of the fingerprint
+    version : int or str
+        bump to rerun the stage after changing its code
+    """
+    def __init__(self, name: str, func, inputs = (), outputs = (), params: dict = None, version = 1):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = dict(params or {})
+        self.version = version
+
+    def key(self, fnames: dict) -> str:
+        return make_key(stage = self.name, version = self.version, params = self.params, inputs = fnames_fingerprint(fnames, self.inputs))
+
+
+class StageGraph:
+    """
+    Stages of the pipeline, run in dependency order and skipped when up to date.
+
+    The state (key and output fingerprints of each stage that ran) is stored per participant as json in
+    fnames["stage_state"].
+    """
+    def __init__(self, stages: list = ()):
+        self.stages = {}
+        for stage in stages:
+            self.add(stage)
+
+    def add(self, stage: Stage):
+        self.stages[stage.name] = stage
+        return stage
+
+    def upstream(self, name: str) -> list:
+        """
+        Names of the stages writing the inputs of a stage.
+        """
+        inputs = set(self.stages[name].inputs)
+        return [other.name for other in self.stages.values() if other.name != name and inputs & set(other.outputs)]
+
+    def order(self, targets: list = None) -> list:
+        """
+        The targets (all stages if None) and their upstream stages, each after the stages it depends on.
+        """
+        ordered, visiting = [], set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} depends on itself")
+            visiting.add(name)
+            for upstream in self.upstream(name):
+                visit(upstream)
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in (targets if targets is not None else list(self.stages)):
+            visit(name)
+
+        return ordered
+
+    @staticmethod
+    def _read_state(path) -> dict:
+        path = Path(path)
+        if not path.exists():
+            return {}
+        with path.open() as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_state(path, state: dict):
+        path = Path(path)
+        path.parent.mkdir(parents = True, exist_ok = True)
+        tmp_path = path.with_suffix(".tmp")
+
+        with tmp_path.open("w") as f:
+            json.dump(state, f, indent = 1, default = str)
+        tmp_path.replace(path)
+
+    def is_up_to_date(self, name: str, fnames: dict, state: dict) -> bool:
+        stage = self.stages[name]
+        recorded = state.get(name)
+
+        return (
+            recorded is not None
+            and recorded["key"] == stage.key(fnames)
+            and recorded["outputs"] == json.loads(json.dumps(fnames_fingerprint(fnames, stage.outputs), default = str))
+            and all(output is not None for output in recorded["outputs"].values())
+            )
+
+    def run(self, participant, targets: list = None, force = False) -> dict:
+        """
+        Runs the targets (all stages if None) for a participant, and the stages upstream of them, skipping those that
+        are up to date.
+
+        force:
+            True to run all of them, or a list of stage names to run regardless of their state
+
+        Returns
+        -------
+        dict
+            stage name to "ran" or "skipped"
+        """
+        fnames = participant.fnames
+        state = self._read_state(fnames["stage_state"])
+        status = {}
+
+        for name in self.order(targets):
+            forced = force is True or (isinstance(force, (list, tuple)) and name in force)
+
+            if not forced and self.is_up_to_date(name, fnames, state):
+                print(f"{participant.subj_id}: {name} is up to date")
+                status[name] = "skipped"
+                continue
+
+            stage = self.stages[name]
+            key = stage.key(fnames) # inputs as the stage reads them, after upstream stages ran
+
+            with timed_stage(f"stage_{name}", subject = participant.subj_id):
+                stage.func(participant, **stage.params)
+
+            state[name] = {"key": key, "params": stage.params, "outputs": fnames_fingerprint(fnames, stage.outputs)}
+            self._write_state(fnames["stage_state"], state)
+            status[name] = "ran"
+
+        return status